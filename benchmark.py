@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""
+Mediciones de rendimiento del sistema de vigilancia sin cámaras reales.
+
+Las cámaras simuladas usan la misma clase Camara que la aplicación; solo se
+reemplaza la apertura del stream por una fuente local (escena sintética o
+archivo de video) que entrega frames al ritmo de una cámara real.
+
+Uso:
+    python benchmark.py                      # todas las mediciones, comparadas con la base guardada
+                                             # (o, si no hay, con benchmark_referencia.json a modo informativo)
+    python benchmark.py --rapido             # versión corta para verificar antes de desplegar
+    python benchmark.py --archivo clip.mp4   # usar un video local en lugar de escenas sintéticas
+    python benchmark.py --guardar-base       # guardar los resultados como nueva base
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import detector
+from detector import MotorMovimiento, Camara, SalidaVista, CacheSondeo, CatalogoGrabaciones, FPS_VISUALIZACION
+
+# Resoluciones de origen y anchos de análisis a comparar (0 = resolución completa)
+RESOLUCIONES = [(1280, 720), (1920, 1080), (3840, 2160)]
+ANCHOS_ANALISIS = [0, 1280, 960, 640, 480, 320]
+CANTIDADES_CAMARAS = [1, 2, 4, 8, 16, 32]
+ARCHIVO_BASE = 'benchmark_base.json'
+ARCHIVO_REFERENCIA = 'benchmark_referencia.json'  # base incluida en el repositorio, medida con --rapido
+TOLERANCIA = 0.20  # variación relativa aceptada respecto de la base
+REPETICIONES_DETECCION = 5  # se toma la mejor para que el ruido del equipo no parezca una regresión
+
+# Sentido de cada métrica al comparar con la base: True si un valor mayor es mejor
+MAYOR_ES_MEJOR = {
+    'fps': True,
+    'cpu_ms': False,
+    'cpu_pct': False,
+    'rss_mb': False,
+    'latencia_p50_ms': False,
+    'latencia_p95_ms': False,
+    'fps_por_camara': True,
+    'frames_por_segundo': True,
+    'mb_por_segundo': True,
+}
+
+
+def generar_frames(ancho, alto, cantidad=60, semilla=0, actividad=1.0):
+    """Genera una escena con ruido de sensor y un rectángulo que cruza la imagen.
+
+    `actividad` es la fracción de frames con movimiento: en el resto la escena
+    queda quieta, como una cámara que pasa la mayor parte del tiempo en reposo.
+    """
+    rng = np.random.default_rng(semilla)
+    fondo = rng.integers(60, 90, size=(alto, ancho, 3), dtype=np.uint8)
+    frames = []
+    lado = max(16, alto // 5)
+    con_movimiento = max(1, int(round(cantidad * actividad)))
+    for i in range(cantidad):
+        frame = fondo.copy()
+        if i < con_movimiento:
+            x = int((ancho - lado) * i / max(1, con_movimiento - 1))
+            y = alto // 3
+            cv2.rectangle(frame, (x, y), (x + lado, y + lado), (230, 230, 230), -1)
+        frames.append(frame)
+    return frames
+
+
+# Fuentes locales con la interfaz de cv2.VideoCapture que usa Camara
+class FuenteSintetica:
+    """Entrega frames pregenerados en bucle a `fps` cuadros por segundo (0 = sin límite)."""
+
+    def __init__(self, frames, fps=15):
+        self.frames = frames
+        self.intervalo = 1.0 / fps if fps else 0
+        self.indice = 0
+        self.abierta = True
+        self.ultimo_instante = None  # Momento en que read() entregó el último frame
+        self._proximo = time.perf_counter()
+
+    def isOpened(self):
+        return self.abierta
+
+    def esperar_turno(self):
+        if not self.intervalo:
+            return
+        espera = self._proximo - time.perf_counter()
+        if espera > 0:
+            time.sleep(espera)
+        # Si la captura se atrasa no se acumulan frames pendientes, igual que en un stream en vivo
+        self._proximo = max(self._proximo + self.intervalo, time.perf_counter())
+
+    def read(self):
+        if not self.abierta:
+            return False, None
+        self.esperar_turno()
+        frame = self.frames[self.indice % len(self.frames)]
+        self.indice += 1
+        self.ultimo_instante = time.perf_counter()
+        return True, frame
+
+    def get(self, propiedad):
+        if propiedad == cv2.CAP_PROP_POS_MSEC:
+            return self.indice * (self.intervalo or 1 / 30) * 1000
+        return 0
+
+    def release(self):
+        self.abierta = False
+
+
+class FuenteArchivo(FuenteSintetica):
+    """Decodifica un video local en bucle, de modo que el costo de decodificación también se mide."""
+
+    def __init__(self, ruta, fps=15):
+        super().__init__([], fps)
+        self.ruta = ruta
+        self.cap = cv2.VideoCapture(ruta)
+        self.abierta = self.cap.isOpened()
+
+    def read(self):
+        if not self.abierta:
+            return False, None
+        self.esperar_turno()
+        ret, frame = self.cap.read()
+        if not ret:
+            # Fin del archivo: volver al principio
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read()
+            if not ret:
+                return False, None
+        self.indice += 1
+        self.ultimo_instante = time.perf_counter()
+        return True, frame
+
+    def release(self):
+        self.abierta = False
+        self.cap.release()
+
+
+class CamaraBenchmark(Camara):
+    """Camara alimentada por una fuente local; los clips por movimiento solo se cuentan."""
+
+    def __init__(self, fuente, nombre, config):
+        self.fuente = fuente
+        super().__init__(f"benchmark://{nombre}", nombre, None, None, config)
+        self.has_audio = False
+
+    def abrir_captura(self, url):
+        return self.fuente
+
+    def iniciar_grabacion(self, frame_inicial):
+        pass  # Se mide la detección, no la escritura de clips (ver bench_escritor)
+
+
+class VistaMedida(SalidaVista):
+    """SalidaVista que registra cuánto tarda cada frame desde read() hasta que la interfaz lo toma."""
+
+    def __init__(self, fuente, ancho=400, alto=300, fps=FPS_VISUALIZACION):
+        super().__init__(ancho, alto, fps)
+        self.fuente = fuente
+        self.latencias = []
+        self._instante_listo = None
+
+    def ofrecer(self, frame):
+        instante = self.fuente.ultimo_instante
+        anterior = self._ultimo
+        super().ofrecer(frame)
+        if self._ultimo != anterior:
+            self._instante_listo = instante
+
+    def tomar(self):
+        instante = self._instante_listo
+        frame = super().tomar()
+        if frame is not None and instante is not None:
+            self.latencias.append(time.perf_counter() - instante)
+        return frame
+
+
+@contextlib.contextmanager
+def silenciar():
+    """Oculta los mensajes de las cámaras (de todos los hilos) durante una medición."""
+    original = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = original
+
+
+def memoria_rss_mb():
+    """Memoria residente actual del proceso en MB (pico del proceso si no hay /proc)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+
+
+def crear_fuente(args, frames, fps):
+    if args.archivo:
+        return FuenteArchivo(args.archivo, fps)
+    return FuenteSintetica(frames, fps)
+
+
+def bench_deteccion(frames, ancho_analisis, sensibilidad=100, repeticiones=REPETICIONES_DETECCION):
+    """Devuelve el mejor tiempo de CPU y de reloj por frame de la detección entre varias pasadas, en milisegundos."""
+    motor = MotorMovimiento(ancho_analisis)
+    motor.analizar(frames[0], sensibilidad)  # Inicializar el fondo
+    cpu = reloj = float('inf')
+    for _ in range(repeticiones):
+        cpu_inicio = time.process_time()
+        reloj_inicio = time.perf_counter()
+        for frame in frames:
+            motor.analizar(frame, sensibilidad)
+        cpu = min(cpu, (time.process_time() - cpu_inicio) / len(frames) * 1000)
+        reloj = min(reloj, (time.perf_counter() - reloj_inicio) / len(frames) * 1000)
+    return cpu, reloj
+
+
+def medir_asignaciones(frames, ancho_analisis, sensibilidad=100):
+    """Devuelve el pico de memoria reservada (en bytes) al analizar frames con los buffers ya creados.
+
+    tracemalloc registra las reservas de NumPy, incluidas las salidas que OpenCV
+    crea cuando no recibe dst=, por lo que cualquier arreglo temporal del tamaño
+    del frame aparece en el pico.
+    """
+    motor = MotorMovimiento(ancho_analisis)
+    motor.analizar(frames[0], sensibilidad)
+    motor.analizar(frames[1], sensibilidad)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        for frame in frames:
+            motor.analizar(frame, sensibilidad)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def verificar_asignaciones(frames, ancho_analisis):
+    """Comprueba que el análisis no reserve memoria por frame.
+
+    El pico al analizar todos los frames debe quedar muy por debajo del tamaño de
+    un frame y no crecer respecto del pico con una cuarta parte de ellos. Devuelve
+    (pico en bytes, descripción de la falla o None).
+    """
+    corto = medir_asignaciones(frames[:max(2, len(frames) // 4)], ancho_analisis)
+    largo = medir_asignaciones(frames, ancho_analisis)
+    limite = frames[0].nbytes // 10
+    if largo >= limite:
+        return largo, f"pico de {largo / 1024:.1f} KB, límite {limite / 1024:.1f} KB (1/10 de un frame)"
+    if largo > 2 * corto + 4096:
+        return largo, f"el pico crece con los frames: {corto / 1024:.1f} KB -> {largo / 1024:.1f} KB"
+    return largo, None
+
+
+def medir_deteccion(args):
+    resultados = {}
+    resoluciones = RESOLUCIONES[:2] if args.rapido else RESOLUCIONES
+    print(f"{'Origen':>11} {'Análisis':>9} {'CPU ms/frame':>13} {'Reloj ms/frame':>15} {'FPS':>8} {'Pico KB':>8}")
+    for ancho, alto in resoluciones:
+        frames = generar_frames(ancho, alto, cantidad=30 if args.rapido else 60)
+        for ancho_analisis in ANCHOS_ANALISIS:
+            if ancho_analisis >= ancho:
+                continue
+            cpu, reloj = bench_deteccion(frames, ancho_analisis)
+            pico, falla = verificar_asignaciones(frames, ancho_analisis)
+            pico /= 1024
+            etiqueta = ancho_analisis or "completo"
+            if falla:
+                args.fallas.append(f"Asignaciones por frame en {ancho}x{alto}@{etiqueta}: {falla}")
+            print(f"{ancho:>5}x{alto:<5} {etiqueta:>9} {cpu:>13.2f} {reloj:>15.2f} {1000 / reloj:>8.1f} {pico:>8.1f}")
+            resultados[f"{ancho}x{alto}@{etiqueta}"] = {'cpu_ms': round(cpu, 3), 'fps': round(1000 / reloj, 1)}
+    return resultados
+
+
+def bench_camaras(args, cantidad, frames):
+    """Ejecuta `cantidad` cámaras simuladas con vista previa y un ciclo de refresco como el de la grilla."""
+    config = dict(detector.CONFIG_POR_DEFECTO)
+    config.update({
+        'modo_grabacion': 'motion',
+        'preroll_segundos': args.preroll,
+        'directorio_videos': args.directorio,
+        'catalogo_grabaciones': os.path.join(args.directorio, 'catalogo.db'),
+        'journal_ftp': os.path.join(args.directorio, 'subidas_ftp.db'),
+    })
+    camaras, vistas = [], []
+    with silenciar():
+        for i in range(cantidad):
+            fuente = crear_fuente(args, frames, args.fps)
+            camara = CamaraBenchmark(fuente, f"bench_{i + 1}", config)
+            vista = VistaMedida(fuente)
+            camara.bus.agregar_consumidor(vista.ofrecer)
+            camaras.append(camara)
+            vistas.append(vista)
+
+        activo = threading.Event()
+        activo.set()
+
+        def refrescar():
+            # Equivalente al RenderizadorGrilla sin Tk: tomar el frame nuevo de cada vista
+            intervalo = 1.0 / FPS_VISUALIZACION
+            while activo.is_set():
+                for vista in vistas:
+                    vista.tomar()
+                time.sleep(intervalo)
+
+        hilo_refresco = threading.Thread(target=refrescar, daemon=True)
+        for camara in camaras:
+            camara.iniciar()
+        hilo_refresco.start()
+
+        time.sleep(min(2.0, args.duracion / 4))  # Calentamiento: conexión y primer análisis
+        frames_inicio = sum(c.frames_capturados for c in camaras)
+        for vista in vistas:
+            vista.latencias.clear()
+        cpu_inicio = time.process_time()
+        reloj_inicio = time.perf_counter()
+        time.sleep(args.duracion)
+        cpu = time.process_time() - cpu_inicio
+        reloj = time.perf_counter() - reloj_inicio
+        frames = sum(c.frames_capturados for c in camaras) - frames_inicio
+        rss = memoria_rss_mb()
+        latencias = [latencia for vista in vistas for latencia in vista.latencias]
+        deteccion = [c.latencia_deteccion for c in camaras]
+
+        activo.clear()
+        for camara in camaras:
+            camara.detener()
+        hilo_refresco.join()
+        time.sleep(0.5)  # Dejar que los hilos de captura terminen
+
+    return {
+        'cpu_pct': round(cpu / reloj * 100, 1),
+        'rss_mb': round(rss, 1),
+        'fps_por_camara': round(frames / reloj / cantidad, 2),
+        'latencia_p50_ms': round(float(np.percentile(latencias, 50)) * 1000, 1) if latencias else None,
+        'latencia_p95_ms': round(float(np.percentile(latencias, 95)) * 1000, 1) if latencias else None,
+        'deteccion_ms': round(float(np.mean(deteccion)) * 1000, 1),
+    }
+
+
+def medir_escalado(args):
+    ancho, alto = args.resolucion
+    frames = generar_frames(ancho, alto, cantidad=args.fps * 4, actividad=args.actividad)
+    cantidades = [c for c in CANTIDADES_CAMARAS if c <= args.max_camaras]
+    print(f"\nCámaras simuladas a {ancho}x{alto}, {args.fps} fps, {args.duracion:.0f} s por medición"
+          + (f" (fuente: {args.archivo})" if args.archivo else ""))
+    print(f"{'Cámaras':>8} {'CPU %':>7} {'RSS MB':>8} {'FPS/cám':>8} {'Vista p50 ms':>13} {'Vista p95 ms':>13} {'Detección ms':>13}")
+    resultados = {}
+    for cantidad in cantidades:
+        r = bench_camaras(args, cantidad, frames)
+        print(f"{cantidad:>8} {r['cpu_pct']:>7.1f} {r['rss_mb']:>8.1f} {r['fps_por_camara']:>8.2f} "
+              f"{r['latencia_p50_ms'] or 0:>13.1f} {r['latencia_p95_ms'] or 0:>13.1f} {r['deteccion_ms']:>13.1f}")
+        resultados[str(cantidad)] = r
+    return resultados
+
+
+def medir_escritor(args):
+    """Mide cuántos frames por segundo codifica el escritor de segmentos continuos sin límite de entrada."""
+    ancho, alto = args.resolucion
+    frames = generar_frames(ancho, alto, cantidad=60)
+    config = dict(detector.CONFIG_POR_DEFECTO)
+    config.update({
+        'modo_grabacion': 'continuous',
+        'backend_grabacion': 'opencv',
+        'directorio_videos': args.directorio,
+        'catalogo_grabaciones': os.path.join(args.directorio, 'catalogo.db'),
+        'journal_ftp': os.path.join(args.directorio, 'subidas_ftp.db'),
+    })
+    with silenciar():
+        fuente = crear_fuente(args, frames, 0)  # Sin límite: el escritor es el cuello de botella
+        camara = CamaraBenchmark(fuente, "bench_escritor", config)
+        inicio_total = time.perf_counter()
+        camara.iniciar()
+        time.sleep(1)
+        escritos_inicio = camara.escritor.escritos
+        inicio = time.perf_counter()
+        time.sleep(args.duracion)
+        transcurrido = time.perf_counter() - inicio
+        escritos = camara.escritor.escritos - escritos_inicio
+        descartados = camara.escritor.descartados
+        camara.detener()
+        total = time.perf_counter() - inicio_total
+        time.sleep(1)  # Dejar que el escritor cierre el segmento
+    carpeta = os.path.join(args.directorio, "bench_escritor")
+    total_bytes = sum(e.stat().st_size for e in os.scandir(carpeta) if e.is_file()) if os.path.isdir(carpeta) else 0
+    resultado = {
+        'frames_por_segundo': round(escritos / transcurrido, 1),
+        'mb_por_segundo': round(total_bytes / (1024 * 1024) / total, 2),
+        'descartados': descartados,
+    }
+    print(f"\nEscritor de segmentos ({ancho}x{alto}, XVID): {resultado['frames_por_segundo']:.1f} frames/s, "
+          f"{resultado['mb_por_segundo']:.2f} MB/s, {descartados} frames descartados por desborde")
+    return resultado
+
+
+def opciones_medicion(args):
+    """Opciones que cambian los resultados, guardadas con la base para saber cómo se midió."""
+    return {
+        'rapido': args.rapido,
+        'archivo': os.path.basename(args.archivo) if args.archivo else None,
+        'resolucion': 'x'.join(str(v) for v in args.resolucion),
+        'fps': args.fps,
+        'actividad': args.actividad,
+        'preroll': args.preroll,
+        'max_camaras': args.max_camaras,
+        'duracion': args.duracion,
+    }
+
+
+def comparar_con_base(resultados, base, tolerancia, orientativa=False):
+    """Imprime las métricas que empeoraron más que `tolerancia` y devuelve cuántas son.
+
+    Con una base de otro equipo, de otras opciones o la de referencia (`orientativa`)
+    las diferencias se informan pero no cuentan como regresiones.
+    """
+    if base.get('equipo') != resultados['equipo']:
+        print(f"\n[Aviso] La base se midió en otro equipo ({base.get('equipo')})")
+        orientativa = True
+    if base.get('opciones') != resultados['opciones']:
+        print(f"[Aviso] La base se midió con otras opciones ({base.get('opciones')}); "
+              f"solo se comparan los casos presentes en ambas")
+        orientativa = True
+    regresiones = 0
+    for seccion in ('deteccion', 'escalado', 'escritor'):
+        actual_seccion = resultados.get(seccion)
+        base_seccion = base.get(seccion)
+        if not actual_seccion or not base_seccion:
+            continue
+        casos = actual_seccion.items() if seccion != 'escritor' else [('', actual_seccion)]
+        for caso, metricas in casos:
+            base_caso = base_seccion.get(caso) if seccion != 'escritor' else base_seccion
+            if not base_caso:
+                continue
+            for metrica, valor in metricas.items():
+                referencia = base_caso.get(metrica)
+                if metrica not in MAYOR_ES_MEJOR or not valor or not referencia:
+                    continue
+                cambio = (valor - referencia) / referencia
+                if not MAYOR_ES_MEJOR[metrica]:
+                    cambio = -cambio
+                if cambio < -tolerancia:
+                    regresiones += 1
+                    print(f"[{'Diferencia' if orientativa else 'Regresión'}] {seccion} {caso} {metrica}: "
+                          f"{referencia} -> {valor} ({cambio:+.0%})")
+    if orientativa:
+        print(f"\n{regresiones} métricas peores que la base en más de {tolerancia:.0%}. La comparación es "
+              f"orientativa: guarde una base propia con --guardar-base y las mismas opciones para detectar regresiones")
+        return 0
+    if regresiones:
+        print(f"\n{regresiones} métricas empeoraron más de {tolerancia:.0%} respecto de la base")
+    else:
+        print(f"\nSin regresiones mayores a {tolerancia:.0%} respecto de la base")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mediciones de rendimiento sin cámaras reales")
+    parser.add_argument('--rapido', action='store_true', help="mediciones cortas y hasta 8 cámaras")
+    parser.add_argument('--solo', choices=['deteccion', 'escalado', 'escritor'], help="ejecutar una sola medición")
+    parser.add_argument('--archivo', help="video local usado como fuente en lugar de escenas sintéticas")
+    parser.add_argument('--resolucion', type=lambda v: tuple(int(x) for x in v.lower().split('x')),
+                        default=(640, 360), help="resolución de las cámaras simuladas (por defecto 640x360)")
+    parser.add_argument('--fps', type=int, default=15, help="fps de cada cámara simulada")
+    parser.add_argument('--actividad', type=float, default=0.3, help="fracción del tiempo con movimiento en escena")
+    parser.add_argument('--preroll', type=int, default=3, help="segundos de pre-grabación por cámara")
+    parser.add_argument('--max-camaras', type=int, default=32, help="cantidad máxima de cámaras simuladas")
+    parser.add_argument('--duracion', type=float, default=10, help="segundos de cada medición de cámaras")
+    parser.add_argument('--base', default=ARCHIVO_BASE, help="archivo de resultados de referencia")
+    parser.add_argument('--guardar-base', action='store_true', help="guardar los resultados como nueva base")
+    parser.add_argument('--tolerancia', type=float, default=TOLERANCIA, help="empeoramiento relativo aceptado")
+    args = parser.parse_args()
+    if args.rapido:
+        args.max_camaras = min(args.max_camaras, 8)
+        args.duracion = min(args.duracion, 4)
+
+    # Archivos, caché de sondeo, catálogo y journal en un directorio temporal para no tocar los de la instalación
+    args.directorio = tempfile.mkdtemp(prefix="benchmark_vigilancia_")
+    args.fallas = []
+    detector.CACHE_SONDEO = CacheSondeo(archivo=os.path.join(args.directorio, 'sondeo.json'))
+    # El catálogo compartido se crea aquí para que las grabaciones simuladas no lleguen al de producción
+    detector.CATALOGO = CatalogoGrabaciones(os.path.join(args.directorio, 'catalogo.db'))
+
+    resultados = {
+        'equipo': f"{platform.node()} {platform.machine()} {os.cpu_count()} CPU",
+        'fecha': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'opencv': cv2.__version__,
+        'opciones': opciones_medicion(args),
+    }
+    try:
+        if args.solo in (None, 'deteccion'):
+            resultados['deteccion'] = medir_deteccion(args)
+        if args.solo in (None, 'escalado'):
+            resultados['escalado'] = medir_escalado(args)
+        if args.solo in (None, 'escritor'):
+            resultados['escritor'] = medir_escritor(args)
+    finally:
+        shutil.rmtree(args.directorio, ignore_errors=True)
+
+    if args.fallas:
+        print()
+        for falla in args.fallas:
+            print(f"FALLA: {falla}")
+        return 1
+    if args.guardar_base:
+        with open(args.base, 'w') as f:
+            json.dump(resultados, f, indent=4)
+        print(f"\nResultados guardados como base en {args.base}")
+        return 0
+    orientativa = False
+    try:
+        with open(args.base, 'r') as f:
+            base = json.load(f)
+    except FileNotFoundError:
+        print(f"\nNo hay base en {args.base}. Créela en este equipo con:\n"
+              f"    python benchmark.py {'--rapido ' if args.rapido else ''}--guardar-base --base {args.base}")
+        # Sin base propia se compara con la de referencia del repositorio, solo para informar
+        referencia = os.path.join(os.path.dirname(os.path.abspath(__file__)), ARCHIVO_REFERENCIA)
+        if args.base != ARCHIVO_BASE or not os.path.exists(referencia):
+            return 2
+        with open(referencia, 'r') as f:
+            base = json.load(f)
+        print(f"Comparando con la base de referencia {ARCHIVO_REFERENCIA}")
+        orientativa = True
+    return 1 if comparar_con_base(resultados, base, args.tolerancia, orientativa) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,12 +6,7 @@ Created on Thu Nov 14 22:58:22 2024
 """
 
 import cv2
-import tkinter as tk
-import ttkbootstrap as ttk
-from ttkbootstrap import Style
-from tkinter import messagebox, filedialog
-from threading import Thread, Lock
-from PIL import Image, ImageTk  # Para convertir frames en imágenes compatibles con tkinter
+from threading import Thread, Lock, Condition, BoundedSemaphore, Event
 import os
 import datetime
 import queue
@@ -20,11 +15,31 @@ import numpy as np
 import ffmpeg
 import subprocess
 import tempfile
+import shutil
 import ftplib
 import json
+import math
+import random
+import sqlite3
+import hashlib
+import urllib.parse
 import schedule
 import logging
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# La interfaz gráfica es opcional: en un servidor sin pantalla se usa el modo --headless
+try:
+    import tkinter as tk
+    import ttkbootstrap as ttk
+    from ttkbootstrap import Style
+    from tkinter import messagebox, filedialog
+    from PIL import Image, ImageTk  # Para convertir frames en imágenes compatibles con tkinter
+except ImportError:
+    tk = ttk = Style = messagebox = filedialog = Image = ImageTk = None
 
 # Configuración de estilo moderno con ttkbootstrap
 STYLE_CONFIG = {
@@ -36,9 +51,97 @@ STYLE_CONFIG = {
 }
 
 # Configuración global para FTP
-FTP_QUEUE = deque()
-FTP_QUEUE_LOCK = Lock()
 FTP_RETRY_DELAY = 120  # 2 minutos en segundos
+FTP_MAX_INTENTOS = 3  # intentos ante errores permanentes del servidor (respuestas 5xx)
+FTP_RETRY_DELAY_MAXIMO = 3600  # tope de la espera entre reintentos por errores de conexión
+FTP_TRABAJADORES = 3  # subidas simultáneas del servicio FTP
+FTP_KEEPALIVE = 60  # segundos de inactividad antes de enviar NOOP a una sesión libre
+FTP_SESION_MAXIMA_INACTIVA = 300  # segundos tras los que se cierra una sesión libre
+FTP_TIMEOUT = 30  # segundos de timeout de las operaciones FTP
+ARCHIVO_JOURNAL_FTP = 'subidas_ftp.db'  # registro persistente de subidas (SQLite)
+FTP_HORAS_RETENCION = 96  # antigüedad a partir de la cual se eliminan los archivos remotos
+FTP_SESIONES_LIMPIEZA = 3  # sesiones FTP en paralelo al eliminar archivos remotos
+FTP_LOTE_LIMPIEZA = 500  # archivos leídos del journal por cada tanda de eliminación
+FTP_DIAS_RECONCILIACION = 7  # cada cuántos días se recorre el servidor buscando archivos sin registro
+SERVICIO_FTP = None
+SERVICIO_FTP_LOCK = Lock()
+
+# Configuración de grabación
+FPS_GRABACION = 20  # Tasa de frames de los archivos grabados
+SEGUNDOS_SEGMENTO_ANILLO = 2  # duración de los segmentos del stream principal para clips de cámaras con substream
+
+# Catálogo local de grabaciones (SQLite)
+ARCHIVO_CATALOGO = 'catalogo_grabaciones.db'
+LOTE_CATALOGO = 500  # grabaciones leídas del catálogo por cada tanda de limpieza
+CATALOGO = None
+CATALOGO_LOCK = Lock()
+
+# Retención automática de grabaciones (0 desactiva cada límite)
+RETENCION_INTERVALO = 60  # segundos entre pasadas del servicio de retención
+RETENCION_LOTE = 20  # grabaciones eliminadas por tanda
+RETENCION_PAUSA = 0.5  # segundos de pausa entre tandas para no competir con la escritura
+RETENCION_MARGEN = 3600  # no se eliminan grabaciones iniciadas hace menos (pueden seguir abiertas)
+RETENCION_MIN_LIBRE_GB = 0  # espacio libre mínimo en el disco de los videos (opcional)
+SERVICIO_RETENCION = None
+SERVICIO_RETENCION_LOCK = Lock()
+
+# Configuración de detección de movimiento (valores expresados a resolución completa)
+AREA_MINIMA_MOVIMIENTO = 5000  # píxeles
+KERNEL_DESENFOQUE = 31
+ALFA_FONDO = 0.005  # adaptación del fondo por frame de la cámara
+KERNEL_DILATACION = 7  # a resolución completa; equivale a 3 iteraciones con 3x3
+ANCHO_ANALISIS = 640  # ancho del frame de análisis (0 = resolución completa)
+ANALISIS_CADA_N_REPOSO = 5  # en reposo se analiza 1 de cada N frames
+ANALISIS_CADA_N_ACTIVO = 1  # con actividad se analizan todos los frames
+SEGUNDOS_QUIETUD = 10  # tiempo sin movimiento para volver al ritmo de reposo
+HILOS_DETECCION = max(1, (os.cpu_count() or 2) // 2)  # hilos del pool compartido de detección
+
+FPS_VISUALIZACION = 15  # refrescos por segundo de la grilla de cámaras
+CELDA_MOSAICO = (320, 240)  # tamaño de cada cámara en la vista mosaico
+COLA_ESCRITOR = 40  # frames pendientes máximos del escritor de segmentos continuos
+POLITICA_DESBORDE = 'descartar_antiguo'  # 'descartar_antiguo' o 'descartar_nuevo'
+
+# Sondeo de capacidades de los streams (audio, códecs, resolución, fps)
+ARCHIVO_CACHE_SONDEO = 'sondeo_streams.json'
+TTL_SONDEO = 7 * 24 * 3600  # segundos antes de volver a sondear un stream sin cambios
+TIMEOUT_SONDEO = 8  # segundos máximos de ffprobe por stream
+CACHE_SONDEO = None
+CACHE_SONDEO_LOCK = Lock()
+
+# Pool de detección compartido por todas las cámaras (se crea al primer uso)
+POOL_DETECCION = None
+POOL_DETECCION_LOCK = Lock()
+
+# Supervisión de conexiones: un stream sano nunca se reinicia, solo uno estancado
+SEGUNDOS_SIN_FRAMES = 10  # sin frames nuevos durante este tiempo se considera estancado
+SEGUNDOS_PTS_CONGELADO = 10  # frames con la misma marca de tiempo durante este tiempo
+BACKOFF_BASE = 1  # segundos de espera del primer reintento
+BACKOFF_MAXIMO = 60  # tope de la espera entre reintentos
+RECONEXIONES_SIMULTANEAS = 4  # aperturas de stream en curso a la vez entre todas las cámaras
+TIMEOUT_APERTURA_MS = 10000  # timeout de apertura del stream en OpenCV
+TIMEOUT_LECTURA_MS = 5000  # timeout de lectura de un frame en OpenCV
+SEMAFORO_RECONEXION = None
+SEMAFORO_RECONEXION_LOCK = Lock()
+
+# Métricas en formato Prometheus (solo en la interfaz local)
+PUERTO_METRICAS = 9108  # 0 desactiva el servidor de métricas
+HOST_METRICAS = '127.0.0.1'
+
+# Valores por defecto de config.json
+CONFIG_POR_DEFECTO = {
+    'modo_grabacion': 'motion',  # "motion", "continuous", "none"
+    'duracion_grabacion': 15,  # segundos para motion
+    'segmento_continuo': 5,  # minutos para continuous
+    'backend_grabacion': 'opencv',  # "opencv" (recodifica a XVID) o "copia" (ffmpeg -c copy)
+    'sensibilidad_movimiento': 100,
+    'preroll_segundos': 3,
+    'preroll_max_mb': 128,
+    'ancho_analisis': ANCHO_ANALISIS,
+    'directorio_videos': './videos',
+    'modo_mosaico': False,
+    'ftp_config': {'host': '', 'user': '', 'password': '', 'remote_path': '/videos'},
+    'por_camara': {}
+}
 
 # Función para leer el archivo de configuración
 def leer_camaras(archivo):
@@ -46,24 +149,1007 @@ def leer_camaras(archivo):
         urls = f.read().strip().split(',')
     return urls
 
+def cargar_config(archivo='config.json'):
+    """Lee config.json completando las claves faltantes con los valores por defecto."""
+    config = json.loads(json.dumps(CONFIG_POR_DEFECTO))  # copia profunda de los valores por defecto
+    try:
+        with open(archivo, 'r') as f:
+            datos = json.load(f)
+        config['ftp_config'].update(datos.pop('ftp_config', {}))
+        config.update(datos)
+        print(f"[Config] Configuración cargada desde {archivo}")
+    except FileNotFoundError:
+        print("[Config] No se encontró archivo de configuración, usando valores por defecto")
+    except Exception as e:
+        print(f"[Error] Error al cargar configuración: {e}")
+    return config
+
+def cargar_lista_camaras(archivo_urls="camaras.txt", archivo_nombres="nombres_camaras.txt",
+                         archivo_substreams="substreams_camaras.txt"):
+    """Devuelve las listas paralelas de URLs, nombres y substreams ('' si la cámara no tiene)."""
+    try:
+        urls = leer_camaras(archivo_urls)
+    except FileNotFoundError:
+        urls = []
+    # Cargar nombres de cámaras si existe el archivo
+    try:
+        with open(archivo_nombres, 'r') as f:
+            nombres = f.read().strip().split(',')
+    except FileNotFoundError:
+        nombres = [f"Cámara_{i+1}" for i in range(len(urls))]
+    # Asegurar que tengamos nombres para todas las URLs
+    while len(nombres) < len(urls):
+        nombres.append(f"Cámara_{len(nombres)+1}")
+    # Cargar substreams si existe el archivo (una entrada vacía indica que no hay substream)
+    try:
+        with open(archivo_substreams, 'r') as f:
+            substreams = [u.strip() for u in f.read().strip().split(',')]
+    except FileNotFoundError:
+        substreams = []
+    substreams = (substreams + [''] * len(urls))[:len(urls)]
+    return urls, nombres, substreams
+
+def config_para_camara(config, nombre):
+    """Configuración de una cámara: la global con sus ajustes específicos aplicados encima."""
+    config_camara = dict(config)
+    por_camara = config_camara.pop('por_camara', None) or {}
+    config_camara.update(por_camara.get(nombre, {}))
+    return config_camara
+
+# Bus de distribución de frames: un único decode por cámara alimenta a todos los consumidores
+class BusFrames:
+    """Distribuye cada frame capturado a todas las colas suscritas sin bloquear la captura.
+
+    Los frames se comparten entre suscriptores, por lo que ningún consumidor debe
+    modificarlos en el lugar.
+    """
+
+    def __init__(self):
+        self._suscriptores = []
+        self._consumidores = []  # Funciones que reciben cada frame en el hilo de captura
+        self._lock = Lock()
+        self.descartados = 0  # Frames descartados por colas de suscriptores llenas
+
+    def suscribir(self, maxsize=10):
+        """Crea y registra una cola que recibirá los frames publicados."""
+        cola = queue.Queue(maxsize=maxsize)
+        with self._lock:
+            self._suscriptores.append(cola)
+        return cola
+
+    def desuscribir(self, cola):
+        with self._lock:
+            if cola in self._suscriptores:
+                self._suscriptores.remove(cola)
+
+    def suscribir_con_instantanea(self, instantanea, maxsize=10):
+        """Registra una cola y llama a `instantanea()` de forma atómica respecto de `publicar`.
+
+        Cada frame queda registrado por la función `guardar` de su publicación antes
+        de la instantánea, o llega a la cola, nunca en ambos. Devuelve (cola, resultado).
+        """
+        cola = queue.Queue(maxsize=maxsize)
+        with self._lock:
+            resultado = instantanea()
+            self._suscriptores.append(cola)
+        return cola, resultado
+
+    def agregar_consumidor(self, funcion):
+        """Registra una función que se llamará con cada frame en el hilo que publica; debe ser rápida."""
+        with self._lock:
+            self._consumidores.append(funcion)
+
+    def quitar_consumidor(self, funcion):
+        with self._lock:
+            if funcion in self._consumidores:
+                self._consumidores.remove(funcion)
+
+    def publicar(self, frame, guardar=None):
+        """Entrega el frame; `guardar` (por ejemplo el buffer de pre-grabación) se llama junto
+        con la lectura de suscriptores para que `suscribir_con_instantanea` no duplique frames."""
+        with self._lock:
+            if guardar is not None:
+                guardar(frame)
+            suscriptores = list(self._suscriptores)
+            consumidores = list(self._consumidores)
+        for funcion in consumidores:
+            try:
+                funcion(frame)
+            except Exception as e:
+                print(f"[Error] Error en un consumidor de frames: {e}")
+        for cola in suscriptores:
+            # Intentar poner el frame en la cola sin bloquear
+            try:
+                cola.put_nowait(frame)
+            except queue.Full:
+                # Si la cola está llena, descartar el frame más antiguo
+                self.descartados += 1
+                try:
+                    cola.get_nowait()
+                    cola.put_nowait(frame)
+                except (queue.Empty, queue.Full):
+                    pass
+
+# Preparación de frames para la interfaz
+class SalidaVista:
+    """Prepara frames listos para mostrar (RGB al tamaño de la vista) fuera del hilo de Tk.
+
+    El productor reduce y convierte el frame en uno de tres buffers preasignados, a
+    lo sumo `fps` veces por segundo y solo si la vista no está en pausa. La
+    interfaz toma el más reciente sin convertir nada; con tres buffers el productor
+    nunca escribe sobre el que la interfaz está leyendo.
+    """
+
+    def __init__(self, ancho, alto, fps=FPS_VISUALIZACION):
+        self.ancho = ancho
+        self.alto = alto
+        self.intervalo = 1.0 / max(1, fps)
+        self.pausada = False
+        self.descartados = 0  # Frames preparados que la interfaz no llegó a mostrar
+        self._reducido = np.empty((alto, ancho, 3), dtype=np.uint8)
+        self._buffers = [np.empty((alto, ancho, 3), dtype=np.uint8) for _ in range(3)]
+        self._listo = None  # Buffer preparado pendiente de mostrar
+        self._en_uso = None  # Buffer que está leyendo la interfaz
+        self._ultimo = 0
+        self._lock = Lock()
+
+    def ofrecer(self, frame):
+        """Prepara el frame para la vista si corresponde (en el hilo productor)."""
+        if self.pausada:
+            return
+        ahora = time.time()
+        if ahora - self._ultimo < self.intervalo:
+            return
+        self._ultimo = ahora
+        with self._lock:
+            indice = next(i for i in range(3) if i != self._listo and i != self._en_uso)
+        cv2.resize(frame, (self.ancho, self.alto), dst=self._reducido, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._reducido, cv2.COLOR_BGR2RGB, dst=self._buffers[indice])
+        with self._lock:
+            if self._listo is not None:
+                self.descartados += 1
+            self._listo = indice
+
+    def tomar(self):
+        """Devuelve el frame RGB preparado más reciente, o None si no hay uno nuevo (hilo de Tk)."""
+        with self._lock:
+            if self._listo is None:
+                return None
+            self._en_uso = self._listo
+            self._listo = None
+            return self._buffers[self._en_uso]
+
+# Buffer circular de pre-grabación
+class BufferPreEvento:
+    """Guarda los últimos frames de una cámara en un arreglo NumPy preasignado.
+
+    La capacidad se fija al recibir el primer frame a partir de los segundos de
+    pre-grabación, los fps del stream y el límite de memoria, por lo que el
+    consumo se mantiene constante sin importar cuánto tiempo corra el sistema.
+    `fps_stream` devuelve los fps sondeados (o None mientras no se conocen);
+    hasta entonces se usa `fps` y al conocerlos se vuelve a reservar.
+    """
+
+    def __init__(self, segundos, max_bytes, fps=FPS_GRABACION, fps_stream=None):
+        self.segundos = segundos
+        self.max_bytes = max_bytes
+        self.fps = fps
+        self._fps_stream = fps_stream
+        self._frames = None
+        self._forma = None
+        self._capacidad = 0
+        self._indice = 0
+        self._cantidad = 0
+        self._total = 0  # frames agregados desde la última reserva
+        self._generacion = 0  # cambia al reservar, invalida las marcas anteriores
+        self._lock = Lock()
+
+    def _reservar(self, frame):
+        tamano_frame = frame.nbytes
+        pedidos = int(self.segundos * self.fps)
+        self._capacidad = max(0, min(pedidos, self.max_bytes // tamano_frame))
+        self._frames = np.empty((self._capacidad,) + frame.shape, dtype=frame.dtype) if self._capacidad else None
+        self._forma = frame.shape
+        self._indice = 0
+        self._cantidad = 0
+        self._total = 0
+        self._generacion += 1
+        print(f"[Pre-grabación] Buffer de {self._capacidad} frames ({self._capacidad * tamano_frame / (1024 * 1024):.1f} MB)")
+        if self._capacidad < pedidos:
+            print(f"[Pre-grabación] Aviso: el límite de {self.max_bytes // (1024 * 1024)} MB alcanza para "
+                  f"{self._capacidad / self.fps:.1f} de los {self.segundos} s configurados a "
+                  f"{frame.shape[1]}x{frame.shape[0]} y {self.fps:g} fps; aumente preroll_max_mb")
+
+    def agregar(self, frame):
+        """Copia el frame en la siguiente posición del buffer, sobrescribiendo el más antiguo."""
+        with self._lock:
+            if self._fps_stream is not None:
+                fps = self._fps_stream()
+                if fps:
+                    # Los fps reales del stream ya se conocen: dimensionar con ellos
+                    self._fps_stream = None
+                    if fps != self.fps:
+                        self.fps = fps
+                        self._forma = None
+            if frame.shape != self._forma:
+                # Primer frame, fps recién sondeados o cambio de resolución del stream
+                self._reservar(frame)
+            if not self._capacidad:
+                return
+            np.copyto(self._frames[self._indice], frame)
+            self._indice = (self._indice + 1) % self._capacidad
+            self._cantidad = min(self._cantidad + 1, self._capacidad)
+            self._total += 1
+
+    def marca(self):
+        """Identifica los frames almacenados en este momento, sin copiarlos."""
+        with self._lock:
+            return self._generacion, self._total - self._cantidad, self._total
+
+    def frames(self, marca):
+        """Recorre los frames de la marca del más antiguo al más reciente, copiando uno por vez.
+
+        Los que el buffer ya sobrescribió mientras tanto se omiten.
+        """
+        generacion, inicio, fin = marca
+        for secuencia in range(inicio, fin):
+            with self._lock:
+                if generacion != self._generacion or secuencia < self._total - self._capacidad:
+                    continue
+                frame = self._frames[secuencia % self._capacidad].copy()
+            yield frame
+
+# Motor de detección de movimiento
+class MotorMovimiento:
+    """Detecta movimiento por sustracción de fondo sin reservar memoria por frame.
+
+    Todos los pasos escriben en buffers propios mediante los parámetros dst= de
+    OpenCV. Los buffers se reservan con el primer frame y solo se recrean si
+    cambia la resolución del stream.
+    """
+
+    def __init__(self, ancho_analisis=ANCHO_ANALISIS):
+        self.ancho_analisis = ancho_analisis
+        self.region = None  # Último rectángulo con movimiento, en coordenadas del frame original
+        self._forma = None
+
+    def _reservar(self, frame):
+        alto, ancho = frame.shape[:2]
+        self.escala = self.ancho_analisis / ancho if 0 < self.ancho_analisis < ancho else 1.0
+        ancho_a = max(1, round(ancho * self.escala))
+        alto_a = max(1, round(alto * self.escala))
+
+        # Escalar los parámetros definidos a resolución completa
+        kernel = max(3, int(KERNEL_DESENFOQUE * self.escala) | 1)
+        self._kernel = (kernel, kernel)
+        dilatacion = max(3, int(KERNEL_DILATACION * self.escala) | 1)
+        self._kernel_dilatacion = cv2.getStructuringElement(cv2.MORPH_RECT, (dilatacion, dilatacion))
+        self._area_minima = AREA_MINIMA_MOVIMIENTO * self.escala * self.escala
+        self._limite_inferior = alto_a * 0.8  # Ignorar el 20% inferior (posible timestamp)
+
+        self._reducido = np.empty((alto_a, ancho_a, 3), dtype=np.uint8) if self.escala < 1.0 else None
+        self._gris = np.empty((alto_a, ancho_a), dtype=np.uint8)
+        self._desenfoque = np.empty((alto_a, ancho_a), dtype=np.uint8)
+        self._delta = np.empty((alto_a, ancho_a), dtype=np.uint8)
+        self._umbral = np.empty((alto_a, ancho_a), dtype=np.uint8)
+        self._fondo = np.empty((alto_a, ancho_a), dtype=np.float32)
+        self._fondo_u8 = np.empty((alto_a, ancho_a), dtype=np.uint8)  # Copia en uint8 del fondo para absdiff
+        self._fondo_listo = False
+        self._forma = frame.shape
+        self._paso = 1
+        self._alfa = ALFA_FONDO
+
+    def analizar(self, frame, sensibilidad, paso=1):
+        """Devuelve True si el frame contiene movimiento significativo respecto al fondo.
+
+        `paso` es cada cuántos frames de la cámara se analiza uno; el fondo se adapta
+        con la misma velocidad por segundo sin importar la cadencia.
+        """
+        if frame.shape != self._forma:
+            self._reservar(frame)
+        if paso != self._paso:
+            self._paso = paso
+            self._alfa = 1 - (1 - ALFA_FONDO) ** paso
+
+        # Reducir el frame a la resolución de análisis configurada
+        if self._reducido is not None:
+            cv2.resize(frame, (self._reducido.shape[1], self._reducido.shape[0]), dst=self._reducido, interpolation=cv2.INTER_AREA)
+            frame = self._reducido
+
+        # Convertir a escala de grises
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gris)
+        cv2.GaussianBlur(self._gris, self._kernel, 0, dst=self._desenfoque)  # Mayor blur para reducir ruido
+
+        # Inicializar el fondo si es necesario
+        if not self._fondo_listo:
+            np.copyto(self._fondo, self._desenfoque)
+            np.copyto(self._fondo_u8, self._desenfoque)
+            self._fondo_listo = True
+            return False
+
+        # Calcular la diferencia absoluta entre el fondo y el frame actual
+        cv2.absdiff(self._fondo_u8, self._desenfoque, dst=self._delta)
+        cv2.threshold(self._delta, sensibilidad, 255, cv2.THRESH_BINARY, dst=self._umbral)
+
+        # Dilatar el umbral para llenar agujeros (en el lugar; findContours no modifica la entrada)
+        # El kernel está escalado a la resolución de análisis para que las manchas se unan igual que a resolución completa
+        cv2.dilate(self._umbral, self._kernel_dilatacion, dst=self._umbral)
+
+        # Encontrar contornos
+        contours, _ = cv2.findContours(self._umbral, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        # Verificar si hay movimiento significativo (ignorar contornos muy pequeños)
+        movimiento_significativo = False
+        for contour in contours:
+            if cv2.contourArea(contour) < self._area_minima:  # Área mínima más alta para ignorar ruido
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            if y > self._limite_inferior:
+                continue
+            self.region = tuple(int(v / self.escala) for v in (x, y, w, h))
+            movimiento_significativo = True
+            break
+
+        # Actualizar el fondo gradualmente para adaptarse a cambios de iluminación
+        # Solo actualizar si no hay movimiento para evitar incluir objetos en movimiento en el fondo
+        if not movimiento_significativo:
+            cv2.accumulateWeighted(self._desenfoque, self._fondo, self._alfa)  # Actualización aún más lenta
+            np.copyto(self._fondo_u8, self._fondo, casting='unsafe')
+
+        return movimiento_significativo
+
+# Planificador de la cadencia de análisis
+class PlanificadorAnalisis:
+    """Decide qué frames se analizan según la actividad reciente de la escena.
+
+    En reposo analiza uno de cada `cada_n_reposo` frames; al detectar movimiento
+    pasa a `cada_n_activo` y vuelve al ritmo de reposo tras `segundos_quietud`
+    sin actividad.
+    """
+
+    def __init__(self, cada_n_reposo=ANALISIS_CADA_N_REPOSO, cada_n_activo=ANALISIS_CADA_N_ACTIVO,
+                 segundos_quietud=SEGUNDOS_QUIETUD):
+        self.cada_n_reposo = max(1, cada_n_reposo)
+        self.cada_n_activo = max(1, cada_n_activo)
+        self.segundos_quietud = segundos_quietud
+        self.activo = False
+        self.tasa_efectiva = 0.0  # Análisis por segundo medidos en la última ventana
+        self._contador = 0
+        self._ultima_actividad = 0
+        self._analizados = 0
+        self._inicio_ventana = time.time()
+
+    @property
+    def modo(self):
+        return 'activo' if self.activo else 'reposo'
+
+    @property
+    def paso(self):
+        """Frames de la cámara por cada frame analizado en el modo actual."""
+        return self.cada_n_activo if self.activo else self.cada_n_reposo
+
+    def debe_analizar(self):
+        """Indica si el frame actual debe pasar por la detección de movimiento."""
+        self._contador += 1
+        if self._contador < (self.cada_n_activo if self.activo else self.cada_n_reposo):
+            return False
+        self._contador = 0
+        self._analizados += 1
+
+        # Actualizar la tasa efectiva cada 5 segundos
+        ahora = time.time()
+        transcurrido = ahora - self._inicio_ventana
+        if transcurrido >= 5:
+            self.tasa_efectiva = self._analizados / transcurrido
+            self._analizados = 0
+            self._inicio_ventana = ahora
+        return True
+
+    def registrar(self, movimiento):
+        """Actualiza el modo con el resultado del último análisis."""
+        ahora = time.time()
+        if movimiento:
+            self._ultima_actividad = ahora
+            if not self.activo:
+                self.activo = True
+                self._contador = 0
+        elif self.activo and ahora - self._ultima_actividad > self.segundos_quietud:
+            self.activo = False
+
+# Pool de hilos para la detección de movimiento
+class PoolDeteccion:
+    """Ejecuta la detección de movimiento de todas las cámaras fuera de los hilos de captura.
+
+    Cada cámara tiene una única ranura con el frame pendiente más reciente: si llega
+    uno nuevo antes de que se analice el anterior, el viejo se descarta. Una cámara
+    nunca se analiza en dos hilos a la vez, por lo que su motor no necesita locks.
+    """
+
+    def __init__(self, hilos=HILOS_DETECCION):
+        self._cola = queue.Queue()
+        self._pendientes = {}  # cámara -> (frame, instante de captura)
+        self._en_cola = set()
+        self._lock = Lock()
+        for _ in range(max(1, hilos)):
+            Thread(target=self._trabajar, daemon=True).start()
+        print(f"[Detección] Pool de detección iniciado con {max(1, hilos)} hilos")
+
+    def enviar(self, camara, frame):
+        """Deja el frame como pendiente de análisis sin bloquear a quien lo envía."""
+        with self._lock:
+            if camara in self._pendientes:
+                camara.analisis_descartados += 1
+            self._pendientes[camara] = (frame, time.time())
+            if camara in self._en_cola:
+                return
+            self._en_cola.add(camara)
+        self._cola.put(camara)
+
+    def retirar(self, camara):
+        """Descarta el frame pendiente de una cámara que se detuvo."""
+        with self._lock:
+            self._pendientes.pop(camara, None)
+
+    def _trabajar(self):
+        while True:
+            camara = self._cola.get()
+            with self._lock:
+                pendiente = self._pendientes.pop(camara, None)
+            if pendiente is not None:
+                try:
+                    camara.procesar_analisis(*pendiente)
+                except Exception as e:
+                    print(f"[Error] Error en el pool de detección para {camara.nombre}: {e}")
+            with self._lock:
+                # Si llegó otro frame mientras se analizaba, volver a encolar la cámara
+                if camara in self._pendientes:
+                    self._cola.put(camara)
+                else:
+                    self._en_cola.discard(camara)
+
+def obtener_pool_deteccion(hilos=HILOS_DETECCION):
+    """Devuelve el pool de detección compartido, creándolo si aún no existe."""
+    global POOL_DETECCION
+    with POOL_DETECCION_LOCK:
+        if POOL_DETECCION is None:
+            POOL_DETECCION = PoolDeteccion(hilos)
+    return POOL_DETECCION
+
+# Escritor en segundo plano de la grabación continua
+class EscritorSegmentos:
+    """Hilo propio de cada cámara que codifica y rota los segmentos continuos.
+
+    La captura solo encola frames y órdenes de cambio de segmento; la escritura,
+    el cierre del segmento y su finalización (audio y FTP) ocurren fuera del hilo
+    de captura. Cuando la cola alcanza `max_frames` se aplica la política de
+    desborde: 'descartar_antiguo' elimina el frame pendiente más viejo y
+    'descartar_nuevo' descarta el entrante. Las órdenes nunca se descartan.
+    """
+
+    def __init__(self, camara, max_frames=COLA_ESCRITOR, politica=POLITICA_DESBORDE):
+        self.camara = camara
+        self.max_frames = max(1, max_frames)
+        self.politica = politica
+        self.descartados = 0  # Frames perdidos por desborde
+        self.escritos = 0
+        self._items = deque()  # (tipo, dato, instante de encolado)
+        self._frames_pendientes = 0
+        self._condicion = Condition()
+        Thread(target=self.ejecutar, daemon=True).start()
+
+    @property
+    def pendientes(self):
+        """Frames encolados que aún no se escribieron."""
+        return self._frames_pendientes
+
+    @property
+    def retraso(self):
+        """Segundos que lleva esperando el frame pendiente más antiguo."""
+        with self._condicion:
+            for tipo, _, instante in self._items:
+                if tipo == 'frame':
+                    return time.time() - instante
+        return 0.0
+
+    def encolar_frame(self, frame):
+        with self._condicion:
+            if self._frames_pendientes >= self.max_frames:
+                self.descartados += 1
+                if self.politica == 'descartar_nuevo':
+                    return
+                for i, item in enumerate(self._items):
+                    if item[0] == 'frame':
+                        del self._items[i]
+                        self._frames_pendientes -= 1
+                        break
+            self._items.append(('frame', frame, time.time()))
+            self._frames_pendientes += 1
+            self._condicion.notify()
+
+    def nuevo_segmento(self, frame_inicial):
+        """Pide abrir un segmento nuevo con la resolución del frame indicado."""
+        self._encolar_orden('segmento', frame_inicial)
+
+    def cerrar(self):
+        """Pide finalizar el segmento actual y terminar el hilo."""
+        self._encolar_orden('cerrar', None)
+
+    def _encolar_orden(self, tipo, dato):
+        with self._condicion:
+            self._items.append((tipo, dato, time.time()))
+            self._condicion.notify()
+
+    def ejecutar(self):
+        while True:
+            with self._condicion:
+                while not self._items:
+                    self._condicion.wait()
+                tipo, dato, _ = self._items.popleft()
+                if tipo == 'frame':
+                    self._frames_pendientes -= 1
+            if tipo == 'frame':
+                self.camara.escribir_frame_continuo(dato)
+                self.escritos += 1
+            elif tipo == 'segmento':
+                self.camara.iniciar_grabacion_continua(dato)
+            else:
+                self.camara.cerrar_grabacion_continua()
+                return
+
+# Grabación continua por copia directa del stream
+class GrabadorStreamCopy:
+    """Graba el stream de la cámara en segmentos con ffmpeg, sin decodificar ni recodificar el video.
+
+    ffmpeg copia el video tal como llega (`-c:v copy`) y graba el audio en el mismo
+    proceso. El muxer de segmentos solo puede cortar en keyframes, por lo que cada
+    archivo empieza con una imagen completa. Cada segmento terminado se informa por
+    la salida estándar y se entrega a `al_completar`. Si ffmpeg termina
+    inesperadamente, se relanza con espera creciente.
+    """
+
+    def __init__(self, url, nombre, carpeta, segundos_segmento, al_completar, prefijo='continuo_'):
+        self.url = url
+        self.nombre = nombre
+        self.carpeta = carpeta
+        self.segundos_segmento = segundos_segmento
+        self.al_completar = al_completar
+        self.prefijo = prefijo
+        self.activo = False
+        self.proceso = None
+
+    def comando(self):
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error'] + entrada_ffmpeg(self.url)
+        cmd += [
+            '-map', '0:v:0', '-map', '0:a?',
+            '-c:v', 'copy', '-c:a', 'aac', '-b:a', '128k',
+            '-f', 'segment', '-segment_time', str(self.segundos_segmento),
+            '-segment_format', 'matroska', '-reset_timestamps', '1', '-strftime', '1',
+            '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+            os.path.join(self.carpeta, f'{self.prefijo}%Y%m%d_%H%M%S.mkv')
+        ]
+        return cmd
+
+    def iniciar(self):
+        os.makedirs(self.carpeta, exist_ok=True)
+        self.activo = True
+        Thread(target=self.ejecutar, daemon=True).start()
+
+    def ejecutar(self):
+        espera = 1
+        while self.activo:
+            inicio = time.time()
+            try:
+                self.proceso = subprocess.Popen(self.comando(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                stderr=subprocess.DEVNULL, text=True)
+                print(f"[Grabación] Iniciando grabación por copia directa en {self.nombre}")
+                # Cada línea es un segmento ya cerrado
+                for linea in self.proceso.stdout:
+                    linea = linea.strip()
+                    if linea:
+                        self.al_completar(os.path.join(self.carpeta, os.path.basename(linea)))
+                self.proceso.wait()
+            except Exception as e:
+                print(f"[Error] Error en la grabación por copia directa de {self.nombre}: {e}")
+            if not self.activo:
+                break
+            # Relanzar con espera creciente si ffmpeg falla repetidamente
+            espera = 1 if time.time() - inicio > 60 else min(espera * 2, 60)
+            print(f"[Grabación] ffmpeg terminó en {self.nombre}, reintentando en {espera}s")
+            time.sleep(espera)
+
+    def detener(self):
+        """Pide a ffmpeg que cierre el segmento actual y termine."""
+        self.activo = False
+        proceso = self.proceso
+        if not proceso or proceso.poll() is not None:
+            return
+        try:
+            proceso.stdin.write('q')
+            proceso.stdin.flush()
+            proceso.wait(timeout=10)
+        except Exception:
+            try:
+                proceso.kill()
+            except:
+                pass
+
+# Clips por movimiento a partir de segmentos cortos del stream principal
+class AnilloSegmentos:
+    """Clips por movimiento de cámaras con substream sin abrir una sesión RTSP por evento.
+
+    Un GrabadorStreamCopy mantiene una única sesión con el stream principal y lo
+    corta en segmentos de pocos segundos (copia directa, con audio) en una carpeta
+    oculta de la cámara. Cada clip se arma concatenando sin recodificar los
+    segmentos que cubren desde `preroll` segundos antes del disparo hasta el final
+    del evento, así incluye la pre-grabación. Los segmentos que ya no pueden formar
+    parte de ningún clip se eliminan.
+    """
+
+    def __init__(self, url, nombre, carpeta, preroll, segundos_segmento=SEGUNDOS_SEGMENTO_ANILLO):
+        self.nombre = nombre
+        self.preroll = preroll
+        self.segundos_segmento = segundos_segmento
+        self.carpeta = os.path.join(carpeta, '.anillo')
+        self._segmentos = deque()  # (inicio, fin, archivo) ya cerrados, del más antiguo al más nuevo
+        self._reservas = []  # inicio de los clips en preparación: sus segmentos no se eliminan
+        self._detenido = False
+        self._condicion = Condition()
+        self.grabador = GrabadorStreamCopy(url, nombre, self.carpeta, segundos_segmento,
+                                           self._segmento_cerrado, prefijo='anillo_')
+
+    def iniciar(self):
+        # Los segmentos de una ejecución anterior no son continuos con los nuevos
+        shutil.rmtree(self.carpeta, ignore_errors=True)
+        self._detenido = False
+        self.grabador.iniciar()
+
+    def detener(self):
+        """Cierra el segmento en curso; los clips en preparación terminan con lo que haya."""
+        self.grabador.detener()
+        with self._condicion:
+            self._detenido = True
+            self._condicion.notify_all()
+
+    def _segmento_cerrado(self, archivo):
+        fin = time.time()
+        nombre = os.path.splitext(os.path.basename(archivo))[0]
+        try:
+            inicio = datetime.datetime.strptime(nombre[len('anillo_'):], "%Y%m%d_%H%M%S").timestamp()
+        except ValueError:
+            inicio = fin - self.segundos_segmento
+        with self._condicion:
+            self._segmentos.append((inicio, fin, archivo))
+            # Conservar la pre-grabación del próximo evento y lo que usan los clips en preparación
+            limite = min([fin - self.preroll - self.segundos_segmento] + self._reservas)
+            viejos = []
+            while self._segmentos and self._segmentos[0][1] < limite:
+                viejos.append(self._segmentos.popleft()[2])
+            self._condicion.notify_all()
+        for viejo in viejos:
+            try:
+                os.remove(viejo)
+            except OSError:
+                pass
+
+    def grabar_clip(self, disparo, duracion, archivo_salida):
+        """Arma en `archivo_salida` el clip de [disparo - preroll, disparo + duracion].
+
+        Los bordes se redondean a segmentos completos. Devuelve True si se generó.
+        """
+        desde, hasta = disparo - self.preroll, disparo + duracion
+        with self._condicion:
+            self._reservas.append(desde)
+        try:
+            with self._condicion:
+                # Esperar a que se cierre el segmento que contiene el final del evento; los
+                # segmentos se cortan en keyframes, así que pueden durar más de lo pedido
+                espera_maxima = hasta + max(30, 4 * self.segundos_segmento)
+                while not self._detenido and not (self._segmentos and self._segmentos[-1][1] >= hasta):
+                    restante = espera_maxima - time.time()
+                    if restante <= 0:
+                        break
+                    self._condicion.wait(min(restante, 1))
+                segmentos = [archivo for inicio, fin, archivo in self._segmentos if fin > desde and inicio < hasta]
+            if not segmentos:
+                print(f"[Grabación] No hay segmentos del stream principal para el clip de {self.nombre}")
+                return False
+
+            lista = os.path.join(self.carpeta, f"clip_{int(disparo * 1000)}.txt")
+            with open(lista, 'w') as f:
+                for archivo in segmentos:
+                    ruta = os.path.abspath(archivo).replace("'", "'\\''")
+                    f.write(f"file '{ruta}'\n")
+            cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0',
+                   '-i', lista, '-c', 'copy', archivo_salida]
+            try:
+                resultado = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+            finally:
+                try:
+                    os.remove(lista)
+                except OSError:
+                    pass
+            return resultado.returncode == 0
+        finally:
+            with self._condicion:
+                self._reservas.remove(desde)
+
+# Utilidades de streams
+def entrada_ffmpeg(url):
+    """Argumentos de entrada de ffmpeg/ffprobe para la URL (RTSP sobre TCP)."""
+    if url.startswith('rtsp://'):
+        return ['-rtsp_transport', 'tcp', '-i', url]
+    return ['-i', url]
+
+def mapear_region(region, forma_origen, forma_destino):
+    """Convierte un rectángulo (x, y, w, h) entre dos resoluciones del mismo encuadre."""
+    escala_x = forma_destino[1] / forma_origen[1]
+    escala_y = forma_destino[0] / forma_origen[0]
+    x, y, w, h = region
+    return (int(x * escala_x), int(y * escala_y), int(w * escala_x), int(h * escala_y))
+
+# Sondeo de streams con ffprobe
+def sondear_stream(url, timeout=TIMEOUT_SONDEO):
+    """Obtiene con ffprobe si el stream tiene audio, sus códecs, resolución y fps."""
+    cmd = ['ffprobe', '-v', 'error', '-analyzeduration', '1000000', '-probesize', '500000']
+    cmd += ['-show_streams', '-of', 'json'] + entrada_ffmpeg(url)
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip()[:200] or f"ffprobe terminó con código {result.returncode}")
+
+    streams = json.loads(result.stdout).get('streams', [])
+    video = next((st for st in streams if st.get('codec_type') == 'video'), {})
+    audio = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+    fps = None
+    for clave in ('avg_frame_rate', 'r_frame_rate'):
+        try:
+            num, den = video.get(clave, '0/0').split('/')
+            if int(num) and int(den):
+                fps = round(int(num) / int(den), 2)
+                break
+        except ValueError:
+            continue
+    return {
+        'audio': audio is not None,
+        'codec_video': video.get('codec_name'),
+        'codec_audio': audio.get('codec_name') if audio else None,
+        'ancho': video.get('width'),
+        'alto': video.get('height'),
+        'fps': fps,
+        'sondeado': time.time()
+    }
+
+def clave_sondeo(url):
+    """URL sin usuario ni contraseña, para no guardar credenciales en la caché de sondeo."""
+    partes = urllib.parse.urlsplit(url)
+    if partes.username is None and partes.password is None:
+        return url
+    host = partes.netloc.rpartition('@')[2]
+    return urllib.parse.urlunsplit(partes._replace(netloc=host))
+
+class CacheSondeo:
+    """Resultados de sondeo por URL, persistidos en disco para que los reinicios no repitan el sondeo.
+
+    Los sondeos se ejecutan en paralelo en segundo plano. Una entrada vence tras
+    `ttl` segundos o cuando la captura observa una resolución distinta a la
+    sondeada (ver `invalidar`). Las entradas se guardan con la URL sin credenciales.
+    """
+
+    def __init__(self, archivo=ARCHIVO_CACHE_SONDEO, ttl=TTL_SONDEO):
+        self.archivo = archivo
+        self.ttl = ttl
+        self._lock = Lock()
+        self._en_curso = set()
+        self._sin_ffprobe = False
+        self._executor = ThreadPoolExecutor(max_workers=8)
+        try:
+            with open(archivo, 'r') as f:
+                self._datos = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._datos = {}
+        # Versiones anteriores usaban la URL completa: reescribir sin credenciales
+        datos = {clave_sondeo(url): info for url, info in self._datos.items()}
+        if list(datos) != list(self._datos):
+            self._datos = datos
+            self.guardar()
+
+    def obtener(self, url):
+        """Devuelve el último sondeo válido del stream o None si aún no se conoce."""
+        if self._sin_ffprobe:
+            return {'audio': False}
+        with self._lock:
+            info = self._datos.get(clave_sondeo(url))
+        if info and time.time() - info.get('sondeado', 0) < self.ttl:
+            return info
+        return None
+
+    def sondear_async(self, url):
+        """Lanza el sondeo del stream en segundo plano si no hay un resultado válido."""
+        if self.obtener(url) is not None:
+            return
+        with self._lock:
+            if clave_sondeo(url) in self._en_curso:
+                return
+            self._en_curso.add(clave_sondeo(url))
+        self._executor.submit(self._sondear, url)
+
+    def invalidar(self, url):
+        with self._lock:
+            self._datos.pop(clave_sondeo(url), None)
+        self.guardar()
+
+    def _sondear(self, url):
+        try:
+            info = sondear_stream(url)
+            with self._lock:
+                self._datos[clave_sondeo(url)] = info
+            self.guardar()
+            print(f"[Sondeo] {info['ancho']}x{info['alto']} {info['codec_video']} @ {info['fps']} fps, "
+                  f"audio: {info['codec_audio'] or 'no'}")
+        except FileNotFoundError:
+            print("[Sondeo] ffprobe no está instalado. Se grabará sin audio")
+            self._sin_ffprobe = True
+        except Exception as e:
+            print(f"[Sondeo] Error al sondear stream: {e}")
+        finally:
+            with self._lock:
+                self._en_curso.discard(clave_sondeo(url))
+
+    def guardar(self):
+        with self._lock:
+            datos = dict(self._datos)
+        try:
+            temporal = f"{self.archivo}.tmp"
+            with open(temporal, 'w') as f:
+                json.dump(datos, f, indent=4)
+            os.replace(temporal, self.archivo)
+        except Exception as e:
+            print(f"[Sondeo] No se pudo guardar la caché de sondeo: {e}")
+
+def obtener_cache_sondeo():
+    """Devuelve la caché de sondeo compartida, creándola si aún no existe."""
+    global CACHE_SONDEO
+    with CACHE_SONDEO_LOCK:
+        if CACHE_SONDEO is None:
+            CACHE_SONDEO = CacheSondeo()
+    return CACHE_SONDEO
+
+# Supervisión de la conexión de cada cámara
+class SupervisorConexion:
+    """Máquina de estados de la conexión de un stream.
+
+    conectando -> en_vivo -> estancado -> esperando -> conectando ...
+    Se reconecta solo cuando el stream deja de entregar frames o su marca de
+    tiempo queda congelada. Los reintentos esperan con backoff exponencial con
+    jitter y un semáforo global limita las reconexiones simultáneas.
+    """
+
+    def __init__(self, nombre, config=None):
+        config = config or {}
+        self.nombre = nombre
+        self.sin_frames = config.get('segundos_sin_frames', SEGUNDOS_SIN_FRAMES)
+        self.pts_congelado = config.get('segundos_pts_congelado', SEGUNDOS_PTS_CONGELADO)
+        self.backoff_base = config.get('backoff_base', BACKOFF_BASE)
+        self.backoff_maximo = config.get('backoff_maximo', BACKOFF_MAXIMO)
+        self.semaforo = obtener_semaforo_reconexion(config.get('reconexiones_simultaneas', RECONEXIONES_SIMULTANEAS))
+        self.estado = 'conectando'
+        self.historial = deque(maxlen=20)  # (instante, estado, motivo)
+        self.intentos = 0  # reintentos fallidos consecutivos
+        self.reconexiones = 0
+        self.proximo_intento = 0
+        self._ultimo_frame = time.time()
+        self._ultimo_pts = None
+        self._cambio_pts = time.time()
+        self._pts_avanza = False
+        self._conectada_antes = False
+        self.historial.append((time.time(), self.estado, ''))
+
+    def cambiar(self, estado, motivo=''):
+        if estado == self.estado:
+            return
+        self.estado = estado
+        self.historial.append((time.time(), estado, motivo))
+        print(f"[Conexión] {self.nombre}: {estado}" + (f" ({motivo})" if motivo else ""))
+
+    def abrir(self, abrir_captura, url, activo):
+        """Abre el stream; las reconexiones respetan el límite global de aperturas simultáneas."""
+        self.cambiar('conectando')
+        if self._conectada_antes or self.intentos:
+            with self.semaforo:
+                if not activo():
+                    return None
+                cap = abrir_captura(url)
+        else:
+            # La primera apertura no espera turno: todas las cámaras arrancan en paralelo
+            cap = abrir_captura(url)
+        if not cap.isOpened():
+            cap.release()
+            self.cambiar('estancado', 'no se pudo abrir el stream')
+            return None
+        ahora = time.time()
+        self._ultimo_frame = ahora
+        self._ultimo_pts = None
+        self._cambio_pts = ahora
+        self._pts_avanza = False
+        return cap
+
+    def registrar_frame(self, pts):
+        """Registra un frame leído con su marca de tiempo (CAP_PROP_POS_MSEC)."""
+        ahora = time.time()
+        self._ultimo_frame = ahora
+        if pts and pts > 0 and pts != self._ultimo_pts:
+            self._pts_avanza = self._ultimo_pts is not None
+            self._ultimo_pts = pts
+            self._cambio_pts = ahora
+        if self.estado != 'en_vivo':
+            if self._conectada_antes:
+                self.reconexiones += 1
+            self._conectada_antes = True
+            self.intentos = 0
+            self.cambiar('en_vivo')
+
+    def diagnostico(self):
+        """Motivo por el que el stream se considera estancado, o None si está sano."""
+        ahora = time.time()
+        if ahora - self._ultimo_frame > self.sin_frames:
+            return f"sin frames hace {ahora - self._ultimo_frame:.0f}s"
+        # Solo se vigila la marca de tiempo si el backend la informa y alguna vez avanzó
+        if self._pts_avanza and ahora - self._cambio_pts > self.pts_congelado:
+            return f"marca de tiempo congelada hace {ahora - self._cambio_pts:.0f}s"
+        return None
+
+    def esperar_reintento(self, activo):
+        """Espera el backoff exponencial con jitter antes del próximo intento."""
+        espera = min(self.backoff_maximo, self.backoff_base * 2 ** self.intentos)
+        espera = random.uniform(espera / 2, espera)  # jitter para no reconectar todas a la vez
+        self.intentos += 1
+        self.proximo_intento = time.time() + espera
+        self.cambiar('esperando', f"intento {self.intentos}, reintento en {espera:.1f}s")
+        while activo() and time.time() < self.proximo_intento:
+            time.sleep(0.2)
+
+    def descripcion_historial(self):
+        return [f"{datetime.datetime.fromtimestamp(instante).strftime('%H:%M:%S')} {estado}"
+                + (f" ({motivo})" if motivo else "")
+                for instante, estado, motivo in self.historial]
+
+def obtener_semaforo_reconexion(limite=RECONEXIONES_SIMULTANEAS):
+    """Devuelve el semáforo global de reconexiones, creándolo si aún no existe."""
+    global SEMAFORO_RECONEXION
+    with SEMAFORO_RECONEXION_LOCK:
+        if SEMAFORO_RECONEXION is None:
+            SEMAFORO_RECONEXION = BoundedSemaphore(max(1, limite))
+    return SEMAFORO_RECONEXION
+
 # Clase para manejar cada cámara
 class Camara:
-    def __init__(self, url, nombre, frame_padre, root, config=None):
-        self.url = url
+    def __init__(self, url, nombre, frame_padre, root, config=None, url_substream=None):
+        self.url = url  # Stream principal: se usa para grabar
+        self.url_substream = url_substream or None  # Stream secundario de baja resolución (opcional)
+        self.url_captura = self.url_substream or url  # Stream decodificado para vista previa y análisis
         self.nombre = nombre
-        self.cap = cv2.VideoCapture(url)
+        self.cap = None  # Se abre en el hilo de captura para no bloquear la interfaz
+        self.supervisor = SupervisorConexion(nombre, config)
         self.grabando = False
-        self.background = None
         self.ultimo_movimiento = 0
         self.cooldown = 5  # segundos entre grabaciones
-        self.frame_padre = frame_padre  # Frame donde se mostrará el video
-        self.canvas = tk.Canvas(self.frame_padre, width=400, height=300, bg="black")
-        self.canvas.pack()
-        self.queue = queue.Queue(maxsize=10)  # Cola para frames
+        self.frame_padre = frame_padre  # Frame donde se mostrará el video (None en la vista mosaico)
+        self.bus = BusFrames()  # Distribución de frames a vista previa y grabación
+        self.canvas = None
+        self.texto_conexion = None
+        self.salida_vista = None
+        if self.frame_padre is not None:
+            self.canvas = tk.Canvas(self.frame_padre, width=400, height=300, bg="black")
+            self.canvas.pack()
+            self.texto_conexion = self.canvas.create_text(200, 150, text="Conectando...", fill="white",
+                                                          font=(STYLE_CONFIG['font_family'], STYLE_CONFIG['font_size_normal']))
+            # Vista previa preparada en el hilo de captura, a la tasa de refresco de la grilla
+            self.salida_vista = SalidaVista(400, 300, (config or {}).get('fps_visualizacion', FPS_VISUALIZACION))
+            self.bus.agregar_consumidor(self.salida_vista.ofrecer)
         self.running = True
         self.root = root  # Referencia al root de Tkinter
         self.photo = None
         self.image_item = None
+        self.texto_estado = None  # Texto superpuesto con el estado de la cámara
 
         # Configuración de grabación
         self.config = config or {
@@ -76,146 +1162,331 @@ class Camara:
         # Variables para grabación continua
         self.ultimo_segmento = 0
         self.segmento_actual = None
+        self.ultimo_video_segmento = None
+        self.escritor = None
+        self.grabador_copia = None
+        self.anillo = None
+        if self.config['modo_grabacion'] == 'motion' and self.url_substream:
+            # Clips del stream principal desde una única sesión persistente, con pre-grabación
+            directorio_base = self.config.get('directorio_videos', './videos')
+            self.anillo = AnilloSegmentos(self.url, self.nombre, f"{directorio_base}/{self.nombre}",
+                                          self.config.get('preroll_segundos', 3))
+        if self.config['modo_grabacion'] == 'continuous' and (self.config.get('backend_grabacion', 'opencv') == 'copia'
+                                                               or self.url_substream):
+            # Copia directa del stream con ffmpeg: sin decodificar ni recodificar. Con substream es
+            # obligatoria, porque los frames decodificados son los de baja resolución
+            directorio_base = self.config.get('directorio_videos', './videos')
+            self.grabador_copia = GrabadorStreamCopy(
+                self.url, self.nombre, f"{directorio_base}/{self.nombre}",
+                self.config['segmento_continuo'] * 60, self.segmento_completado
+            )
+        elif self.config['modo_grabacion'] == 'continuous':
+            self.escritor = EscritorSegmentos(
+                self,
+                self.config.get('cola_escritor', COLA_ESCRITOR),
+                self.config.get('politica_desborde', POLITICA_DESBORDE)
+            )
+
+        # Motor de detección de movimiento con buffers propios
+        self.motor = MotorMovimiento(self.config.get('ancho_analisis', ANCHO_ANALISIS))
+
+        # Cadencia de análisis adaptativa según la actividad de la escena
+        self.planificador = PlanificadorAnalisis(
+            self.config.get('analisis_cada_n_reposo', ANALISIS_CADA_N_REPOSO),
+            self.config.get('analisis_cada_n_activo', ANALISIS_CADA_N_ACTIVO),
+            self.config.get('segundos_quietud', SEGUNDOS_QUIETUD)
+        )
+
+        # Detección asíncrona en el pool compartido
+        self.pool_deteccion = obtener_pool_deteccion(self.config.get('hilos_deteccion', HILOS_DETECCION))
+        self.analisis_descartados = 0  # Frames reemplazados antes de ser analizados
+        self.latencia_deteccion = 0.0  # Segundos entre la captura y el resultado del último análisis
+
+        # Buffer de pre-grabación para incluir los segundos previos al movimiento
+        # Con substream los clips se copian del stream principal y no usan este buffer
+        self.buffer_pre_evento = BufferPreEvento(
+            0 if self.url_substream else self.config.get('preroll_segundos', 3),
+            self.config.get('preroll_max_mb', 128) * 1024 * 1024,
+            fps_stream=lambda: (obtener_cache_sondeo().obtener(self.url) or {}).get('fps')
+        )
 
         # Variables para audio
         self.audio_process = None
         self.audio_temp_file = None
         self.has_audio = None  # Cache para saber si la cámara tiene audio
 
+        # Stream principal decodificado bajo demanda para la vista completa (solo con substream)
+        self.bus_principal = BusFrames()
+        self.suscriptores_principal = 0
+        self.hilo_principal_activo = False
+        self.lock_principal = Lock()
+        self.forma_stream = None  # Resolución observada, para detectar cambios del stream
+
+        # Contadores para el servidor de métricas (cada uno se actualiza desde un único hilo, sin locks)
+        self.frames_capturados = 0
+        self.segundos_lectura = 0.0  # Tiempo dentro de cap.read(): espera de red más decodificación
+        self.fps_captura = 0.0  # Promedio móvil exponencial
+        self._ultima_lectura = None
+        self.eventos_movimiento = 0
+        self.archivos_grabados = 0
+        self.bytes_grabados = 0
+        self.ftp_bytes_subidos = 0
+        self.ftp_bytes_reanudados = 0  # Bytes que no se reenviaron gracias a reanudar la subida
+        self.ftp_segundos_subida = 0.0
+        self.ftp_reintentos = 0
+        self.ftp_fallidos = 0
+        self.region_principal = None  # Movimiento que disparó el último clip, en coordenadas del stream principal
+
+        # Sondear los streams en segundo plano (o tomarlos de la caché en disco)
+        obtener_cache_sondeo().sondear_async(self.url)
+        if self.url_substream:
+            obtener_cache_sondeo().sondear_async(self.url_substream)
+
     def iniciar(self):
         Thread(target=self.capturar_video, daemon=True).start()
-        self.root.after(100, self.mostrar_video)  # Iniciar mostrar_video en el hilo principal
+        if self.grabador_copia:
+            self.grabador_copia.iniciar()
+        if self.anillo:
+            self.anillo.iniciar()
+        # La vista previa la refresca el RenderizadorGrilla de la aplicación
+
+    @property
+    def estado(self):
+        return self.supervisor.estado
+
+    def abrir_captura(self, url):
+        """Abre un VideoCapture con timeouts de apertura y lectura para detectar streams caídos."""
+        if hasattr(cv2, 'CAP_PROP_OPEN_TIMEOUT_MSEC'):
+            parametros = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, self.config.get('timeout_apertura_ms', TIMEOUT_APERTURA_MS),
+                          cv2.CAP_PROP_READ_TIMEOUT_MSEC, self.config.get('timeout_lectura_ms', TIMEOUT_LECTURA_MS)]
+            return cv2.VideoCapture(url, cv2.CAP_FFMPEG, parametros)
+        return cv2.VideoCapture(url)
 
     def capturar_video(self):
-        frame_count = 0
-        ultimo_refresh = time.time()
+        # Abrir el stream aquí: con varias cámaras las conexiones se hacen en paralelo
+        activo = lambda: self.running
         while self.running:
-            try:
-                ret, frame = self.cap.read()
-                if not ret:
-                    print(f"[Error] No se puede acceder al stream de {self.nombre}, intentando reconectar...")
-                    self.cap.release()
-                    time.sleep(1)  # Esperar antes de reconectar
-                    self.cap = cv2.VideoCapture(self.url)
-                    continue
-
-                tiempo_actual = time.time()
-
-                # Refresh periódico del stream para evitar congelamiento (cada 30 minutos)
-                if tiempo_actual - ultimo_refresh > 1800:  # 30 minutos
-                    print(f"[Stream] Refrescando stream de {self.nombre}")
-                    self.cap.release()
-                    time.sleep(0.5)
-                    self.cap = cv2.VideoCapture(self.url)
-                    ultimo_refresh = tiempo_actual
-                    continue  # Saltar al siguiente ciclo después del refresh
-
-                # Manejar grabación según el modo configurado
-                if self.config['modo_grabacion'] == 'motion':
-                    # Detectar movimiento y grabar
-                    movimiento_detectado = self.detectar_movimiento(frame)
-                    if movimiento_detectado and not self.grabando and (tiempo_actual - self.ultimo_movimiento) > self.cooldown:
-                        self.ultimo_movimiento = tiempo_actual
-                        self.iniciar_grabacion(frame)
-                elif self.config['modo_grabacion'] == 'continuous':
-                    # Verificar si es tiempo de crear un nuevo segmento
-                    if tiempo_actual - self.ultimo_segmento >= self.config['segmento_continuo'] * 60:
-                        if self.segmento_actual:
-                            self.segmento_actual.release()
-                        self.ultimo_segmento = tiempo_actual
-                        self.iniciar_grabacion_continua(frame)
-                    # Grabar el frame actual en el segmento continuo
-                    self.grabar_frame_continuo(frame)
-                # Para 'none', no hacer nada
-
-                # Intentar poner el frame en la cola sin bloquear
-                try:
-                    self.queue.put_nowait(frame)
-                except queue.Full:
-                    # Si la cola está llena, descartar el frame más antiguo
-                    try:
-                        self.queue.get_nowait()
-                        self.queue.put_nowait(frame)
-                    except queue.Empty:
-                        pass
-
-                # Pequeña pausa para no sobrecargar
-                time.sleep(0.01)
-            except Exception as e:
-                print(f"[Error] Error en {self.nombre}: {e}, intentando reconectar...")
+            self.cap = self.supervisor.abrir(self.abrir_captura, self.url_captura, activo)
+            if self.cap is not None:
                 try:
+                    self.leer_stream()
+                except Exception as e:
+                    self.supervisor.cambiar('estancado', f"error: {e}")
+                finally:
+                    # Solo este hilo usa el VideoCapture, así que también es quien lo libera
                     self.cap.release()
-                except:
-                    pass
-                time.sleep(1)
-                self.cap = cv2.VideoCapture(self.url)
-                time.sleep(0.5)
+            if self.running:
+                self.supervisor.esperar_reintento(activo)
+        self.pool_deteccion.retirar(self)
+
+    def leer_stream(self):
+        """Lee frames hasta que el stream se estanca o la cámara se detiene."""
+        while self.running:
+            inicio_lectura = time.perf_counter()
+            ret, frame = self.cap.read()
+            if not ret:
+                # Una lectura fallida aislada no reinicia el stream; sí lo hace el estancamiento
+                motivo = self.supervisor.diagnostico()
+                if motivo:
+                    self.supervisor.cambiar('estancado', motivo)
+                    return
+                time.sleep(0.1)
                 continue
 
-    def mostrar_video(self):
-        if not self.running:
+            fin_lectura = time.perf_counter()
+            self.segundos_lectura += fin_lectura - inicio_lectura
+            self.frames_capturados += 1
+            if self._ultima_lectura is not None and fin_lectura > self._ultima_lectura:
+                self.fps_captura += 0.1 * (1 / (fin_lectura - self._ultima_lectura) - self.fps_captura)
+            self._ultima_lectura = fin_lectura
+
+            self.supervisor.registrar_frame(self.cap.get(cv2.CAP_PROP_POS_MSEC))
+            motivo = self.supervisor.diagnostico()
+            if motivo:
+                self.supervisor.cambiar('estancado', motivo)
+                return
+
+            tiempo_actual = time.time()
+            if frame.shape != self.forma_stream:
+                self.forma_stream = frame.shape
+                self.verificar_sondeo(frame)
+
+            # Manejar grabación según el modo configurado
+            if self.config['modo_grabacion'] == 'motion':
+                # Enviar a detección solo los frames que toca analizar; el resultado llega
+                # de forma asíncrona a procesar_analisis
+                if self.planificador.debe_analizar():
+                    self.pool_deteccion.enviar(self, frame)
+            elif self.config['modo_grabacion'] == 'continuous' and self.escritor:
+                # Verificar si es tiempo de crear un nuevo segmento (la rotación ocurre en el escritor)
+                if tiempo_actual - self.ultimo_segmento >= self.config['segmento_continuo'] * 60:
+                    self.ultimo_segmento = tiempo_actual
+                    self.escritor.nuevo_segmento(frame)
+                # Grabar el frame actual en el segmento continuo
+                self.grabar_frame_continuo(frame)
+            # Para 'none', no hacer nada
+
+            # Entregar el frame a la vista previa y a las grabaciones activas; en modo movimiento
+            # se guarda además para la pre-grabación del próximo evento
+            self.bus.publicar(frame, self.buffer_pre_evento.agregar
+                              if self.config['modo_grabacion'] == 'motion' else None)
+
+            # Pequeña pausa para no sobrecargar
+            time.sleep(0.01)
+
+    def abrir_stream_completo(self):
+        """Devuelve el bus con frames a resolución completa para la vista ampliada.
+
+        Sin substream es el mismo bus de la captura. Con substream se decodifica el
+        stream principal mientras haya suscriptores.
+        """
+        if not self.url_substream:
+            return self.bus
+        with self.lock_principal:
+            self.suscriptores_principal += 1
+            if not self.hilo_principal_activo:
+                self.hilo_principal_activo = True
+                Thread(target=self.capturar_principal, daemon=True).start()
+        return self.bus_principal
+
+    def cerrar_stream_completo(self):
+        if not self.url_substream:
             return
+        with self.lock_principal:
+            self.suscriptores_principal = max(0, self.suscriptores_principal - 1)
 
+    def capturar_principal(self):
+        """Decodifica el stream principal mientras alguna vista completa lo use."""
+        cap = self.abrir_captura(self.url)
+        print(f"[Stream] Abriendo stream principal de {self.nombre} para la vista completa")
         try:
-            frame = self.queue.get_nowait()
-        except queue.Empty:
-            # Si no hay frames disponibles, programar la próxima verificación
-            self.root.after(10, self.mostrar_video)
+            while self.running and self.suscriptores_principal > 0:
+                ret, frame = cap.read()
+                if not ret:
+                    cap.release()
+                    time.sleep(1)
+                    cap = self.abrir_captura(self.url)
+                    continue
+                self.bus_principal.publicar(frame)
+        except Exception as e:
+            print(f"[Error] Error en el stream principal de {self.nombre}: {e}")
+        finally:
+            cap.release()
+            with self.lock_principal:
+                # Si alguien se suscribió justo al salir del ciclo, relanzar el hilo
+                if self.running and self.suscriptores_principal > 0:
+                    Thread(target=self.capturar_principal, daemon=True).start()
+                else:
+                    self.hilo_principal_activo = False
+            print(f"[Stream] Stream principal de {self.nombre} cerrado")
+
+    def procesar_analisis(self, frame, instante_captura):
+        """Analiza un frame en un hilo del pool de detección y dispara la grabación si corresponde."""
+        if not self.running:
             return
+        movimiento_detectado = self.detectar_movimiento(frame)
+        self.planificador.registrar(movimiento_detectado)
+        tiempo_actual = time.time()
+        self.latencia_deteccion = tiempo_actual - instante_captura
+        if movimiento_detectado and not self.grabando and (tiempo_actual - self.ultimo_movimiento) > self.cooldown:
+            self.ultimo_movimiento = tiempo_actual
+            self.eventos_movimiento += 1
+            # El clip se graba del stream principal: guardar la región en sus coordenadas
+            self.region_principal = self.mapear_a_principal(self.motor.region, frame.shape)
+            self.iniciar_grabacion(frame)
+
+    def mapear_a_principal(self, region, forma_analizada):
+        """Lleva una región del stream analizado a coordenadas del stream principal."""
+        if region is None or not self.url_substream:
+            return region
+        info = obtener_cache_sondeo().obtener(self.url)
+        if not info or not info.get('ancho'):
+            return None  # Resolución del stream principal aún desconocida
+        return mapear_region(region, forma_analizada, (info['alto'], info['ancho']))
+
+    @property
+    def pausada(self):
+        """La vista no está visible: no se preparan frames para ella (lo actualiza el renderizador)."""
+        return self.salida_vista is None or self.salida_vista.pausada
+
+    @pausada.setter
+    def pausada(self, valor):
+        if self.salida_vista is not None:
+            self.salida_vista.pausada = valor
+
+    def esta_visible(self, contenedor):
+        return contenedor is not None and self.canvas is not None and widget_visible(self.canvas, contenedor)
 
-        # Redimensionar el frame al tamaño del canvas
-        frame_resized = cv2.resize(frame, (400, 300))  # Dimensiones del Canvas
-        frame_rgb = cv2.cvtColor(frame_resized, cv2.COLOR_BGR2RGB)
+    def mostrar_video(self):
+        """Dibuja el frame más reciente, si hay uno nuevo (llamado en cada tick del renderizador)."""
+        if not self.running or self.salida_vista is None:
+            return
+
+        # El frame ya viene reducido y en RGB desde el hilo de captura
+        frame_rgb = self.salida_vista.tomar()
+        if frame_rgb is None:
+            # Sin frames nuevos el estado de conexión igual debe reflejarse
+            if self.image_item is not None:
+                self.actualizar_texto_estado()
+            return
         frame_pil = Image.fromarray(frame_rgb)
-        self.photo = ImageTk.PhotoImage(image=frame_pil)
 
-        # Mostrar el frame en el canvas
+        # Mostrar el frame en el canvas, reutilizando el mismo PhotoImage
+        if self.texto_conexion is not None:
+            self.canvas.delete(self.texto_conexion)
+            self.texto_conexion = None
         if self.image_item is None:
+            self.photo = ImageTk.PhotoImage(image=frame_pil)
             self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
         else:
-            self.canvas.itemconfig(self.image_item, image=self.photo)
+            self.photo.paste(frame_pil)
+        self.actualizar_texto_estado()
+
+    def descripcion_estado(self):
+        """Texto corto con el estado de la cámara para superponer en la vista previa."""
+        if self.estado == 'conectando':
+            return "Conectando..."
+        if self.estado == 'esperando':
+            restante = max(0, self.supervisor.proximo_intento - time.time())
+            return f"Sin señal, reintento {self.supervisor.intentos} en {restante:.0f}s"
+        if self.estado == 'estancado':
+            return "Stream estancado, reconectando..."
+        if self.config['modo_grabacion'] == 'motion':
+            return f"Análisis {self.planificador.modo}: {self.planificador.tasa_efectiva:.1f}/s"
+        if self.grabador_copia:
+            return "Grabando por copia directa"
+        if self.escritor:
+            return f"Escritor: {self.escritor.pendientes} pendientes, {self.escritor.retraso:.1f}s de retraso"
+        return ""
+
+    def detener(self):
+        """Detiene la captura y cierra las grabaciones en curso."""
+        # El hilo de captura libera el VideoCapture al salir de su ciclo
+        self.running = False
+        if self.escritor:
+            # El escritor finaliza el segmento actual junto con su audio
+            self.escritor.cerrar()
+        elif self.grabador_copia:
+            # Esperar a que ffmpeg cierre el último segmento sin bloquear la interfaz
+            Thread(target=self.grabador_copia.detener).start()
+        else:
+            # Detener grabación de audio
+            self.detener_grabacion_audio()
+        if self.anillo:
+            Thread(target=self.anillo.detener).start()
 
-        # Programar la próxima actualización
-        self.root.after(10, self.mostrar_video)
+    def actualizar_texto_estado(self):
+        texto = self.descripcion_estado()
+        if self.texto_estado is None:
+            self.texto_estado = self.canvas.create_text(5, 5, anchor=tk.NW, text=texto, fill="white",
+                                                        font=(STYLE_CONFIG['font_family'], STYLE_CONFIG['font_size_small']))
+        elif self.canvas.itemcget(self.texto_estado, 'text') != texto:
+            self.canvas.itemconfig(self.texto_estado, text=texto)
 
     def detectar_movimiento(self, frame):
         try:
-            # Convertir a escala de grises
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (31, 31), 0)  # Mayor blur para reducir ruido
-
-            # Inicializar el fondo si es necesario
-            if self.background is None:
-                self.background = gray.astype(np.float32)
-                return False
-
-            # Calcular la diferencia absoluta entre el fondo y el frame actual
-            frame_delta = cv2.absdiff(self.background.astype(np.uint8), gray)
-            thresh = cv2.threshold(frame_delta, self.config['sensibilidad_movimiento'], 255, cv2.THRESH_BINARY)[1]  # Usar sensibilidad configurada
-
-            # Dilatar el umbral para llenar agujeros
-            thresh = cv2.dilate(thresh, None, iterations=3)  # Más iteraciones para reducir ruido
-
-            # Encontrar contornos
-            contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # Verificar si hay movimiento significativo (ignorar contornos muy pequeños)
-            movimiento_significativo = False
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                if area < 5000:  # Área mínima más alta para ignorar cambios pequeños como ruido
-                    continue
-                # Verificar si el contorno no está en la parte inferior (posible área de timestamp)
-                x, y, w, h = cv2.boundingRect(contour)
-                if y > gray.shape[0] * 0.8:  # Ignorar contornos en el 20% inferior (posible timestamp)
-                    continue
-                movimiento_significativo = True
-                break
-
-            # Actualizar el fondo gradualmente para adaptarse a cambios de iluminación
-            # Solo actualizar si no hay movimiento para evitar incluir objetos en movimiento en el fondo
-            if not movimiento_significativo:
-                cv2.accumulateWeighted(gray.astype(np.float32), self.background, 0.005)  # Actualización aún más lenta
+            movimiento_significativo = self.motor.analizar(frame, self.config['sensibilidad_movimiento'],
+                                                           self.planificador.paso)
 
             # Mostrar mensaje solo cuando se detecta movimiento
             if movimiento_significativo:
@@ -229,21 +1500,45 @@ class Camara:
     def iniciar_grabacion(self, frame_inicial):
         if not self.grabando:
             self.grabando = True
+            if self.url_substream:
+                # Los frames decodificados son del substream: el clip sale del stream principal
+                Thread(target=self.grabar_clip_principal).start()
+                return
             Thread(target=self.grabar_video, args=(frame_inicial,)).start()
             self.iniciar_grabacion_audio()
 
-    def iniciar_grabacion_continua(self, frame_inicial):
-        # Detener grabación de audio anterior si existe
-        if self.audio_process:
-            self.detener_grabacion_audio()
+    def grabar_clip_principal(self):
+        """Arma el clip por movimiento con los segmentos del stream principal, pre-grabación y audio incluidos."""
+        disparo = time.time()
+        region = self.region_principal
+        directorio_base = self.config.get('directorio_videos', './videos')
+        carpeta = f"{directorio_base}/{self.nombre}"
+        os.makedirs(carpeta, exist_ok=True)
+        # El nombre indica el inicio del clip, que incluye la pre-grabación
+        fecha = datetime.datetime.fromtimestamp(disparo - self.anillo.preroll).strftime("%Y%m%d_%H%M%S")
+        archivo_salida = f"{carpeta}/{fecha}.mkv"
 
-        if self.segmento_actual:
-            self.segmento_actual.release()
-            # Combinar audio con el segmento anterior si existe
-            if hasattr(self, 'ultimo_video_segmento') and self.ultimo_video_segmento:
-                self.combinar_audio_video(self.ultimo_video_segmento)
-                # Subir a FTP si está configurado
-                self.subir_a_ftp(self.ultimo_video_segmento)
+        print(f"[Grabación] Armando clip del stream principal en {self.nombre}")
+        try:
+            generado = self.anillo.grabar_clip(disparo, self.config['duracion_grabacion'], archivo_salida)
+        except Exception as e:
+            print(f"[Error] No se pudo armar el clip del stream principal en {self.nombre}: {e}")
+            generado = False
+
+        if generado and os.path.exists(archivo_salida) and os.path.getsize(archivo_salida) > 0:
+            self.archivo_completado(archivo_salida, region)
+            print(f"[Grabación] Finalizada en {self.nombre}: {archivo_salida}")
+        self.grabando = False
+
+    def iniciar_grabacion_continua(self, frame_inicial):
+        """Abre un nuevo segmento continuo (en el hilo del escritor) y finaliza el anterior en segundo plano."""
+        # Tomar el segmento y el audio anteriores antes de reemplazarlos
+        segmento_anterior = self.segmento_actual
+        archivo_anterior = self.ultimo_video_segmento
+        audio_anterior = self.audio_process
+        audio_archivo_anterior = self.audio_temp_file
+        self.audio_process = None
+        self.audio_temp_file = None
 
         # Usar directorio configurado
         directorio_base = self.config.get('directorio_videos', './videos')
@@ -253,12 +1548,37 @@ class Camara:
         archivo_salida = f"{carpeta}/continuo_{fecha}.avi"
 
         fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        self.segmento_actual = cv2.VideoWriter(archivo_salida, fourcc, 20.0, (frame_inicial.shape[1], frame_inicial.shape[0]))
+        self.segmento_actual = cv2.VideoWriter(archivo_salida, fourcc, float(FPS_GRABACION), (frame_inicial.shape[1], frame_inicial.shape[0]))
         self.ultimo_video_segmento = archivo_salida  # Guardar para combinar con audio después
         print(f"[Grabación] Iniciando segmento continuo en {self.nombre}: {archivo_salida}")
         self.iniciar_grabacion_audio_continua()
 
+        # La finalización (audio y FTP) puede tardar segundos: no debe frenar la escritura
+        if segmento_anterior:
+            Thread(target=self.finalizar_segmento,
+                   args=(segmento_anterior, archivo_anterior, audio_anterior, audio_archivo_anterior),
+                   daemon=True).start()
+
+    def finalizar_segmento(self, segmento, archivo, proceso_audio, archivo_audio):
+        """Cierra un segmento continuo, le agrega su audio y lo encola para FTP."""
+        segmento.release()
+        self.detener_grabacion_audio(proceso_audio)
+        self.combinar_audio_video(archivo, archivo_audio)
+        self.archivo_completado(archivo)
+
+    def cerrar_grabacion_continua(self):
+        """Finaliza el segmento en curso al detener la cámara."""
+        if self.segmento_actual:
+            segmento = self.segmento_actual
+            self.segmento_actual = None
+            proceso_audio = self.audio_process
+            archivo_audio = self.audio_temp_file
+            self.audio_process = None
+            self.audio_temp_file = None
+            self.finalizar_segmento(segmento, self.ultimo_video_segmento, proceso_audio, archivo_audio)
+
     def grabar_video(self, frame_inicial):
+        region = self.region_principal
         # Usar directorio configurado
         directorio_base = self.config.get('directorio_videos', './videos')
         carpeta = f"{directorio_base}/{self.nombre}"
@@ -266,81 +1586,116 @@ class Camara:
         fecha = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         archivo_salida = f"{carpeta}/{fecha}.avi"
 
-        # Usar un VideoCapture separado para grabación
-        cap_grabacion = cv2.VideoCapture(self.url)
-        if not cap_grabacion.isOpened():
-            print(f"[Error] No se pudo abrir el stream para grabación en {self.nombre}")
-            return
+        # Suscribirse al stream ya abierto en lugar de abrir otra sesión RTSP. La marca del
+        # buffer se toma en el mismo instante: cada frame está en la pre-grabación o en la cola
+        cola_grabacion, marca = self.bus.suscribir_con_instantanea(self.buffer_pre_evento.marca, maxsize=60)
 
         fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        out = cv2.VideoWriter(archivo_salida, fourcc, 20.0, (frame_inicial.shape[1], frame_inicial.shape[0]))
+        out = cv2.VideoWriter(archivo_salida, fourcc, float(FPS_GRABACION), (frame_inicial.shape[1], frame_inicial.shape[0]))
+
+        # Escribir primero los segundos previos al disparo
+        for frame in self.buffer_pre_evento.frames(marca):
+            if frame.shape == frame_inicial.shape:
+                out.write(frame)
 
         # Grabar por la duración configurada
         contador_frames = 0
-        max_frames = self.config['duracion_grabacion'] * 20  # 20 FPS
+        max_frames = self.config['duracion_grabacion'] * FPS_GRABACION
         while self.grabando and contador_frames < max_frames:
             try:
-                ret, frame = cap_grabacion.read()
-                if not ret:
-                    break
+                frame = cola_grabacion.get(timeout=5)
+            except queue.Empty:
+                print(f"[Error] Sin frames del stream para grabación en {self.nombre}")
+                break
+            try:
                 out.write(frame)
                 contador_frames += 1
-                time.sleep(0.01)  # Controlar la velocidad de grabación
             except cv2.error:
                 print(f"[Error] Error de OpenCV al grabar {self.nombre}")
                 break
 
+        self.bus.desuscribir(cola_grabacion)
         out.release()
-        cap_grabacion.release()
         self.detener_grabacion_audio()
         self.combinar_audio_video(archivo_salida)
-        # Subir a FTP si está configurado
-        self.subir_a_ftp(archivo_salida)
+        self.archivo_completado(archivo_salida, region)
         self.grabando = False
         print(f"[Grabación] Finalizada en {self.nombre}: {archivo_salida}")
 
+    def segmento_completado(self, archivo):
+        """Recibe cada segmento cerrado por la grabación por copia directa."""
+        print(f"[Grabación] Segmento continuo completado en {self.nombre}: {archivo}")
+        self.archivo_completado(archivo)
+
+    def archivo_completado(self, archivo, region=None):
+        """Registra un clip o segmento ya cerrado en el catálogo y lo sube a FTP si está configurado.
+
+        `region` es el rectángulo con movimiento que disparó el clip, en coordenadas del archivo.
+        """
+        try:
+            datos = os.stat(archivo)
+            self.bytes_grabados += datos.st_size
+            self.archivos_grabados += 1
+            self.registrar_en_catalogo(archivo, datos, region)
+        except OSError:
+            pass
+        self.subir_a_ftp(archivo)
+
+    def registrar_en_catalogo(self, archivo, datos, region=None):
+        nombre = analizar_nombre_grabacion(os.path.basename(archivo))
+        if nombre is None:
+            return
+        disparo, inicio = nombre
+        if archivo.endswith('.avi'):
+            # Grabación con OpenCV: XVID, con audio solo si la cámara lo tiene
+            codec, audio = 'xvid', bool(self.has_audio)
+        else:
+            # Copia directa del stream principal: mismo códec y audio que la cámara
+            info = obtener_cache_sondeo().obtener(self.url) or {}
+            codec, audio = info.get('codec_video'), info.get('audio')
+        try:
+            obtener_catalogo(self.config.get('catalogo_grabaciones', ARCHIVO_CATALOGO)).registrar(
+                archivo, self.nombre, inicio, datos.st_mtime, datos.st_size, codec, audio, disparo, region)
+        except sqlite3.Error as e:
+            print(f"[Catálogo] No se pudo registrar {os.path.basename(archivo)}: {e}")
+
     def grabar_frame_continuo(self, frame):
-        if self.segmento_actual and self.config['modo_grabacion'] == 'continuous':
+        if self.escritor and self.config['modo_grabacion'] == 'continuous':
+            self.escritor.encolar_frame(frame)
+
+    def escribir_frame_continuo(self, frame):
+        """Escribe un frame en el segmento actual (en el hilo del escritor)."""
+        if self.segmento_actual:
             try:
                 self.segmento_actual.write(frame)
             except Exception as e:
                 print(f"[Error] Error al escribir frame continuo en {self.nombre}: {e}")
 
     def detectar_audio(self):
-        """Detecta si la cámara tiene audio disponible."""
+        """Indica si la cámara tiene audio según el sondeo en segundo plano, sin bloquear."""
         if self.has_audio is not None:
             return self.has_audio
 
-        try:
-            # Verificar si ffmpeg está disponible
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print(f"[Audio] FFmpeg no está instalado. No se puede detectar audio en {self.nombre}")
-            self.has_audio = False
+        info = obtener_cache_sondeo().obtener(self.url)
+        if info is None:
+            # El sondeo aún no terminó: grabar este evento sin audio en lugar de esperar
+            obtener_cache_sondeo().sondear_async(self.url)
+            print(f"[Audio] Sondeo de {self.nombre} pendiente, grabando sin audio")
             return False
 
-        try:
-            # Intentar obtener información del stream con ffmpeg
-            cmd = ['ffmpeg', '-i', self.url, '-f', 'null', '-']
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-
-            # Si ffmpeg puede acceder al stream sin errores de audio, asumimos que tiene audio
-            if 'Audio:' in result.stderr or 'audio:' in result.stderr.lower():
-                self.has_audio = True
-                print(f"[Audio] Cámara {self.nombre} tiene audio disponible")
-                return True
-            else:
-                self.has_audio = False
-                print(f"[Audio] Cámara {self.nombre} no tiene audio")
-                return False
-        except subprocess.TimeoutExpired:
-            print(f"[Audio] Timeout al detectar audio en {self.nombre}")
-            self.has_audio = False
-            return False
-        except Exception as e:
-            print(f"[Audio] Error al detectar audio en {self.nombre}: {e}")
-            self.has_audio = False
-            return False
+        self.has_audio = info['audio']
+        print(f"[Audio] Cámara {self.nombre} {'tiene' if self.has_audio else 'no tiene'} audio")
+        return self.has_audio
+
+    def verificar_sondeo(self, frame):
+        """Vuelve a sondear el stream si su resolución ya no coincide con la sondeada."""
+        info = obtener_cache_sondeo().obtener(self.url_captura)
+        if info and info.get('ancho') and (info['ancho'], info['alto']) != (frame.shape[1], frame.shape[0]):
+            print(f"[Sondeo] El stream de {self.nombre} cambió, sondeando de nuevo")
+            obtener_cache_sondeo().invalidar(self.url_captura)
+            obtener_cache_sondeo().sondear_async(self.url_captura)
+            if not self.url_substream:
+                self.has_audio = None
 
     def iniciar_grabacion_audio(self):
         try:
@@ -395,41 +1750,49 @@ class Camara:
             print(f"[Error] No se pudo iniciar grabación continua de audio en {self.nombre}: {e}")
             self.audio_process = None
 
-    def detener_grabacion_audio(self):
-        if self.audio_process:
+    def detener_grabacion_audio(self, proceso=None):
+        """Detiene la grabación de audio actual o el proceso indicado."""
+        propio = proceso is None
+        if propio:
+            proceso = self.audio_process
+        if proceso:
             try:
-                self.audio_process.terminate()
-                self.audio_process.wait(timeout=5)
+                proceso.terminate()
+                proceso.wait(timeout=5)
                 print(f"[Audio] Grabación de audio detenida")
             except subprocess.TimeoutExpired:
                 print(f"[Audio] Timeout al detener grabación de audio, forzando cierre")
                 try:
-                    self.audio_process.kill()
-                    self.audio_process.wait(timeout=2)
+                    proceso.kill()
+                    proceso.wait(timeout=2)
                 except:
                     pass
             except Exception as e:
                 print(f"[Error] Error al detener grabación de audio: {e}")
                 try:
-                    self.audio_process.kill()
+                    proceso.kill()
                 except:
                     pass
-            self.audio_process = None
+            if propio:
+                self.audio_process = None
 
-    def combinar_audio_video(self, video_file):
-        if not self.audio_temp_file or not os.path.exists(self.audio_temp_file):
+    def combinar_audio_video(self, video_file, audio_file=None):
+        """Combina el audio grabado (el actual o el indicado) con el archivo de video."""
+        propio = audio_file is None
+        if propio:
+            audio_file = self.audio_temp_file
+        if not audio_file or not os.path.exists(audio_file):
             print(f"[Audio] No hay archivo de audio para combinar con {video_file}")
             return
 
         try:
             # Verificar si el archivo de audio tiene contenido
-            if os.path.getsize(self.audio_temp_file) == 0:
+            if os.path.getsize(audio_file) == 0:
                 print(f"[Audio] Archivo de audio vacío, guardando solo video: {video_file}")
                 try:
-                    os.remove(self.audio_temp_file)
+                    os.remove(audio_file)
                 except:
                     pass
-                self.audio_temp_file = None
                 return
 
             # Crear archivo de salida con audio
@@ -437,7 +1800,7 @@ class Camara:
 
             # Usar ffmpeg para combinar video y audio
             cmd = [
-                'ffmpeg', '-y', '-i', video_file, '-i', self.audio_temp_file,
+                'ffmpeg', '-y', '-i', video_file, '-i', audio_file,
                 '-c:v', 'copy', '-c:a', 'aac', '-b:a', '128k', video_con_audio
             ]
 
@@ -453,109 +1816,1451 @@ class Camara:
 
             # Limpiar archivo temporal de audio
             try:
-                os.remove(self.audio_temp_file)
+                os.remove(audio_file)
             except:
                 pass
 
         except Exception as e:
             print(f"[Error] Error al combinar audio y video: {e}")
         finally:
-            self.audio_temp_file = None
+            if propio:
+                self.audio_temp_file = None
 
     def subir_a_ftp(self, archivo_video):
-        """Sube un archivo de video a un servidor FTP si está configurado."""
+        """Encola un archivo de video para el servicio FTP si está configurado."""
         ftp_config = self.config.get('ftp_config', {})
         if not ftp_config.get('host') or not ftp_config.get('user') or not ftp_config.get('password'):
             return  # FTP no configurado
 
-        # Agregar a la cola de FTP con timestamp de creación
-        with FTP_QUEUE_LOCK:
-            FTP_QUEUE.append({
-                'archivo': archivo_video,
-                'timestamp': time.time(),
-                'intentos': 0,
-                'camara': self.nombre,
-                'ftp_config': ftp_config.copy()
-            })
-
-        # Iniciar el procesamiento de la cola si no está corriendo
-        Thread(target=self.procesar_cola_ftp, daemon=True).start()
+        obtener_servicio_ftp(self.config.get('ftp_trabajadores', FTP_TRABAJADORES), ftp_config,
+                             self.config.get('journal_ftp', ARCHIVO_JOURNAL_FTP)).encolar(
+            archivo_video, self.nombre, ftp_config, self)
         print(f"[FTP] Archivo {os.path.basename(archivo_video)} agregado a la cola de subida")
 
-    def procesar_cola_ftp(self):
-        """Procesa la cola de subida FTP con reintentos."""
-        while True:
+# Catálogo de grabaciones locales
+def analizar_nombre_grabacion(nombre):
+    """(disparo, inicio) de un clip o segmento según su nombre, o None si no es una grabación."""
+    base = os.path.splitext(nombre)[0]
+    disparo = 'movimiento'
+    if base.startswith('continuo_'):
+        base = base[len('continuo_'):]
+        disparo = 'continuo'
+    try:
+        return disparo, datetime.datetime.strptime(base, "%Y%m%d_%H%M%S").timestamp()
+    except ValueError:
+        return None
+
+class CatalogoGrabaciones:
+    """Índice en SQLite (modo WAL) de todas las grabaciones locales.
+
+    Cada clip o segmento se registra al cerrarse con su cámara, inicio, fin,
+    tamaño, códec, audio, disparo ('movimiento' o 'continuo') y, en los clips, la
+    región con movimiento en coordenadas del archivo. Si falta algo en el
+    índice, `sincronizar` lo reconstruye desde el disco revisando solo las carpetas
+    cuya fecha de modificación cambió. Las búsquedas por intervalo y la limpieza
+    son consultas sobre los índices, sin recorrer directorios.
+    """
+
+    def __init__(self, archivo=ARCHIVO_CATALOGO):
+        self.archivo = archivo
+        self._lock = Lock()
+        self._conexion = sqlite3.connect(archivo, check_same_thread=False)
+        self._conexion.execute('PRAGMA journal_mode=WAL')
+        self._conexion.execute('PRAGMA synchronous=NORMAL')
+        with self._conexion:
+            self._conexion.execute('''
+                CREATE TABLE IF NOT EXISTS grabaciones (
+                    id INTEGER PRIMARY KEY,
+                    ruta TEXT NOT NULL UNIQUE,
+                    camara TEXT NOT NULL,
+                    inicio REAL NOT NULL,
+                    fin REAL NOT NULL,
+                    tamano INTEGER NOT NULL,
+                    codec TEXT,
+                    audio INTEGER,
+                    disparo TEXT NOT NULL,
+                    region TEXT
+                )''')
+            # Catálogos creados antes de guardar la región del movimiento
+            columnas = {fila[1] for fila in self._conexion.execute('PRAGMA table_info(grabaciones)')}
+            if 'region' not in columnas:
+                self._conexion.execute('ALTER TABLE grabaciones ADD COLUMN region TEXT')
+            self._conexion.execute('CREATE INDEX IF NOT EXISTS idx_grabaciones_inicio ON grabaciones (inicio)')
+            self._conexion.execute('CREATE INDEX IF NOT EXISTS idx_grabaciones_camara ON grabaciones (camara, inicio)')
+            self._conexion.execute('CREATE INDEX IF NOT EXISTS idx_grabaciones_disparo ON grabaciones (disparo, inicio)')
+            # Fecha de modificación de cada carpeta de cámara al sincronizarla por última vez
+            self._conexion.execute(
+                'CREATE TABLE IF NOT EXISTS carpetas (ruta TEXT PRIMARY KEY, modificada REAL NOT NULL)')
+            # Bytes y archivos por cámara, mantenidos por triggers para no sumar toda la tabla
+            nueva = self._conexion.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'totales'").fetchone() is None
+            self._conexion.execute('''
+                CREATE TABLE IF NOT EXISTS totales (
+                    camara TEXT PRIMARY KEY, bytes INTEGER NOT NULL, archivos INTEGER NOT NULL)''')
+            self._conexion.execute('''
+                CREATE TRIGGER IF NOT EXISTS grabaciones_insertada AFTER INSERT ON grabaciones BEGIN
+                    INSERT OR IGNORE INTO totales (camara, bytes, archivos) VALUES (NEW.camara, 0, 0);
+                    UPDATE totales SET bytes = bytes + NEW.tamano, archivos = archivos + 1 WHERE camara = NEW.camara;
+                END''')
+            self._conexion.execute('''
+                CREATE TRIGGER IF NOT EXISTS grabaciones_eliminada AFTER DELETE ON grabaciones BEGIN
+                    UPDATE totales SET bytes = bytes - OLD.tamano, archivos = archivos - 1 WHERE camara = OLD.camara;
+                END''')
+            self._conexion.execute('''
+                CREATE TRIGGER IF NOT EXISTS grabaciones_actualizada AFTER UPDATE OF tamano ON grabaciones BEGIN
+                    UPDATE totales SET bytes = bytes - OLD.tamano + NEW.tamano WHERE camara = NEW.camara;
+                END''')
+            if nueva:
+                self._conexion.execute('''
+                    INSERT INTO totales (camara, bytes, archivos)
+                    SELECT camara, SUM(tamano), COUNT(*) FROM grabaciones GROUP BY camara''')
+        # La duración más larga acota las búsquedas por intervalo al índice de inicio
+        fila = self._conexion.execute('SELECT MAX(fin - inicio) FROM grabaciones').fetchone()
+        self._duracion_maxima = fila[0] or 0
+        self.sincronizacion_inicial = Event()  # se activa al terminar la sincronización de `iniciar_catalogo`
+
+    def registrar(self, ruta, camara, inicio, fin, tamano, codec=None, audio=None, disparo='movimiento', region=None):
+        with self._lock, self._conexion:
+            self._registrar(os.path.abspath(ruta), camara, inicio, fin, tamano, codec, audio, disparo, region)
+
+    def _registrar(self, ruta, camara, inicio, fin, tamano, codec, audio, disparo, region=None):
+        self._conexion.execute('''
+            INSERT INTO grabaciones (ruta, camara, inicio, fin, tamano, codec, audio, disparo, region)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (ruta) DO UPDATE SET fin = excluded.fin, tamano = excluded.tamano,
+                codec = COALESCE(excluded.codec, codec), audio = COALESCE(excluded.audio, audio),
+                region = COALESCE(excluded.region, region)''',
+            (ruta, camara, inicio, fin, tamano, codec, None if audio is None else int(bool(audio)), disparo,
+             None if region is None else json.dumps(list(region))))
+        self._duracion_maxima = max(self._duracion_maxima, fin - inicio)
+
+    def sincronizar(self, directorio_base):
+        """Agrega al catálogo las grabaciones del disco que falten y quita las que ya no existen.
+
+        Solo se recorren las carpetas de cámaras modificadas desde la última sincronización.
+        Solo este método guarda la fecha de modificación de cada carpeta: la de una carpeta
+        cambia también con archivos aún sin registrar (el segmento en curso mientras se
+        registra el anterior), y adelantarla al registrar los ocultaría para siempre.
+        Devuelve (agregadas, quitadas).
+        """
+        agregadas = quitadas = 0
+        if not os.path.isdir(directorio_base):
+            return agregadas, quitadas
+        with self._lock:
+            conocidas = dict(self._conexion.execute('SELECT ruta, modificada FROM carpetas'))
+        for carpeta in os.scandir(directorio_base):
+            if not carpeta.is_dir():
+                continue
+            ruta_carpeta = os.path.abspath(carpeta.path)
+            modificada = carpeta.stat().st_mtime
+            if conocidas.get(ruta_carpeta) == modificada:
+                continue
+            en_disco = {}
+            for entrada in os.scandir(carpeta.path):
+                nombre = analizar_nombre_grabacion(entrada.name)
+                if nombre is not None and entrada.is_file():
+                    en_disco[os.path.join(ruta_carpeta, entrada.name)] = (entrada, nombre)
+            with self._lock, self._conexion:
+                # Solo las de esta carpeta: la cámara puede tener grabaciones en otro directorio base
+                registradas = {ruta for ruta, in self._conexion.execute(
+                    'SELECT ruta FROM grabaciones WHERE camara = ?', (carpeta.name,))
+                    if os.path.dirname(ruta) == ruta_carpeta}
+                for ruta in registradas - en_disco.keys():
+                    self._conexion.execute('DELETE FROM grabaciones WHERE ruta = ?', (ruta,))
+                    quitadas += 1
+                for ruta in en_disco.keys() - registradas:
+                    entrada, (disparo, inicio) = en_disco[ruta]
+                    datos = entrada.stat()
+                    codec = 'xvid' if ruta.endswith('.avi') else None
+                    self._registrar(ruta, carpeta.name, inicio, datos.st_mtime, datos.st_size, codec, None, disparo)
+                    agregadas += 1
+                self._conexion.execute('INSERT OR REPLACE INTO carpetas (ruta, modificada) VALUES (?, ?)',
+                                       (ruta_carpeta, modificada))
+        if agregadas or quitadas:
+            print(f"[Catálogo] Sincronizado con {directorio_base}: {agregadas} agregadas, {quitadas} quitadas")
+        return agregadas, quitadas
+
+    def buscar(self, desde, hasta, camara=None):
+        """Grabaciones que se superponen con el intervalo [desde, hasta], ordenadas por inicio."""
+        condiciones = ['inicio >= ?', 'inicio < ?', 'fin > ?']
+        parametros = [desde - self._duracion_maxima, hasta, desde]
+        if camara is not None:
+            condiciones.append('camara = ?')
+            parametros.append(camara)
+        with self._lock:
+            filas = self._conexion.execute(f'''
+                SELECT ruta, camara, inicio, fin, tamano, codec, audio, disparo, region FROM grabaciones
+                WHERE {' AND '.join(condiciones)} ORDER BY inicio''', parametros).fetchall()
+        campos = ('ruta', 'camara', 'inicio', 'fin', 'tamano', 'codec', 'audio', 'disparo', 'region')
+        grabaciones = [dict(zip(campos, fila)) for fila in filas]
+        for grabacion in grabaciones:
+            if grabacion['region'] is not None:
+                grabacion['region'] = tuple(json.loads(grabacion['region']))
+        return grabaciones
+
+    def anteriores(self, limite, camara=None, disparo=None, desde=(0, 0), cantidad=LOTE_CATALOGO, directorio=None):
+        """(id, ruta, tamaño, inicio) de las grabaciones iniciadas antes de `limite`, de la más antigua
+        a la más nueva y a continuación de (inicio, id) `desde`, opcionalmente solo bajo `directorio`."""
+        condiciones = ['inicio < ?', '(inicio, id) > (?, ?)']
+        parametros = [limite, desde[0], desde[1]]
+        if directorio is not None:
+            prefijo = os.path.join(os.path.abspath(directorio), '')
+            condiciones.append('substr(ruta, 1, ?) = ?')
+            parametros.extend([len(prefijo), prefijo])
+        if camara is not None:
+            condiciones.append('camara = ?')
+            parametros.append(camara)
+        if disparo is not None:
+            condiciones.append('disparo = ?')
+            parametros.append(disparo)
+        with self._lock:
+            return self._conexion.execute(f'''
+                SELECT id, ruta, tamano, inicio FROM grabaciones
+                WHERE {' AND '.join(condiciones)} ORDER BY inicio, id LIMIT ?''',
+                parametros + [cantidad]).fetchall()
+
+    def quitar(self, ids):
+        with self._lock, self._conexion:
+            self._conexion.executemany('DELETE FROM grabaciones WHERE id = ?', [(i,) for i in ids])
+
+    def totales(self):
+        """Bytes grabados de cada cámara según el catálogo."""
+        with self._lock:
+            return dict(self._conexion.execute('SELECT camara, bytes FROM totales WHERE archivos > 0'))
+
+def obtener_catalogo(archivo=ARCHIVO_CATALOGO):
+    """Devuelve el catálogo de grabaciones compartido, creándolo si aún no existe."""
+    global CATALOGO
+    with CATALOGO_LOCK:
+        if CATALOGO is None:
+            CATALOGO = CatalogoGrabaciones(archivo)
+    return CATALOGO
+
+def iniciar_catalogo(config):
+    """Abre el catálogo y lo sincroniza con el disco en segundo plano."""
+    catalogo = obtener_catalogo(config.get('catalogo_grabaciones', ARCHIVO_CATALOGO))
+    directorio = config.get('directorio_videos', './videos')
+
+    def sincronizar():
+        try:
+            catalogo.sincronizar(directorio)
+        except (OSError, sqlite3.Error) as e:
+            print(f"[Catálogo] Error al sincronizar con {directorio}: {e}")
+        finally:
+            catalogo.sincronizacion_inicial.set()
+
+    Thread(target=sincronizar, daemon=True).start()
+    return catalogo
+
+def eliminar_grabaciones(filas, catalogo):
+    """Elimina del disco y del catálogo las grabaciones (id, ruta, tamaño, inicio) indicadas.
+
+    Las que no se puedan borrar quedan en el catálogo. Devuelve (archivos eliminados, bytes liberados).
+    """
+    eliminados = liberados = 0
+    quitadas = []
+    for id_grabacion, ruta, tamano, _ in filas:
+        try:
+            os.remove(ruta)
+            eliminados += 1
+            liberados += tamano
+            print(f"[Limpieza] Eliminado: {os.path.basename(ruta)}")
+        except FileNotFoundError:
+            pass  # Ya no estaba en el disco: basta con olvidarla
+        except OSError as e:
+            print(f"[Limpieza] Error eliminando {ruta}: {e}")
+            continue
+        quitadas.append(id_grabacion)
+    catalogo.quitar(quitadas)
+    return eliminados, liberados
+
+def eliminar_grabaciones_antiguas(limite, catalogo=None, directorio=None):
+    """Elimina del disco y del catálogo las grabaciones iniciadas antes de `limite`,
+    opcionalmente solo las que están bajo `directorio`.
+
+    Devuelve (archivos eliminados, bytes liberados).
+    """
+    catalogo = catalogo or obtener_catalogo()
+    eliminados = liberados = 0
+    desde = (0, 0)
+    while True:
+        filas = catalogo.anteriores(limite, desde=desde, directorio=directorio)
+        if not filas:
+            break
+        # Las que no se puedan borrar quedan para la próxima limpieza
+        desde = (filas[-1][3], filas[-1][0])
+        archivos, bytes_liberados = eliminar_grabaciones(filas, catalogo)
+        eliminados += archivos
+        liberados += bytes_liberados
+    return eliminados, liberados
+
+# Retención automática de grabaciones locales
+class ServicioRetencion:
+    """Hilo en segundo plano que mantiene las grabaciones dentro de los límites de retención.
+
+    En cada pasada aplica, en este orden, la antigüedad máxima por cámara (distinta
+    para clips por movimiento y segmentos continuos), el máximo de bytes por cámara,
+    el máximo de bytes total y el espacio libre mínimo del disco. Los candidatos
+    salen del catálogo de la más antigua a la más nueva; al aplicar una cuota se
+    eliminan antes los segmentos continuos que los clips por movimiento. Se borra
+    en tandas pequeñas con una pausa entre ellas para no competir con la escritura
+    de las cámaras, y nunca se tocan grabaciones que puedan seguir abiertas.
+    """
+
+    def __init__(self, config, catalogo=None, intervalo=RETENCION_INTERVALO, lote=RETENCION_LOTE,
+                 pausa=RETENCION_PAUSA):
+        self.config = dict(config)
+        self.catalogo = catalogo or obtener_catalogo(config.get('catalogo_grabaciones', ARCHIVO_CATALOGO))
+        self.intervalo = intervalo
+        self.lote = lote
+        self.pausa = pausa
+        self.eliminados = 0
+        self.bytes_liberados = 0
+        self.detenido = Event()
+        self._hilo = None
+
+    def configurar(self, config):
+        """Actualiza los límites; se aplican en la próxima pasada."""
+        self.config = dict(config)
+
+    def iniciar(self):
+        if self._hilo is not None and self._hilo.is_alive():
+            return
+        self.detenido.clear()
+        self._hilo = Thread(target=self._ejecutar, daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self.detenido.set()
+
+    def _ejecutar(self):
+        while not self.detenido.is_set():
             try:
-                with FTP_QUEUE_LOCK:
-                    if not FTP_QUEUE:
-                        break
-                    tarea = FTP_QUEUE.popleft()
+                self.pasada()
+            except (OSError, sqlite3.Error) as e:
+                print(f"[Retención] Error en la pasada de retención: {e}")
+            self.detenido.wait(self.intervalo)
+
+    def pasada(self):
+        """Aplica todos los límites una vez. Devuelve (archivos eliminados, bytes liberados)."""
+        inicio = time.time()
+        eliminados_antes, liberados_antes = self.eliminados, self.bytes_liberados
+        # Las grabaciones más recientes que un segmento pueden seguir abiertas por un escritor
+        tope = inicio - RETENCION_MARGEN
+
+        for camara, bytes_camara in self.catalogo.totales().items():
+            config = config_para_camara(self.config, camara)
+            for disparo in ('movimiento', 'continuo'):
+                dias = config.get(f'retencion_dias_{disparo}', 0)
+                if dias:
+                    self._purgar(lambda: math.inf, min(tope, inicio - dias * 86400), camara, disparo)
+            maximo = config.get('retencion_max_gb', 0) * 1024 ** 3
+            if maximo and bytes_camara > maximo:
+                self._purgar_por_cuota(lambda camara=camara: self.catalogo.totales().get(camara, 0) - maximo,
+                                       tope, camara)
+
+        maximo_total = self.config.get('retencion_total_max_gb', 0) * 1024 ** 3
+        if maximo_total:
+            self._purgar_por_cuota(lambda: sum(self.catalogo.totales().values()) - maximo_total, tope)
+
+        minimo_libre = self.config.get('retencion_min_libre_gb', RETENCION_MIN_LIBRE_GB) * 1024 ** 3
+        # Solo liberan espacio las grabaciones que están en el disco medido
+        if minimo_libre and not self._purgar_por_cuota(lambda: minimo_libre - self.espacio_libre(), tope,
+                                                        directorio=self.config.get('directorio_videos', './videos')):
+            print(f"[Retención] Quedan menos de {minimo_libre / 1024 ** 3:.1f} GB libres y no hay "
+                  f"grabaciones que se puedan eliminar")
+
+        eliminados = self.eliminados - eliminados_antes
+        liberados = self.bytes_liberados - liberados_antes
+        if eliminados:
+            print(f"[Retención] {eliminados} grabaciones eliminadas, {liberados / (1024 * 1024):.1f} MB "
+                  f"liberados en {time.time() - inicio:.1f} s")
+        return eliminados, liberados
+
+    def espacio_libre(self):
+        try:
+            return shutil.disk_usage(self.config.get('directorio_videos', './videos')).free
+        except OSError:
+            return math.inf  # El directorio aún no existe: no hay nada que liberar
 
-                archivo = tarea['archivo']
-                timestamp = tarea['timestamp']
-                intentos = tarea['intentos']
-                camara = tarea['camara']
-                ftp_config = tarea['ftp_config']
+    def _purgar_por_cuota(self, exceso, limite, camara=None, directorio=None):
+        """Libera los bytes de `exceso()` de la más antigua a la más nueva, primero los segmentos continuos.
+
+        Devuelve False si la cuota sigue excedida por no quedar grabaciones que eliminar.
+        """
+        for disparo in ('continuo', 'movimiento'):
+            if self._purgar(exceso, limite, camara, disparo, directorio):
+                return True
+        return exceso() <= 0
 
-                # Verificar si el archivo aún existe
-                if not os.path.exists(archivo):
-                    print(f"[FTP] Archivo {os.path.basename(archivo)} ya no existe, omitiendo")
+    def _purgar(self, exceso, limite, camara, disparo, directorio=None):
+        """Elimina tandas de grabaciones anteriores a `limite` hasta liberar los bytes de `exceso()`.
+
+        Devuelve True si terminó porque ya no queda exceso.
+        """
+        desde = (0, 0)
+        while not self.detenido.is_set():
+            pendiente = exceso()
+            if pendiente <= 0:
+                return True
+            filas = self.catalogo.anteriores(limite, camara, disparo, desde, self.lote, directorio)
+            if not filas:
+                return False
+            # No borrar más de lo necesario para cubrir el exceso
+            for cantidad, fila in enumerate(filas, 1):
+                pendiente -= fila[2]
+                if pendiente <= 0:
+                    filas = filas[:cantidad]
+                    break
+            desde = (filas[-1][3], filas[-1][0])
+            eliminados, liberados = eliminar_grabaciones(filas, self.catalogo)
+            self.eliminados += eliminados
+            self.bytes_liberados += liberados
+            # Pausa entre tandas para repartir la E/S en el tiempo
+            self.detenido.wait(self.pausa)
+        return False
+
+def obtener_servicio_retencion(config):
+    """Devuelve el servicio de retención compartido con la configuración indicada, iniciándolo si hace falta."""
+    global SERVICIO_RETENCION
+    with SERVICIO_RETENCION_LOCK:
+        if SERVICIO_RETENCION is None:
+            SERVICIO_RETENCION = ServicioRetencion(config)
+        else:
+            SERVICIO_RETENCION.configurar(config)
+    SERVICIO_RETENCION.iniciar()
+    return SERVICIO_RETENCION
+
+# Subidas FTP
+class SesionesFTP:
+    """Sesiones FTP ya autenticadas, reutilizadas entre subidas al mismo servidor.
+
+    Las sesiones libres reciben NOOP tras `keepalive` segundos sin uso para que
+    el servidor no las cierre, y se descartan tras `maxima_inactiva` segundos.
+    """
+
+    def __init__(self, keepalive=FTP_KEEPALIVE, maxima_inactiva=FTP_SESION_MAXIMA_INACTIVA, timeout=FTP_TIMEOUT):
+        self.keepalive = keepalive
+        self.maxima_inactiva = maxima_inactiva
+        self.timeout = timeout
+        self._libres = {}  # clave del servidor -> [(ftp, último uso)]
+        self._directorios = set()  # (clave, ruta) ya creados en el servidor
+        self._comandos_hash = {}  # clave -> comandos de hash que el servidor no soporta
+        self._lock = Lock()
+        Thread(target=self._mantener, daemon=True).start()
+
+    @staticmethod
+    def clave(ftp_config):
+        return (ftp_config['host'], ftp_config['user'])
+
+    def obtener(self, ftp_config):
+        """Devuelve una sesión libre del servidor o abre una nueva."""
+        clave = self.clave(ftp_config)
+        while True:
+            with self._lock:
+                libres = self._libres.get(clave)
+                if not libres:
+                    break
+                ftp, ultimo_uso = libres.pop()
+            if time.time() - ultimo_uso < self.keepalive:
+                return ftp
+            # Sesión inactiva: comprobar que siga viva antes de usarla
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except Exception:
+                self.descartar(ftp)
+        ftp = ftplib.FTP(ftp_config['host'], timeout=self.timeout)
+        ftp.login(ftp_config['user'], ftp_config['password'])
+        return ftp
+
+    def devolver(self, ftp_config, ftp):
+        with self._lock:
+            self._libres.setdefault(self.clave(ftp_config), []).append((ftp, time.time()))
+
+    def descartar(self, ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+    def asegurar_directorio(self, ftp_config, ftp, ruta):
+        """Crea la ruta remota una sola vez por servidor y proceso."""
+        clave = (self.clave(ftp_config), ruta)
+        if clave in self._directorios:
+            return
+        actual = ''
+        for parte in ruta.strip('/').split('/'):
+            actual = f"{actual}/{parte}" if actual or ruta.startswith('/') else parte
+            try:
+                ftp.mkd(actual)
+            except ftplib.error_perm:
+                pass  # El directorio ya existe
+        self._directorios.add(clave)
+
+    def hash_remoto(self, ftp_config, ftp, ruta):
+        """Devuelve (algoritmo, hash) del archivo remoto con XMD5 o HASH, o None si el servidor no los soporta."""
+        no_soportados = self._comandos_hash.setdefault(self.clave(ftp_config), set())
+        for comando in ('XMD5', 'HASH'):
+            if comando in no_soportados:
+                continue
+            try:
+                respuesta = ftp.sendcmd(f'{comando} {ruta}')
+            except ftplib.error_perm as e:
+                # 500/502: comando desconocido; cualquier otro error es del archivo
+                if str(e)[:3] in ('500', '502', '504'):
+                    no_soportados.add(comando)
                     continue
+                return None
+            except ftplib.Error:
+                return None
+            partes = respuesta.split()
+            if comando == 'XMD5' and len(partes) >= 2:
+                return 'md5', partes[-1].lower()
+            if comando == 'HASH' and len(partes) >= 4:
+                # 213 SHA-256 0-1234 <hash> <archivo>
+                return partes[1].replace('-', '').lower(), partes[3].lower()
+            return None
+        return None
 
+    def _mantener(self):
+        while True:
+            time.sleep(max(1, self.keepalive / 2))
+            ahora = time.time()
+            with self._lock:
+                revisar = [(clave, sesion) for clave, libres in self._libres.items() for sesion in libres
+                           if ahora - sesion[1] >= self.keepalive]
+                for clave, sesion in revisar:
+                    self._libres[clave].remove(sesion)
+            for clave, (ftp, ultimo_uso) in revisar:
+                if ahora - ultimo_uso >= self.maxima_inactiva:
+                    self.descartar(ftp)
+                    continue
+                try:
+                    ftp.voidcmd('NOOP')
+                except Exception:
+                    self.descartar(ftp)
+                    continue
+                with self._lock:
+                    # Conservar el último uso real para que la sesión termine cerrándose si nadie la usa
+                    self._libres.setdefault(clave, []).append((ftp, ultimo_uso))
+
+def tamano_remoto(ftp, ruta):
+    """Tamaño de un archivo remoto con SIZE, o None si no existe."""
+    try:
+        ftp.voidcmd('TYPE I')  # SIZE requiere modo binario en muchos servidores
+        return ftp.size(ruta)
+    except ftplib.error_perm:
+        return None
+
+def hash_local(archivo, algoritmo):
+    try:
+        resumen = hashlib.new(algoritmo)
+    except ValueError:
+        return None
+    with open(archivo, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            resumen.update(bloque)
+    return resumen.hexdigest()
+
+class JournalSubidas:
+    """Registro persistente de subidas FTP en SQLite (modo WAL).
+
+    Cada archivo pasa por los estados pendiente -> en_curso -> hecho, o fallido
+    tras agotar los intentos. Al iniciar, las subidas que quedaron en curso por
+    un cierre inesperado vuelven a pendiente, así nada se pierde ni hace falta
+    recorrer el directorio de videos. El índice (estado, proximo_intento) mantiene
+    baratas las operaciones de la cola aunque se acumulen cientos de miles de filas.
+    """
+
+    def __init__(self, archivo=ARCHIVO_JOURNAL_FTP):
+        self.archivo = archivo
+        self._lock = Lock()
+        self._conexion = sqlite3.connect(archivo, check_same_thread=False)
+        self._conexion.execute('PRAGMA journal_mode=WAL')
+        self._conexion.execute('PRAGMA synchronous=NORMAL')
+        with self._conexion:
+            self._conexion.execute('''
+                CREATE TABLE IF NOT EXISTS subidas (
+                    id INTEGER PRIMARY KEY,
+                    archivo TEXT NOT NULL UNIQUE,
+                    camara TEXT NOT NULL,
+                    estado TEXT NOT NULL,
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    creado REAL NOT NULL,
+                    proximo_intento REAL NOT NULL,
+                    destino TEXT,
+                    tamano INTEGER,
+                    subido REAL,
+                    error TEXT
+                )''')
+            self._conexion.execute(
+                'CREATE INDEX IF NOT EXISTS idx_subidas_estado ON subidas (estado, proximo_intento)')
+            self._conexion.execute(
+                'CREATE INDEX IF NOT EXISTS idx_subidas_subido ON subidas (estado, subido)')
+            self._conexion.execute(
+                'CREATE TABLE IF NOT EXISTS parametros (clave TEXT PRIMARY KEY, valor TEXT)')
+            recuperadas = self._conexion.execute(
+                "UPDATE subidas SET estado = 'pendiente' WHERE estado = 'en_curso'").rowcount
+        if recuperadas:
+            print(f"[FTP] {recuperadas} subidas interrumpidas vuelven a la cola")
+
+    def agregar(self, archivo, camara, demora=0):
+        ahora = time.time()
+        with self._lock, self._conexion:
+            self._conexion.execute('''
+                INSERT INTO subidas (archivo, camara, estado, intentos, creado, proximo_intento)
+                VALUES (?, ?, 'pendiente', 0, ?, ?)
+                ON CONFLICT (archivo) DO UPDATE SET estado = 'pendiente', intentos = 0,
+                    proximo_intento = excluded.proximo_intento, error = NULL''',
+                (archivo, camara, ahora, ahora + demora))
+
+    def tomar(self, ahora):
+        """Marca en curso la subida pendiente más próxima si ya está lista.
+
+        Devuelve (tarea, None), o (None, instante de la próxima) si ninguna está
+        lista todavía, o (None, None) si no hay pendientes.
+        """
+        with self._lock, self._conexion:
+            fila = self._conexion.execute('''
+                SELECT id, archivo, camara, intentos, creado, proximo_intento FROM subidas
+                WHERE estado = 'pendiente' ORDER BY proximo_intento LIMIT 1''').fetchone()
+            if fila is None:
+                return None, None
+            if fila[5] > ahora:
+                return None, fila[5]
+            self._conexion.execute("UPDATE subidas SET estado = 'en_curso' WHERE id = ?", (fila[0],))
+        return {'id': fila[0], 'archivo': fila[1], 'camara': fila[2], 'intentos': fila[3], 'timestamp': fila[4]}, None
+
+    def completar(self, tarea, destino, tamano):
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "UPDATE subidas SET estado = 'hecho', destino = ?, tamano = ?, subido = ?, error = NULL WHERE id = ?",
+                (destino, tamano, time.time(), tarea['id']))
+
+    def reprogramar(self, tarea, demora, error):
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "UPDATE subidas SET estado = 'pendiente', intentos = ?, proximo_intento = ?, error = ? WHERE id = ?",
+                (tarea['intentos'], time.time() + demora, str(error)[:200], tarea['id']))
+
+    def fallar(self, tarea, error):
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "UPDATE subidas SET estado = 'fallido', intentos = ?, error = ? WHERE id = ?",
+                (tarea['intentos'], str(error)[:200], tarea['id']))
+
+    def pendientes_por_camara(self):
+        """Subidas pendientes o en curso de cada cámara."""
+        with self._lock:
+            filas = self._conexion.execute('''
+                SELECT camara, COUNT(*) FROM subidas
+                WHERE estado IN ('pendiente', 'en_curso') GROUP BY camara''').fetchall()
+        return dict(filas)
+
+    def vencidas(self, limite, desde=(0, 0), cantidad=FTP_LOTE_LIMPIEZA):
+        """Subidas hechas antes de `limite`, en orden de subida y a continuación de (subido, id) `desde`."""
+        with self._lock:
+            return self._conexion.execute('''
+                SELECT id, destino, tamano, subido FROM subidas
+                WHERE estado = 'hecho' AND subido < ? AND (subido, id) > (?, ?)
+                ORDER BY subido, id LIMIT ?''', (limite, desde[0], desde[1], cantidad)).fetchall()
+
+    def quitar(self, ids):
+        """Olvida las subidas cuyo archivo remoto ya se eliminó."""
+        with self._lock, self._conexion:
+            self._conexion.executemany('DELETE FROM subidas WHERE id = ?', [(i,) for i in ids])
+
+    def valor(self, clave, por_defecto=None):
+        with self._lock:
+            fila = self._conexion.execute('SELECT valor FROM parametros WHERE clave = ?', (clave,)).fetchone()
+        return por_defecto if fila is None else fila[0]
+
+    def guardar_valor(self, clave, valor):
+        with self._lock, self._conexion:
+            self._conexion.execute('INSERT OR REPLACE INTO parametros (clave, valor) VALUES (?, ?)',
+                                   (clave, str(valor)))
+
+class ServicioFTP:
+    """Servicio único de subida FTP con un número fijo de trabajadores.
+
+    Las tareas esperan en el journal ordenadas por el instante en que pueden
+    ejecutarse: un reintento se reprograma para más tarde sin ocupar a ningún
+    trabajador mientras tanto, y sobrevive a un reinicio de la aplicación.
+    """
+
+    def __init__(self, trabajadores=FTP_TRABAJADORES, ftp_config=None, archivo_journal=ARCHIVO_JOURNAL_FTP,
+                 max_intentos=FTP_MAX_INTENTOS, demora_reintento=FTP_RETRY_DELAY,
+                 demora_maxima=FTP_RETRY_DELAY_MAXIMO):
+        self.ftp_config = dict(ftp_config or {})
+        self.max_intentos = max_intentos
+        self.demora_reintento = demora_reintento
+        self.demora_maxima = demora_maxima
+        self.sesiones = SesionesFTP()
+        self.journal = JournalSubidas(archivo_journal)
+        self._origenes = {}  # nombre de cámara -> Camara, para métricas y logs
+        self._condicion = Condition()
+        self._lock_metricas = Lock()
+        self._lock_limpieza = Lock()
+        for _ in range(max(1, trabajadores)):
+            Thread(target=self._trabajar, daemon=True).start()
+
+    def configurar(self, ftp_config):
+        """Actualiza el servidor de destino; las subidas pendientes se reanudan con él."""
+        with self._condicion:
+            self.ftp_config = dict(ftp_config)
+            self._condicion.notify_all()
+
+    def encolar(self, archivo, camara, ftp_config=None, origen=None, demora=0):
+        if origen is not None:
+            self._origenes[camara] = origen
+        self.journal.agregar(archivo, camara, demora)
+        with self._condicion:
+            if ftp_config:
+                self.ftp_config = dict(ftp_config)
+            self._condicion.notify()
+
+    def pendientes_por_camara(self):
+        return self.journal.pendientes_por_camara()
+
+    def _tomar(self):
+        """Espera hasta que la subida más próxima esté lista y la devuelve."""
+        with self._condicion:
+            while True:
+                if self.ftp_config.get('host'):
+                    tarea, proxima = self.journal.tomar(time.time())
+                    if tarea is not None:
+                        tarea['ftp_config'] = self.ftp_config
+                        tarea['origen'] = self._origenes.get(tarea['camara'])
+                        return tarea
+                    self._condicion.wait(None if proxima is None else max(0.01, proxima - time.time()))
+                else:
+                    # Sin servidor configurado las subidas esperan en el journal
+                    self._condicion.wait()
+
+    def _trabajar(self):
+        while True:
+            tarea = self._tomar()
+            try:
+                self._subir(tarea)
+            except Exception as e:
+                print(f"[FTP] Error en procesamiento de cola: {e}")
                 try:
-                    with ftplib.FTP(ftp_config['host']) as ftp:
-                        ftp.login(ftp_config['user'], ftp_config['password'])
-                        remote_path = ftp_config.get('remote_path', '/videos')
-
-                        # Crear directorio remoto si no existe
-                        try:
-                            ftp.mkd(remote_path)
-                        except ftplib.error_perm:
-                            pass  # El directorio ya existe
-
-                        # Cambiar al directorio remoto
-                        ftp.cwd(remote_path)
-
-                        # Crear subdirectorio para la cámara si no existe
-                        try:
-                            ftp.mkd(camara)
-                        except ftplib.error_perm:
-                            pass
-                        ftp.cwd(camara)
-
-                        # Subir el archivo
-                        with open(archivo, 'rb') as file:
-                            filename = os.path.basename(archivo)
-                            ftp.storbinary(f'STOR {filename}', file)
-
-                        print(f"[FTP] Archivo {filename} subido exitosamente a {ftp_config['host']}")
-                        # Log en la interfaz si existe
-                        if hasattr(self, 'app') and hasattr(self.app, 'log_ftp'):
-                            self.app.log_ftp(f"✅ Archivo {filename} enviado por FTP")
+                    self._reintentar(tarea, e)
+                except Exception as e:
+                    print(f"[FTP] No se pudo reprogramar {tarea['archivo']}: {e}")
+
+    def _registrar(self, tarea, atributo, valor):
+        origen = tarea['origen']
+        if origen is not None:
+            with self._lock_metricas:
+                setattr(origen, atributo, getattr(origen, atributo) + valor)
+
+    def _log(self, tarea, mensaje):
+        # Log en la interfaz (o en la consola del servicio) si existe
+        app = getattr(tarea['origen'], 'app', None)
+        if hasattr(app, 'log_ftp'):
+            app.log_ftp(mensaje)
+
+    def _subir(self, tarea):
+        archivo = tarea['archivo']
+        ftp_config = tarea['ftp_config']
+        filename = os.path.basename(archivo)
+
+        # Verificar si el archivo aún existe
+        if not os.path.exists(archivo):
+            print(f"[FTP] Archivo {filename} ya no existe, omitiendo")
+            self.journal.fallar(tarea, "el archivo ya no existe")
+            return
 
+        try:
+            ftp = self.sesiones.obtener(ftp_config)
+        except Exception as e:
+            self._reintentar(tarea, e)
+            return
+
+        try:
+            ruta = f"{ftp_config.get('remote_path', '/videos').rstrip('/')}/{tarea['camara']}"
+            destino = f"{ruta}/{filename}"
+            self.sesiones.asegurar_directorio(ftp_config, ftp, ruta)
+            if self._transferir(tarea, ftp, archivo, destino) is None:
+                self.sesiones.devolver(ftp_config, ftp)
+                self.journal.completar(tarea, destino, os.path.getsize(archivo))
+                print(f"[FTP] Archivo {filename} ya estaba en el servidor, omitiendo")
+                return
+        except Exception as e:
+            # La sesión puede haber quedado en un estado desconocido: no reutilizarla
+            self.sesiones.descartar(ftp)
+            self._reintentar(tarea, e)
+            return
+
+        self.sesiones.devolver(ftp_config, ftp)
+        self.journal.completar(tarea, destino, os.path.getsize(archivo))
+        print(f"[FTP] Archivo {filename} subido exitosamente a {ftp_config['host']}")
+        self._log(tarea, f"✅ Archivo {filename} enviado por FTP")
+
+    def _transferir(self, tarea, ftp, archivo, destino):
+        """Sube el archivo a destino.part reanudando desde lo que ya tenga el servidor y lo renombra al final.
+
+        Devuelve None si el destino ya existía completo y no hubo nada que subir.
+        """
+        ftp_config = tarea['ftp_config']
+        tamano = os.path.getsize(archivo)
+        existente = tamano_remoto(ftp, destino)
+        if existente == tamano:
+            remoto = self.sesiones.hash_remoto(ftp_config, ftp, destino)
+            if remoto is None or hash_local(archivo, remoto[0]) in (None, remoto[1]):
+                return None
+            print(f"[FTP] {os.path.basename(destino)} existe con otro contenido, se reemplaza")
+
+        temporal = f"{destino}.part"
+        desplazamiento = tamano_remoto(ftp, temporal) or 0
+        if desplazamiento > tamano:
+            ftp.delete(temporal)  # Parcial de otro archivo: empezar de cero
+            desplazamiento = 0
+        if desplazamiento:
+            print(f"[FTP] Reanudando {os.path.basename(archivo)} desde {desplazamiento / (1024 * 1024):.1f} MB")
+            self._registrar(tarea, 'ftp_bytes_reanudados', desplazamiento)
+
+        if desplazamiento < tamano:
+            inicio_subida = time.time()
+            with open(archivo, 'rb') as file:
+                file.seek(desplazamiento)
+                ftp.storbinary(f'STOR {temporal}', file, rest=desplazamiento or None)
+            self._registrar(tarea, 'ftp_segundos_subida', time.time() - inicio_subida)
+            self._registrar(tarea, 'ftp_bytes_subidos', tamano - desplazamiento)
+
+        subido = tamano_remoto(ftp, temporal)
+        if subido != tamano:
+            raise ftplib.Error(f"tamaño remoto {subido} distinto del local {tamano}")
+        if existente is not None:
+            try:
+                ftp.delete(destino)  # Algunos servidores no renombran sobre un archivo existente
+            except ftplib.error_perm:
+                pass
+        ftp.rename(temporal, destino)
+        return tamano
+
+    def _reintentar(self, tarea, error):
+        """Reprograma la subida tras un error.
+
+        Los errores de conexión o transferencia se reintentan sin límite con espera
+        exponencial, así un corte largo del servidor no pierde ninguna subida. Solo
+        las respuestas permanentes (5xx) agotan los intentos, y el archivo local
+        inexistente falla de inmediato.
+        """
+        filename = os.path.basename(tarea['archivo'])
+        tarea['intentos'] += 1
+        permanente = isinstance(error, ftplib.error_perm) or not os.path.exists(tarea['archivo'])
+        if not permanente or tarea['intentos'] < self.max_intentos:
+            demora = min(self.demora_maxima, self.demora_reintento * 2 ** (tarea['intentos'] - 1))
+            demora = random.uniform(demora / 2, demora)  # jitter para no reintentar todas a la vez
+            limite = f"/{self.max_intentos}" if permanente else ""
+            print(f"[FTP] Error al subir {filename} (intento {tarea['intentos']}{limite}), "
+                  f"reintento en {demora:.0f}s: {error}")
+            self._registrar(tarea, 'ftp_reintentos', 1)
+            # Reprogramar sin bloquear al trabajador
+            self.journal.reprogramar(tarea, demora, error)
+        else:
+            print(f"[FTP] Fallaron todos los intentos para {filename}")
+            self.journal.fallar(tarea, error)
+            self._registrar(tarea, 'ftp_fallidos', 1)
+            self._log(tarea, f"❌ Error al transmitir {filename} por FTP")
+
+    def limpiar_remotos(self, ftp_config, horas=FTP_HORAS_RETENCION, log=print, sesiones=FTP_SESIONES_LIMPIEZA,
+                        dias_reconciliacion=FTP_DIAS_RECONCILIACION):
+        """Elimina del servidor los archivos subidos hace más de `horas` horas.
+
+        Los candidatos salen del journal, sin listar directorios remotos, y se
+        eliminan en tandas repartidas entre varias sesiones. Cada
+        `dias_reconciliacion` días se recorre además el servidor con MLSD (o LIST)
+        para encontrar archivos que el journal no registra. Devuelve el informe
+        de la ejecución, o None si ya había una limpieza en curso.
+        """
+        if not self._lock_limpieza.acquire(blocking=False):
+            print("[FTP] Ya hay una limpieza remota en curso, omitiendo")
+            return None
+        try:
+            inicio = time.time()
+            limite = inicio - horas * 3600
+            sesiones = max(1, sesiones)
+            informe = {'eliminados': 0, 'bytes': 0, 'errores': 0, 'comandos': 0, 'reconciliados': 0}
+
+            with ThreadPoolExecutor(max_workers=sesiones) as pool:
+                desde = (0, 0)
+                while True:
+                    filas = self.journal.vencidas(limite, desde)
+                    if not filas:
+                        break
+                    # Las que fallen quedan en el journal y se reintentan en la próxima limpieza
+                    desde = (filas[-1][3], filas[-1][0])
+                    borrados = self._eliminar_en_paralelo(pool, ftp_config, [fila[:3] for fila in filas], sesiones, informe)
+                    self.journal.quitar(borrados)
+                    print(f"[FTP] Limpieza: {informe['eliminados']} eliminados "
+                          f"({informe['bytes'] / (1024 * 1024):.1f} MB), {informe['errores']} errores, "
+                          f"{time.time() - inicio:.1f} s")
+
+                ultima = float(self.journal.valor('ultima_reconciliacion', 0))
+                if dias_reconciliacion and inicio - ultima >= dias_reconciliacion * 86400:
+                    vencidos = self._reconciliar(ftp_config, limite, informe)
+                    eliminados_antes = informe['eliminados']
+                    for i in range(0, len(vencidos), FTP_LOTE_LIMPIEZA):
+                        self._eliminar_en_paralelo(pool, ftp_config, vencidos[i:i + FTP_LOTE_LIMPIEZA], sesiones, informe)
+                    informe['reconciliados'] = informe['eliminados'] - eliminados_antes
+                    self.journal.guardar_valor('ultima_reconciliacion', inicio)
+
+            informe['segundos'] = time.time() - inicio
+            resumen = (f"{informe['eliminados']} archivos ({informe['bytes'] / (1024 * 1024):.1f} MB) en "
+                       f"{informe['segundos']:.1f} s, {informe['comandos']} comandos FTP, {informe['errores']} errores")
+            if informe['reconciliados']:
+                resumen += f", {informe['reconciliados']} sin registro en el journal"
+            print(f"[FTP] Limpieza completada: {resumen}")
+            if informe['eliminados'] or informe['errores']:
+                log(f"Limpieza FTP: {resumen}")
+            return informe
+        finally:
+            self._lock_limpieza.release()
+
+    def _eliminar_en_paralelo(self, pool, ftp_config, archivos, sesiones, informe):
+        """Reparte (id, ruta, tamaño) entre las sesiones y devuelve los ids eliminados."""
+        lotes = [archivos[i::sesiones] for i in range(sesiones) if archivos[i::sesiones]]
+        borrados = []
+        for ids, liberados, errores, comandos in pool.map(lambda lote: self._eliminar_lote(ftp_config, lote), lotes):
+            borrados.extend(i for i in ids if i is not None)
+            informe['eliminados'] += len(ids)
+            informe['bytes'] += liberados
+            informe['errores'] += errores
+            informe['comandos'] += comandos
+        return borrados
+
+    def _eliminar_lote(self, ftp_config, lote):
+        ids, liberados, errores, comandos = [], 0, 0, 0
+        ftp = None
+        for posicion, (id_subida, ruta, tamano) in enumerate(lote):
+            if ftp is None:
+                try:
+                    ftp = self.sesiones.obtener(ftp_config)
                 except Exception as e:
-                    intentos += 1
-                    if intentos < 3:  # Máximo 3 intentos
-                        print(f"[FTP] Error al subir {os.path.basename(archivo)} (intento {intentos}/3): {e}")
-                        # Re-agregar a la cola con delay
-                        with FTP_QUEUE_LOCK:
-                            FTP_QUEUE.append({
-                                'archivo': archivo,
-                                'timestamp': timestamp,
-                                'intentos': intentos,
-                                'camara': camara,
-                                'ftp_config': ftp_config
-                            })
-                        time.sleep(FTP_RETRY_DELAY)
-                    else:
-                        print(f"[FTP] Fallaron todos los intentos para {os.path.basename(archivo)}")
-                        # Log en la interfaz si existe
-                        if hasattr(self, 'app') and hasattr(self.app, 'log_ftp'):
-                            self.app.log_ftp(f"❌ Error al transmitir {os.path.basename(archivo)} por FTP")
+                    # Sin conexión no tiene sentido seguir con el resto del lote
+                    print(f"[FTP] No se pudo conectar para limpiar: {e}")
+                    errores += len(lote) - posicion
+                    break
+            comandos += 1
+            try:
+                ftp.delete(ruta)
+                liberados += tamano or 0
+            except ftplib.error_perm as e:
+                if not str(e).startswith('550'):
+                    print(f"[FTP] No se pudo eliminar {ruta}: {e}")
+                    errores += 1
+                    continue
+                # 550: el archivo ya no está en el servidor, basta con olvidarlo
+            except Exception as e:
+                print(f"[FTP] Error al eliminar {ruta}: {e}")
+                errores += 1
+                self.sesiones.descartar(ftp)
+                ftp = None
+                continue
+            ids.append(id_subida)
+        if ftp is not None:
+            self.sesiones.devolver(ftp_config, ftp)
+        return ids, liberados, errores, comandos
+
+    def _reconciliar(self, ftp_config, limite, informe):
+        """Recorre los directorios de cámaras del servidor y devuelve los archivos anteriores a `limite`.
+
+        Usa MLSD, con fechas exactas en UTC, y recurre a LIST si el servidor no lo soporta.
+        """
+        raiz = ftp_config.get('remote_path', '/videos').rstrip('/')
+        ftp = self.sesiones.obtener(ftp_config)
+        vencidos = []
+        try:
+            listar = listar_mlsd
+            informe['comandos'] += 1
+            try:
+                entradas = listar_mlsd(ftp, raiz)
+            except ftplib.error_perm as e:
+                if str(e)[:3] == '550':
+                    print(f"[FTP] Directorio remoto {raiz} no existe")
+                    self.sesiones.devolver(ftp_config, ftp)
+                    return []
+                if str(e)[:3] not in ('500', '502', '504'):
+                    raise
+                print("[FTP] El servidor no soporta MLSD, se usa LIST para reconciliar")
+                listar = listar_list
+                informe['comandos'] += 1
+                entradas = listar_list(ftp, raiz)
+            for nombre, tipo, _, _ in entradas:
+                if tipo != 'dir':
+                    continue
+                directorio = f"{raiz}/{nombre}"
+                informe['comandos'] += 1
+                try:
+                    contenido = listar(ftp, directorio)
+                except ftplib.error_perm as e:
+                    print(f"[FTP] No se pudo listar {directorio}: {e}")
+                    continue
+                for archivo, tipo_archivo, fecha, tamano in contenido:
+                    if tipo_archivo == 'file' and fecha is not None and fecha < limite:
+                        vencidos.append((None, f"{directorio}/{archivo}", tamano))
+        except Exception:
+            self.sesiones.descartar(ftp)
+            raise
+        self.sesiones.devolver(ftp_config, ftp)
+        return vencidos
+
+def listar_mlsd(ftp, ruta):
+    """Entradas de un directorio remoto con MLSD: (nombre, 'dir' o 'file', fecha, tamaño)."""
+    entradas = []
+    for nombre, hechos in ftp.mlsd(ruta, facts=['type', 'modify', 'size']):
+        tipo = hechos.get('type', '').lower()
+        if tipo in ('cdir', 'pdir'):
+            continue
+        try:
+            # MLSD informa la fecha en UTC con resolución de segundos
+            fecha = datetime.datetime.strptime(hechos['modify'][:14], '%Y%m%d%H%M%S').replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+        except (KeyError, ValueError):
+            fecha = None
+        try:
+            tamano = int(hechos.get('size', 0))
+        except ValueError:
+            tamano = 0
+        entradas.append((nombre, 'dir' if tipo == 'dir' else 'file', fecha, tamano))
+    return entradas
+
+def listar_list(ftp, ruta):
+    """Entradas de un directorio remoto con LIST en formato Unix, para servidores sin MLSD."""
+    lineas = []
+    ftp.retrlines(f'LIST {ruta}', lineas.append)
+    entradas = []
+    for linea in lineas:
+        # -rw-r--r-- 1 user group size month day time filename
+        partes = linea.split(None, 8)
+        if len(partes) < 9 or partes[8] in ('.', '..'):
+            continue
+        try:
+            tamano = int(partes[4])
+        except ValueError:
+            tamano = 0
+        entradas.append((partes[8], 'dir' if linea.startswith('d') else 'file',
+                         parsear_fecha_ftp(partes[5], partes[6], partes[7]), tamano))
+    return entradas
+
+def obtener_servicio_ftp(trabajadores=FTP_TRABAJADORES, ftp_config=None, archivo_journal=ARCHIVO_JOURNAL_FTP):
+    """Devuelve el servicio FTP compartido, creándolo si aún no existe."""
+    global SERVICIO_FTP
+    with SERVICIO_FTP_LOCK:
+        if SERVICIO_FTP is None:
+            SERVICIO_FTP = ServicioFTP(trabajadores, ftp_config, archivo_journal)
+    return SERVICIO_FTP
+
+def iniciar_servicio_ftp(config):
+    """Crea el servicio FTP al arrancar para reanudar las subidas pendientes del journal."""
+    ftp_config = config.get('ftp_config', {})
+    if not ftp_config.get('host') or not ftp_config.get('user') or not ftp_config.get('password'):
+        return None
+    servicio = obtener_servicio_ftp(config.get('ftp_trabajadores', FTP_TRABAJADORES), ftp_config,
+                                    config.get('journal_ftp', ARCHIVO_JOURNAL_FTP))
+    servicio.configurar(ftp_config)
+    return servicio
+
+# Limpieza remota y tareas programadas (compartidas por la interfaz y el modo headless)
+def limpiar_archivos_ftp_antiguos(ftp_config, log=print, horas=FTP_HORAS_RETENCION):
+    """Limpia archivos remotos FTP que tengan más de `horas` horas, a partir del journal de subidas."""
+    if not ftp_config.get('host') or not ftp_config.get('user') or not ftp_config.get('password'):
+        print("[FTP] FTP no configurado, omitiendo limpieza")
+        return None
+
+    try:
+        return obtener_servicio_ftp(ftp_config=ftp_config).limpiar_remotos(ftp_config, horas, log)
+    except Exception as e:
+        print(f"[FTP] Error en limpieza: {e}")
+        log(f"Error en limpieza FTP: {str(e)[:50]}...")
+        return None
+
+def parsear_fecha_ftp(mes, dia, hora_o_ano):
+    """Parsea fecha de listado FTP a timestamp."""
+    try:
+        meses = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+                'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+        ahora = datetime.datetime.now()
+        mes_num = meses.get(mes, 1)
+
+        if ':' in hora_o_ano:
+            # Formato: HH:MM (archivo de los últimos 6 meses, sin año)
+            hora, minuto = map(int, hora_o_ano.split(':'))
+            fecha = datetime.datetime(ahora.year, mes_num, int(dia), hora, minuto)
+            # Una fecha futura es del año anterior (diciembre listado en enero). Se tolera
+            # un día por la diferencia de zona horaria para no envejecer archivos recientes
+            if fecha > ahora + datetime.timedelta(days=1):
+                fecha = datetime.datetime(ahora.year - 1, mes_num, int(dia), hora, minuto)
+        else:
+            # Formato: YYYY (archivo de años anteriores)
+            ano = int(hora_o_ano)
+            fecha = datetime.datetime(ano, mes_num, int(dia))
+
+        return fecha.timestamp()
+    except:
+        return None
+
+def programar_limpieza_diaria(tarea):
+    """Programa la tarea a las 00:00 y ejecuta el scheduler en un hilo separado."""
+    def limpieza_diaria():
+        Thread(target=tarea, daemon=True).start()
+
+    # Programar limpieza diaria a las 00:00
+    schedule.every().day.at("00:00").do(limpieza_diaria)
+
+    # Ejecutar scheduler en un hilo separado
+    def run_scheduler():
+        while True:
+            schedule.run_pending()
+            time.sleep(60)  # Revisar cada minuto
+
+    Thread(target=run_scheduler, daemon=True).start()
+    print("[Scheduler] Limpieza diaria programada para las 00:00")
+
+# Métricas en formato de texto de Prometheus
+def _escapar_etiqueta(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def generar_metricas(camaras):
+    """Texto de exposición de Prometheus con los contadores de cada cámara."""
+    camaras = list(camaras)
+    ftp_pendientes = SERVICIO_FTP.pendientes_por_camara() if SERVICIO_FTP else {}
+
+    definiciones = [
+        ('conectada', 'gauge', "1 si la cámara está recibiendo frames",
+         lambda c: 1 if c.estado == 'en_vivo' else 0),
+        ('reconexiones_total', 'counter', "Reconexiones tras un estancamiento", lambda c: c.supervisor.reconexiones),
+        ('frames_capturados_total', 'counter', "Frames leídos del stream", lambda c: c.frames_capturados),
+        ('fps_captura', 'gauge', "Frames por segundo leídos (promedio móvil)", lambda c: round(c.fps_captura, 2)),
+        ('lectura_segundos_total', 'counter', "Tiempo dentro de cap.read(): espera de red más decodificación",
+         lambda c: round(c.segundos_lectura, 3)),
+        ('vista_descartados_total', 'counter', "Frames de vista previa reemplazados antes de mostrarse",
+         lambda c: c.salida_vista.descartados if c.salida_vista else 0),
+        ('bus_descartados_total', 'counter', "Frames descartados por colas de grabación llenas",
+         lambda c: c.bus.descartados),
+        ('analisis_descartados_total', 'counter', "Frames reemplazados antes de ser analizados",
+         lambda c: c.analisis_descartados),
+        ('latencia_deteccion_segundos', 'gauge', "Tiempo entre la captura y el resultado del último análisis",
+         lambda c: round(c.latencia_deteccion, 4)),
+        ('eventos_movimiento_total', 'counter', "Grabaciones disparadas por movimiento", lambda c: c.eventos_movimiento),
+        ('escritor_pendientes', 'gauge', "Frames en la cola del escritor de segmentos",
+         lambda c: c.escritor.pendientes if c.escritor else 0),
+        ('escritor_descartados_total', 'counter', "Frames perdidos por desborde del escritor",
+         lambda c: c.escritor.descartados if c.escritor else 0),
+        ('archivos_grabados_total', 'counter', "Clips y segmentos finalizados", lambda c: c.archivos_grabados),
+        ('bytes_grabados_total', 'counter', "Bytes de clips y segmentos finalizados", lambda c: c.bytes_grabados),
+        ('ftp_pendientes', 'gauge', "Archivos en cola o subiéndose por FTP", lambda c: ftp_pendientes.get(c.nombre, 0)),
+        ('ftp_bytes_subidos_total', 'counter', "Bytes subidos por FTP", lambda c: c.ftp_bytes_subidos),
+        ('ftp_bytes_reanudados_total', 'counter', "Bytes no reenviados al reanudar subidas",
+         lambda c: c.ftp_bytes_reanudados),
+        ('ftp_subida_segundos_total', 'counter', "Tiempo dedicado a subidas FTP", lambda c: round(c.ftp_segundos_subida, 3)),
+        ('ftp_reintentos_total', 'counter', "Subidas FTP reintentadas", lambda c: c.ftp_reintentos),
+        ('ftp_fallidos_total', 'counter', "Subidas FTP abandonadas tras agotar los intentos", lambda c: c.ftp_fallidos),
+    ]
+    lineas = []
+    for nombre, tipo, ayuda, valor in definiciones:
+        lineas.append(f"# HELP vigilancia_{nombre} {ayuda}")
+        lineas.append(f"# TYPE vigilancia_{nombre} {tipo}")
+        for camara in camaras:
+            lineas.append(f'vigilancia_{nombre}{{camara="{_escapar_etiqueta(camara.nombre)}"}} {valor(camara)}')
+    return "\n".join(lineas) + "\n"
+
+class ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        cuerpo = generar_metricas(self.server.obtener_camaras()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        pass  # Sin una línea por cada consulta de Prometheus
+
+class ServidorMetricas:
+    """Servidor HTTP local con las métricas de las cámaras en /metrics.
+
+    Solo lee contadores que las cámaras ya mantienen: el costo se paga al
+    consultar, no en el hilo de captura.
+    """
+
+    def __init__(self, obtener_camaras, puerto=PUERTO_METRICAS, host=HOST_METRICAS):
+        self.obtener_camaras = obtener_camaras
+        self.puerto = puerto
+        self.host = host
+        self.httpd = None
+
+    def iniciar(self):
+        if not self.puerto:
+            return
+        try:
+            self.httpd = ThreadingHTTPServer((self.host, self.puerto), ManejadorMetricas)
+        except OSError as e:
+            print(f"[Métricas] No se pudo abrir el puerto {self.puerto}: {e}")
+            return
+        self.httpd.daemon_threads = True
+        self.httpd.obtener_camaras = self.obtener_camaras
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print(f"[Métricas] Disponibles en http://{self.host}:{self.puerto}/metrics")
+
+    def detener(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+# Servicio sin interfaz gráfica
+class Servicio:
+    """Ejecuta captura, detección, grabación y subida FTP sin pantalla.
+
+    Carga config.json y camaras.txt igual que la interfaz, pero las cámaras no
+    preparan vista previa, así que solo se paga el costo de grabar y detectar.
+    """
+
+    def __init__(self, archivo_config='config.json'):
+        self.config = cargar_config(archivo_config)
+        self.urls, self.nombres_camaras, self.urls_substream = cargar_lista_camaras()
+        self.ftp_config = self.config['ftp_config']
+        self.camaras = []
+        self.retencion = None
+        self.detenido = Event()
+        self.servidor_metricas = ServidorMetricas(lambda: self.camaras,
+                                                  self.config.get('puerto_metricas', PUERTO_METRICAS),
+                                                  self.config.get('host_metricas', HOST_METRICAS))
+
+    def log_ftp(self, mensaje):
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        print(f"[FTP] [{timestamp}] {mensaje}")
 
+    def iniciar(self):
+        os.makedirs(self.config['directorio_videos'], exist_ok=True)
+        for url, nombre, url_substream in zip(self.urls, self.nombres_camaras, self.urls_substream):
+            # Sin frame ni root: la cámara no crea widgets ni prepara vista previa
+            camara = Camara(url, nombre, None, None, config_para_camara(self.config, nombre), url_substream)
+            camara.app = self
+            self.camaras.append(camara)
+            camara.iniciar()
+        programar_limpieza_diaria(lambda: limpiar_archivos_ftp_antiguos(
+            self.ftp_config, self.log_ftp, self.config.get('ftp_horas_retencion', FTP_HORAS_RETENCION)))
+        iniciar_servicio_ftp(self.config)
+        iniciar_catalogo(self.config)
+        self.retencion = obtener_servicio_retencion(self.config)
+        self.servidor_metricas.iniciar()
+        print(f"[Servicio] {len(self.camaras)} cámaras iniciadas en modo {self.config['modo_grabacion']}")
+
+    def detener(self):
+        for camara in self.camaras:
+            camara.detener()
+        self.camaras = []
+        if self.retencion:
+            self.retencion.detener()
+        print("[Servicio] Cámaras detenidas")
+
+    def ejecutar(self):
+        """Inicia las cámaras y bloquea hasta recibir SIGINT o SIGTERM."""
+        if not self.urls:
+            print("[Servicio] No hay cámaras configuradas en camaras.txt")
+            return
+        signal.signal(signal.SIGINT, lambda *_: self.detenido.set())
+        signal.signal(signal.SIGTERM, lambda *_: self.detenido.set())
+        self.iniciar()
+        while not self.detenido.wait(1):
+            pass
+        self.detener()
+        self.servidor_metricas.detener()
+        # Dar tiempo a que los escritores y ffmpeg cierren los últimos archivos
+        time.sleep(2)
+
+# Ciclo único de refresco de la interfaz
+def widget_visible(widget, contenedor):
+    """Indica si el widget está mapeado y al menos en parte dentro del área visible del contenedor."""
+    if not widget.winfo_ismapped():
+        return False
+    y = widget.winfo_rooty()
+    contenedor_y = contenedor.winfo_rooty()
+    return y + widget.winfo_height() > contenedor_y and y < contenedor_y + contenedor.winfo_height()
+
+class RenderizadorGrilla:
+    """Refresca todas las vistas de cámara desde un único `after` del hilo de Tk.
+
+    En cada tick, a `fps` cuadros por segundo, solo se dibujan las vistas visibles
+    que recibieron un frame nuevo. Las vistas fuera del área visible quedan en
+    pausa (`vista.pausada`) y con la ventana minimizada no se refresca nada, por lo
+    que el costo en el hilo de Tk no crece con callbacks vacíos por cámara.
+
+    Cada vista implementa `esta_visible(contenedor)`, donde el contenedor es None
+    si la ventana principal está minimizada, `mostrar_video()` y `detener()`, que
+    se llama si su ventana se cerró sin quitarla para liberar sus suscripciones.
+    """
+
+    def __init__(self, root, contenedor, fps=FPS_VISUALIZACION):
+        self.root = root
+        self.contenedor = contenedor  # Área con scroll donde están las vistas de la grilla
+        self.vistas = []
+        self.activo = False
+        self.configurar_fps(fps)
+
+    def configurar_fps(self, fps):
+        self.intervalo = max(1, int(1000 / max(1, fps)))
+
+    def registrar(self, vista):
+        if vista not in self.vistas:
+            self.vistas.append(vista)
+        if not self.activo:
+            self.activo = True
+            self.root.after(self.intervalo, self.tick)
+
+    def quitar(self, vista):
+        if vista in self.vistas:
+            self.vistas.remove(vista)
+
+    def tick(self):
+        if not self.vistas:
+            self.activo = False
+            return
+        inicio = time.perf_counter()
+        # Con la ventana principal minimizada se pausa toda la grilla (contenedor None)
+        contenedor = self.contenedor if self.root.state() not in ('iconic', 'withdrawn') else None
+        for vista in list(self.vistas):
+            try:
+                vista.pausada = not vista.esta_visible(contenedor)
+                if not vista.pausada:
+                    vista.mostrar_video()
+            except tk.TclError:
+                # La ventana de la vista se cerró: desuscribirla del stream antes de olvidarla
+                try:
+                    vista.detener()
+                except Exception as e:
+                    print(f"[Error] Error al detener la vista de {vista.nombre}: {e}")
+                self.quitar(vista)
             except Exception as e:
-                print(f"[FTP] Error en procesamiento de cola: {e}")
-                time.sleep(1)
+                print(f"[Error] Error al refrescar la vista de {vista.nombre}: {e}")
+        # Descontar el tiempo de dibujo para mantener la tasa configurada
+        transcurrido = int((time.perf_counter() - inicio) * 1000)
+        self.root.after(max(1, self.intervalo - transcurrido), self.tick)
+
+# Vista mosaico: todas las cámaras en una sola imagen
+class CeldaMosaico:
+    """Escribe los frames de una cámara en su celda del lienzo del mosaico (en el hilo de captura)."""
+
+    def __init__(self, compositor, camara, x, y):
+        self.compositor = compositor
+        self.camara = camara
+        self.x = x
+        self.y = y
+        self.ancho = compositor.ancho_celda
+        self.alto = compositor.alto_celda
+        # Vista sobre el lienzo, sin copia: el resize escribe directamente en la celda
+        self.region = compositor.lienzo[y:y + self.alto, x:x + self.ancho]
+        self._ultimo = 0
+
+    def ofrecer(self, frame):
+        if self.compositor.pausada:
+            return
+        ahora = time.time()
+        if ahora - self._ultimo < self.compositor.intervalo:
+            return
+        self._ultimo = ahora
+        cv2.resize(frame, (self.ancho, self.alto), dst=self.region, interpolation=cv2.INTER_AREA)
+        self.compositor.sucio = True
+
+class CompositorMosaico:
+    """Muestra todas las cámaras en un único lienzo NumPy preasignado y un solo PhotoImage.
+
+    Cada cámara escribe su frame reducido directamente en su celda desde su hilo de
+    captura; en cada tick del renderizador el hilo de Tk convierte el lienzo
+    completo a RGB en un buffer fijo y lo pega en un PhotoImage persistente, así el
+    costo de la interfaz casi no depende de la cantidad de cámaras. Una celda puede
+    mezclar dos frames consecutivos durante un tick, algo imperceptible a esta tasa.
+    Los nombres y estados se dibujan como textos del canvas sobre la imagen.
+    """
+
+    def __init__(self, frame_padre, cantidad, ancho_celda=CELDA_MOSAICO[0], alto_celda=CELDA_MOSAICO[1],
+                 fps=FPS_VISUALIZACION):
+        self.nombre = "Mosaico"
+        self.ancho_celda = ancho_celda
+        self.alto_celda = alto_celda
+        self.columnas = max(1, math.ceil(math.sqrt(cantidad)))
+        self.filas = max(1, math.ceil(cantidad / self.columnas))
+        self.intervalo = 1.0 / max(1, fps)
+        self.lienzo = np.zeros((self.filas * alto_celda, self.columnas * ancho_celda, 3), dtype=np.uint8)
+        self._rgb = np.zeros_like(self.lienzo)
+        self.celdas = []
+        self.pausada = False
+        self.sucio = False
+        self.canvas = tk.Canvas(frame_padre, width=self.lienzo.shape[1], height=self.lienzo.shape[0],
+                                bg="black", highlightthickness=0)
+        self.canvas.pack()
+        self.photo = None
+        self.image_item = None
+        self._textos = {}  # celda -> (id del texto de estado, último texto)
+
+    def agregar(self, camara):
+        """Asigna la siguiente celda libre a la cámara y la suscribe a su stream."""
+        indice = len(self.celdas)
+        x = (indice % self.columnas) * self.ancho_celda
+        y = (indice // self.columnas) * self.alto_celda
+        celda = CeldaMosaico(self, camara, x, y)
+        self.celdas.append(celda)
+        fuente = (STYLE_CONFIG['font_family'], STYLE_CONFIG['font_size_small'])
+        self.canvas.create_text(x + 6, y + 4, anchor=tk.NW, text=camara.nombre, fill="white",
+                                font=fuente + ("bold",), tags="superpuesto")
+        texto_estado = self.canvas.create_text(x + 6, y + self.alto_celda - 4, anchor=tk.SW, text="",
+                                               fill="white", font=fuente, tags="superpuesto")
+        self._textos[celda] = (texto_estado, "")
+        camara.bus.agregar_consumidor(celda.ofrecer)
+        return celda
+
+    def quitar(self, camara):
+        for celda in self.celdas:
+            if celda.camara is camara:
+                camara.bus.quitar_consumidor(celda.ofrecer)
+
+    def detener(self):
+        """Desuscribe todas las celdas de los streams de sus cámaras."""
+        for celda in self.celdas:
+            celda.camara.bus.quitar_consumidor(celda.ofrecer)
+
+    def camara_en(self, x, y):
+        """Devuelve la cámara de la celda que contiene el punto del canvas, o None."""
+        indice = (y // self.alto_celda) * self.columnas + (x // self.ancho_celda)
+        if 0 <= x < self.lienzo.shape[1] and 0 <= indice < len(self.celdas):
+            return self.celdas[indice].camara
+        return None
+
+    def esta_visible(self, contenedor):
+        return contenedor is not None and widget_visible(self.canvas, contenedor)
+
+    def mostrar_video(self):
+        # Actualizar los estados superpuestos solo si cambiaron
+        for celda, (texto_id, anterior) in self._textos.items():
+            texto = celda.camara.descripcion_estado()
+            if texto != anterior:
+                self.canvas.itemconfig(texto_id, text=texto)
+                self._textos[celda] = (texto_id, texto)
+
+        if not self.sucio:
+            return
+        self.sucio = False
+        cv2.cvtColor(self.lienzo, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        imagen = Image.fromarray(self._rgb)
+        if self.image_item is None:
+            self.photo = ImageTk.PhotoImage(image=imagen)
+            self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+            self.canvas.tag_raise("superpuesto")
+        else:
+            self.photo.paste(imagen)
 
 # Clase principal para la interfaz de usuario
 class Aplicacion:
@@ -565,6 +3270,7 @@ class Aplicacion:
         self.camaras = []
         self.root_window = root  # Guardar referencia al root
         self.urls = []  # Lista de URLs cargadas
+        self.urls_substream = []  # URLs secundarias de baja resolución ('' si la cámara no tiene)
         self.nombres_camaras = []  # Lista de nombres personalizados
 
         # Configurar estilo moderno con ttkbootstrap
@@ -578,10 +3284,22 @@ class Aplicacion:
         self.modo_grabacion = tk.StringVar(value="motion")  # "motion", "continuous", "none"
         self.duracion_grabacion = tk.IntVar(value=15)  # segundos para motion
         self.segmento_continuo = tk.IntVar(value=5)  # minutos para continuous
+        self.backend_grabacion = tk.StringVar(value="opencv")  # "opencv" (recodifica a XVID) o "copia" (ffmpeg -c copy)
         self.sensibilidad_movimiento = tk.IntVar(value=100)  # threshold para motion detection
+        self.preroll_segundos = tk.IntVar(value=3)  # segundos previos al movimiento incluidos en el clip
+        self.preroll_max_mb = tk.IntVar(value=128)  # memoria máxima del buffer de pre-grabación por cámara
+        self.ancho_analisis = tk.IntVar(value=ANCHO_ANALISIS)  # ancho del frame usado para detectar movimiento
+
+        # Ajustes por cámara que reemplazan a los globales (clave: nombre de la cámara)
+        self.config_por_camara = {}
+
+        # Ajustes avanzados de config.json sin control en la interfaz (se conservan al guardar)
+        self.config_archivo = {}
 
         # Configuración adicional
         self.directorio_videos = tk.StringVar(value="./videos")
+        self.modo_mosaico = tk.BooleanVar(value=False)  # Todas las cámaras en una sola imagen
+        self.mosaico = None
         self.ftp_config = {
             'host': '',
             'user': '',
@@ -595,6 +3313,9 @@ class Aplicacion:
         # Crear interfaz principal (solo videos, sin lista de cámaras visible)
         self.crear_interfaz_principal()
 
+        # Ciclo único de refresco para todas las vistas de cámara
+        self.renderizador = RenderizadorGrilla(self.root, self.canvas)
+
         # Iniciar scheduler para limpieza diaria
         self.iniciar_scheduler_limpieza()
 
@@ -602,22 +3323,25 @@ class Aplicacion:
         self.cargar_configuracion()
         self.cargar_camaras()
 
-    def iniciar_scheduler_limpieza(self):
-        """Inicia el scheduler para limpieza diaria de archivos FTP."""
-        def limpieza_diaria():
-            Thread(target=self.limpiar_archivos_ftp_antiguos, daemon=True).start()
+        # Reanudar las subidas FTP que quedaron pendientes en el journal
+        iniciar_servicio_ftp({**self.config_archivo, 'ftp_config': self.ftp_config})
 
-        # Programar limpieza diaria a las 00:00
-        schedule.every().day.at("00:00").do(limpieza_diaria)
+        # Poner al día el catálogo de grabaciones con lo que haya en el disco
+        iniciar_catalogo({**self.config_archivo, 'directorio_videos': self.directorio_videos.get()})
 
-        # Ejecutar scheduler en un hilo separado
-        def run_scheduler():
-            while True:
-                schedule.run_pending()
-                time.sleep(60)  # Revisar cada minuto
+        # Mantener el disco dentro de los límites de retención aunque las cámaras no estén iniciadas
+        obtener_servicio_retencion({**self.config_archivo, 'directorio_videos': self.directorio_videos.get(),
+                                    'por_camara': self.config_por_camara})
+
+        # Métricas en formato Prometheus para el monitoreo externo
+        self.servidor_metricas = ServidorMetricas(lambda: self.camaras,
+                                                  self.config_archivo.get('puerto_metricas', PUERTO_METRICAS),
+                                                  self.config_archivo.get('host_metricas', HOST_METRICAS))
+        self.servidor_metricas.iniciar()
 
-        Thread(target=run_scheduler, daemon=True).start()
-        print("[Scheduler] Limpieza diaria programada para las 00:00")
+    def iniciar_scheduler_limpieza(self):
+        """Inicia el scheduler para limpieza diaria de archivos FTP."""
+        programar_limpieza_diaria(self.limpiar_archivos_ftp_antiguos)
 
     def log_ftp(self, mensaje):
         """Agrega un mensaje al panel de logs FTP."""
@@ -636,91 +3360,8 @@ class Aplicacion:
 
     def limpiar_archivos_ftp_antiguos(self):
         """Limpia archivos remotos FTP que tengan más de 96 horas."""
-        ftp_config = self.ftp_config
-        if not ftp_config.get('host') or not ftp_config.get('user') or not ftp_config.get('password'):
-            print("[FTP] FTP no configurado, omitiendo limpieza")
-            return
-
-        try:
-            with ftplib.FTP(ftp_config['host']) as ftp:
-                ftp.login(ftp_config['user'], ftp_config['password'])
-                remote_path = ftp_config.get('remote_path', '/videos')
-
-                # Cambiar al directorio remoto
-                try:
-                    ftp.cwd(remote_path)
-                except ftplib.error_perm:
-                    print(f"[FTP] Directorio remoto {remote_path} no existe")
-                    return
-
-                # Obtener lista de directorios de cámaras
-                try:
-                    dirs = []
-                    ftp.retrlines('LIST', lambda x: dirs.append(x.split()[-1]) if x.startswith('d') else None)
-                except:
-                    dirs = []
-
-                archivos_eliminados = 0
-                tiempo_limite = 96 * 3600  # 96 horas en segundos
-                ahora = time.time()
-
-                for cam_dir in dirs:
-                    try:
-                        ftp.cwd(cam_dir)
-                        # Obtener archivos en el directorio de la cámara
-                        archivos = []
-                        ftp.retrlines('LIST', lambda x: archivos.append(x.split()))
-
-                        for archivo_info in archivos:
-                            if len(archivo_info) >= 9:
-                                # Parsear fecha del archivo (formato FTP: -rw-r--r-- 1 user group size month day time filename)
-                                try:
-                                    mes, dia, hora_o_ano = archivo_info[5], archivo_info[6], archivo_info[7]
-                                    filename = ' '.join(archivo_info[8:])
-
-                                    # Convertir fecha a timestamp (aproximado)
-                                    fecha_archivo = self.parsear_fecha_ftp(mes, dia, hora_o_ano)
-                                    if fecha_archivo and (ahora - fecha_archivo) > tiempo_limite:
-                                        # Eliminar archivo
-                                        ftp.delete(filename)
-                                        archivos_eliminados += 1
-                                        print(f"[FTP] Eliminado archivo antiguo: {cam_dir}/{filename}")
-                                except:
-                                    continue
-
-                        ftp.cwd('..')  # Volver al directorio padre
-                    except:
-                        continue
-
-                if archivos_eliminados > 0:
-                    self.log_ftp(f"Eliminados {archivos_eliminados} archivos antiguos del FTP")
-                print(f"[FTP] Limpieza completada: {archivos_eliminados} archivos eliminados")
-
-        except Exception as e:
-            print(f"[FTP] Error en limpieza: {e}")
-            self.log_ftp(f"Error en limpieza FTP: {str(e)[:50]}...")
-
-    def parsear_fecha_ftp(self, mes, dia, hora_o_ano):
-        """Parsea fecha de listado FTP a timestamp."""
-        try:
-            meses = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-                    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
-
-            ahora = datetime.datetime.now()
-            mes_num = meses.get(mes, 1)
-
-            if ':' in hora_o_ano:
-                # Formato: HH:MM (archivo de este año)
-                hora, minuto = map(int, hora_o_ano.split(':'))
-                fecha = datetime.datetime(ahora.year, mes_num, int(dia), hora, minuto)
-            else:
-                # Formato: YYYY (archivo de años anteriores)
-                ano = int(hora_o_ano)
-                fecha = datetime.datetime(ano, mes_num, int(dia))
-
-            return fecha.timestamp()
-        except:
-            return None
+        limpiar_archivos_ftp_antiguos(self.ftp_config, self.log_ftp,
+                                      self.config_archivo.get('ftp_horas_retencion', FTP_HORAS_RETENCION))
 
     def ejecutar_limpieza_videos(self, dias_conservar):
         """Ejecuta la limpieza de videos antiguos."""
@@ -735,53 +3376,16 @@ class Aplicacion:
 
                 # Calcular fecha límite
                 fecha_limite = datetime.datetime.now() - datetime.timedelta(days=dias_conservar)
-                limite_timestamp = fecha_limite.timestamp()
-
-                archivos_eliminados = 0
-                espacio_liberado = 0
-
-                # Recorrer todas las carpetas de cámaras
-                for carpeta_camara in os.listdir(directorio_base):
-                    ruta_camara = os.path.join(directorio_base, carpeta_camara)
-                    if not os.path.isdir(ruta_camara):
-                        continue
-
-                    print(f"[Limpieza] Revisando carpeta: {carpeta_camara}")
-
-                    # Obtener lista de archivos
-                    archivos = []
-                    for archivo in os.listdir(ruta_camara):
-                        ruta_completa = os.path.join(ruta_camara, archivo)
-                        if os.path.isfile(ruta_completa):
-                            try:
-                                # Extraer fecha del nombre del archivo
-                                # Formato esperado: continuo_YYYYMMDD_HHMMSS.avi o YYYYMMDD_HHMMSS.avi
-                                if archivo.startswith('continuo_'):
-                                    partes = archivo.split('_')
-                                    if len(partes) >= 3:
-                                        fecha_str = partes[1] + '_' + partes[2].split('.')[0]
-                                    else:
-                                        continue
-                                else:
-                                    fecha_str = archivo.split('.')[0]
-
-                                # Convertir a timestamp
-                                fecha_archivo = datetime.datetime.strptime(fecha_str, "%Y%m%d_%H%M%S")
-                                archivos.append((ruta_completa, fecha_archivo.timestamp(), os.path.getsize(ruta_completa)))
-                            except (ValueError, IndexError):
-                                # Si no se puede parsear la fecha, omitir
-                                continue
-
-                    # Eliminar archivos antiguos
-                    for ruta_archivo, timestamp_archivo, tamano in archivos:
-                        if timestamp_archivo < limite_timestamp:
-                            try:
-                                os.remove(ruta_archivo)
-                                archivos_eliminados += 1
-                                espacio_liberado += tamano
-                                print(f"[Limpieza] Eliminado: {os.path.basename(ruta_archivo)}")
-                            except Exception as e:
-                                print(f"[Limpieza] Error eliminando {ruta_archivo}: {e}")
+
+                # El catálogo se sincroniza al iniciar y se mantiene al día con cada grabación:
+                # la limpieza es solo una consulta a su índice, limitada al directorio elegido
+                catalogo = obtener_catalogo(self.config_archivo.get('catalogo_grabaciones', ARCHIVO_CATALOGO))
+                if not catalogo.sincronizacion_inicial.is_set():
+                    # Sin esperar, los archivos aún no indexados quedarían sin limpiar
+                    print("[Limpieza] Esperando a que termine la sincronización del catálogo")
+                    catalogo.sincronizacion_inicial.wait()
+                archivos_eliminados, espacio_liberado = eliminar_grabaciones_antiguas(
+                    fecha_limite.timestamp(), catalogo, directorio_base)
 
                 # Convertir bytes a MB
                 espacio_mb = espacio_liberado / (1024 * 1024)
@@ -923,6 +3527,8 @@ class Aplicacion:
         camaras_menu.add_separator()
         camaras_menu.add_command(label="Cargar Cámaras", command=self.cargar_camaras)
         camaras_menu.add_command(label="Guardar Cámaras", command=self.guardar_camaras)
+        camaras_menu.add_separator()
+        camaras_menu.add_command(label="Estado de Conexiones", command=self.mostrar_estado_conexiones)
 
         # Menú Configuración
         config_menu = tk.Menu(menubar, tearoff=0)
@@ -932,6 +3538,7 @@ class Aplicacion:
         config_menu.add_command(label="Directorio de Videos", command=self.cambiar_directorio_videos)
         config_menu.add_command(label="Configuración FTP", command=self.configurar_ftp)
         config_menu.add_command(label="Limpiar Videos Antiguos", command=self.limpiar_videos_antiguos)
+        config_menu.add_checkbutton(label="Vista Mosaico", variable=self.modo_mosaico)
         config_menu.add_separator()
         config_menu.add_command(label="Guardar Configuración", command=self.guardar_configuracion)
 
@@ -946,7 +3553,7 @@ class Aplicacion:
     def mostrar_config_grabacion(self):
         dialog = ttk.Window(themename=STYLE_CONFIG['theme'])
         dialog.title("Configuración de Grabación")
-        dialog.geometry("500x350")
+        dialog.geometry("500x560")
 
         # Frame principal
         main_frame = ttk.Frame(dialog, style="Modern.TFrame")
@@ -968,6 +3575,14 @@ class Aplicacion:
         ttk.Radiobutton(modo_frame, text="🔄 Continua", variable=self.modo_grabacion, value="continuous").pack(anchor=tk.W, pady=2, padx=10)
         ttk.Radiobutton(modo_frame, text="🚫 Sin grabación", variable=self.modo_grabacion, value="none").pack(anchor=tk.W, pady=2, padx=10)
 
+        # Backend de la grabación continua
+        backend_frame = ttk.LabelFrame(main_frame, text="Grabación Continua",
+                                      style="Modern.TLabelframe")
+        backend_frame.pack(fill=tk.X, pady=(0, 15))
+
+        ttk.Radiobutton(backend_frame, text="🎞️ OpenCV (recodifica a XVID)", variable=self.backend_grabacion, value="opencv").pack(anchor=tk.W, pady=2, padx=10)
+        ttk.Radiobutton(backend_frame, text="⚡ Copia directa con FFmpeg (sin recodificar)", variable=self.backend_grabacion, value="copia").pack(anchor=tk.W, pady=2, padx=10)
+
         # Configuración de tiempo
         tiempo_frame = ttk.LabelFrame(main_frame, text="Configuración de Tiempo",
                                      style="Modern.TLabelframe")
@@ -994,6 +3609,26 @@ class Aplicacion:
                  style="Modern.TLabel").pack(side=tk.LEFT)
         ttk.Spinbox(sens_frame, from_=50, to=255, textvariable=self.sensibilidad_movimiento, width=10).pack(side=tk.RIGHT)
 
+        # Resolución de análisis
+        analisis_frame = ttk.Frame(tiempo_frame, style="Modern.TFrame")
+        analisis_frame.pack(fill=tk.X, padx=10, pady=5)
+        ttk.Label(analisis_frame, text="Ancho de análisis (px, 0 = completo):",
+                 style="Modern.TLabel").pack(side=tk.LEFT)
+        ttk.Spinbox(analisis_frame, from_=0, to=3840, increment=160, textvariable=self.ancho_analisis, width=10).pack(side=tk.RIGHT)
+
+        # Pre-grabación para modo movimiento
+        pre_frame = ttk.Frame(tiempo_frame, style="Modern.TFrame")
+        pre_frame.pack(fill=tk.X, padx=10, pady=5)
+        ttk.Label(pre_frame, text="Pre-grabación (segundos):",
+                 style="Modern.TLabel").pack(side=tk.LEFT)
+        ttk.Spinbox(pre_frame, from_=0, to=30, textvariable=self.preroll_segundos, width=10).pack(side=tk.RIGHT)
+
+        pre_mem_frame = ttk.Frame(tiempo_frame, style="Modern.TFrame")
+        pre_mem_frame.pack(fill=tk.X, padx=10, pady=5)
+        ttk.Label(pre_mem_frame, text="Memoria pre-grabación por cámara (MB):",
+                 style="Modern.TLabel").pack(side=tk.LEFT)
+        ttk.Spinbox(pre_mem_frame, from_=16, to=2048, textvariable=self.preroll_max_mb, width=10).pack(side=tk.RIGHT)
+
         # Botón aceptar
         btn_frame = ttk.Frame(main_frame, style="Modern.TFrame")
         btn_frame.pack(fill=tk.X, pady=(20, 0))
@@ -1087,9 +3722,11 @@ class Aplicacion:
         """Actualiza la lista en el diálogo de gestión."""
         if hasattr(self, 'gestion_lista_camaras'):
             self.gestion_lista_camaras.delete(0, tk.END)
-            for i, (url, nombre) in enumerate(zip(self.urls, self.nombres_camaras)):
+            for i, (url, nombre, url_substream) in enumerate(zip(self.urls, self.nombres_camaras, self.urls_substream)):
                 # Mostrar nombre y URL (ocultando credenciales por seguridad)
                 display_url = self.ocultar_credenciales(url)
+                if url_substream:
+                    display_url += f" (substream: {self.ocultar_credenciales(url_substream)})"
                 self.gestion_lista_camaras.insert(tk.END, f"{nombre}: {display_url}")
 
     def ocultar_credenciales(self, url):
@@ -1142,6 +3779,32 @@ class Aplicacion:
         self.guardar_camaras()
         parent_dialog.destroy()
 
+    def mostrar_estado_conexiones(self):
+        """Muestra el historial de estados de conexión de cada cámara."""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Estado de Conexiones")
+        dialog.geometry("600x400")
+
+        texto = tk.Text(dialog, wrap=tk.NONE, font=(STYLE_CONFIG['font_family'], STYLE_CONFIG['font_size_small']))
+        texto.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        def actualizar():
+            texto.config(state=tk.NORMAL)
+            texto.delete('1.0', tk.END)
+            if not self.camaras:
+                texto.insert(tk.END, "No hay cámaras activas.\n")
+            for camara in self.camaras:
+                supervisor = camara.supervisor
+                texto.insert(tk.END, f"{camara.nombre}: {supervisor.estado} "
+                                     f"({supervisor.reconexiones} reconexiones)\n")
+                for linea in supervisor.descripcion_historial():
+                    texto.insert(tk.END, f"    {linea}\n")
+                texto.insert(tk.END, "\n")
+            texto.config(state=tk.DISABLED)
+
+        ttk.Button(dialog, text="🔄 Actualizar", style="primary.TButton", command=actualizar).pack(pady=(0, 10))
+        actualizar()
+
     def mostrar_acerca_de(self):
         """Muestra información sobre la aplicación."""
         about_text = """Sistema de Vigilancia RTSP
@@ -1230,6 +3893,8 @@ Desarrollado con Python y OpenCV"""
             self.ftp_config['user'] = user_entry.get().strip()
             self.ftp_config['password'] = pass_entry.get().strip()
             self.ftp_config['remote_path'] = path_entry.get().strip()
+            # Reanudar las subidas pendientes con el nuevo servidor
+            iniciar_servicio_ftp({**self.config_archivo, 'ftp_config': self.ftp_config})
             messagebox.showinfo("Configuración", "Configuración FTP guardada correctamente.")
             dialog.destroy()
 
@@ -1287,14 +3952,21 @@ Desarrollado con Python y OpenCV"""
                   command=dialog.destroy).pack(side=tk.RIGHT)
 
     def guardar_configuracion(self):
-        config = {
+        config = dict(self.config_archivo)
+        config.update({
             'modo_grabacion': self.modo_grabacion.get(),
             'duracion_grabacion': self.duracion_grabacion.get(),
             'segmento_continuo': self.segmento_continuo.get(),
+            'backend_grabacion': self.backend_grabacion.get(),
             'sensibilidad_movimiento': self.sensibilidad_movimiento.get(),
+            'preroll_segundos': self.preroll_segundos.get(),
+            'preroll_max_mb': self.preroll_max_mb.get(),
+            'ancho_analisis': self.ancho_analisis.get(),
             'directorio_videos': self.directorio_videos.get(),
-            'ftp_config': self.ftp_config
-        }
+            'modo_mosaico': self.modo_mosaico.get(),
+            'ftp_config': self.ftp_config,
+            'por_camara': self.config_por_camara
+        })
         try:
             with open('config.json', 'w') as f:
                 json.dump(config, f, indent=4)
@@ -1305,35 +3977,23 @@ Desarrollado con Python y OpenCV"""
             print(f"[Error] No se pudo guardar la configuración: {e}")
 
     def cargar_configuracion(self):
-        try:
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-            self.modo_grabacion.set(config.get('modo_grabacion', 'motion'))
-            self.duracion_grabacion.set(config.get('duracion_grabacion', 15))
-            self.segmento_continuo.set(config.get('segmento_continuo', 5))
-            self.sensibilidad_movimiento.set(config.get('sensibilidad_movimiento', 100))
-            self.directorio_videos.set(config.get('directorio_videos', './videos'))
-            self.ftp_config.update(config.get('ftp_config', {}))
-            print("[Config] Configuración cargada desde config.json")
-        except FileNotFoundError:
-            print("[Config] No se encontró archivo de configuración, usando valores por defecto")
-        except Exception as e:
-            print(f"[Error] Error al cargar configuración: {e}")
+        config = cargar_config('config.json')
+        self.config_archivo = config
+        self.modo_grabacion.set(config['modo_grabacion'])
+        self.duracion_grabacion.set(config['duracion_grabacion'])
+        self.segmento_continuo.set(config['segmento_continuo'])
+        self.backend_grabacion.set(config['backend_grabacion'])
+        self.sensibilidad_movimiento.set(config['sensibilidad_movimiento'])
+        self.preroll_segundos.set(config['preroll_segundos'])
+        self.preroll_max_mb.set(config['preroll_max_mb'])
+        self.ancho_analisis.set(config['ancho_analisis'])
+        self.config_por_camara = config['por_camara']
+        self.directorio_videos.set(config['directorio_videos'])
+        self.modo_mosaico.set(config['modo_mosaico'])
+        self.ftp_config.update(config['ftp_config'])
 
     def cargar_camaras(self):
-        try:
-            self.urls = leer_camaras("camaras.txt")
-        except FileNotFoundError:
-            self.urls = []
-        # Cargar nombres de cámaras si existe el archivo
-        try:
-            with open("nombres_camaras.txt", 'r') as f:
-                self.nombres_camaras = f.read().strip().split(',')
-        except FileNotFoundError:
-            self.nombres_camaras = [f"Cámara_{i+1}" for i in range(len(self.urls))]
-        # Asegurar que tengamos nombres para todas las URLs
-        while len(self.nombres_camaras) < len(self.urls):
-            self.nombres_camaras.append(f"Cámara_{len(self.nombres_camaras)+1}")
+        self.urls, self.nombres_camaras, self.urls_substream = cargar_lista_camaras()
         # Actualizar estado en lugar de lista (ya no hay lista visible)
         self.actualizar_estado()
 
@@ -1344,7 +4004,7 @@ Desarrollado con Python y OpenCV"""
     def agregar_camara(self):
         dialog = ttk.Window(themename=STYLE_CONFIG['theme'])
         dialog.title("Agregar nueva cámara")
-        dialog.geometry("500x250")
+        dialog.geometry("500x320")
 
         # Frame principal
         main_frame = ttk.Frame(dialog, style="Modern.TFrame")
@@ -1366,7 +4026,12 @@ Desarrollado con Python y OpenCV"""
         ttk.Label(main_frame, text="🔗 URL RTSP:",
                  style="Modern.TLabel").pack(anchor=tk.W, pady=(0, 5))
         url_entry = ttk.Entry(main_frame, width=50)
-        url_entry.pack(pady=(0, 20))
+        url_entry.pack(pady=(0, 15))
+
+        ttk.Label(main_frame, text="🔗 URL substream (opcional, baja resolución):",
+                 style="Modern.TLabel").pack(anchor=tk.W, pady=(0, 5))
+        substream_entry = ttk.Entry(main_frame, width=50)
+        substream_entry.pack(pady=(0, 20))
 
         # Botones
         btn_frame = ttk.Frame(main_frame, style="Modern.TFrame")
@@ -1379,6 +4044,7 @@ Desarrollado con Python y OpenCV"""
                 if not nombre:
                     nombre = f"Cámara_{len(self.urls)+1}"
                 self.urls.append(url)
+                self.urls_substream.append(substream_entry.get().strip())
                 self.nombres_camaras.append(nombre)
                 self.actualizar_lista_camaras()
                 dialog.destroy()
@@ -1398,7 +4064,7 @@ Desarrollado con Python y OpenCV"""
         """Edita una cámara por su índice."""
         dialog = ttk.Window(themename=STYLE_CONFIG['theme'])
         dialog.title("Editar cámara")
-        dialog.geometry("500x250")
+        dialog.geometry("500x320")
 
         # Frame principal
         main_frame = ttk.Frame(dialog, style="Modern.TFrame")
@@ -1422,7 +4088,13 @@ Desarrollado con Python y OpenCV"""
                  style="Modern.TLabel").pack(anchor=tk.W, pady=(0, 5))
         url_entry = ttk.Entry(main_frame, width=50)
         url_entry.insert(0, self.urls[indice])
-        url_entry.pack(pady=(0, 20))
+        url_entry.pack(pady=(0, 15))
+
+        ttk.Label(main_frame, text="🔗 URL substream (opcional, baja resolución):",
+                 style="Modern.TLabel").pack(anchor=tk.W, pady=(0, 5))
+        substream_entry = ttk.Entry(main_frame, width=50)
+        substream_entry.insert(0, self.urls_substream[indice])
+        substream_entry.pack(pady=(0, 20))
 
         # Botones
         btn_frame = ttk.Frame(main_frame, style="Modern.TFrame")
@@ -1435,6 +4107,7 @@ Desarrollado con Python y OpenCV"""
                 if not nombre:
                     nombre = f"Cámara_{indice+1}"
                 self.urls[indice] = url
+                self.urls_substream[indice] = substream_entry.get().strip()
                 self.nombres_camaras[indice] = nombre
                 dialog.destroy()
                 messagebox.showinfo("Éxito", f"Cámara '{nombre}' actualizada correctamente.")
@@ -1458,6 +4131,7 @@ Desarrollado con Python y OpenCV"""
         nombre = self.nombres_camaras[indice]
         if messagebox.askyesno("Confirmar eliminación", f"¿Está seguro de que desea eliminar la cámara '{nombre}'?"):
             del self.urls[indice]
+            del self.urls_substream[indice]
             del self.nombres_camaras[indice]
             messagebox.showinfo("Éxito", f"Cámara '{nombre}' eliminada correctamente.")
 
@@ -1518,8 +4192,10 @@ Desarrollado con Python y OpenCV"""
             f.write(','.join(self.urls))
         with open("nombres_camaras.txt", 'w') as f:
             f.write(','.join(self.nombres_camaras))
+        with open("substreams_camaras.txt", 'w') as f:
+            f.write(','.join(self.urls_substream))
         messagebox.showinfo("Éxito", "Configuración de cámaras guardada correctamente.")
-        print("[Info] Cámaras guardadas en camaras.txt y nombres_camaras.txt")
+        print("[Info] Cámaras guardadas en camaras.txt, nombres_camaras.txt y substreams_camaras.txt")
 
     def iniciar_camaras(self):
         if not self.urls:
@@ -1532,21 +4208,34 @@ Desarrollado con Python y OpenCV"""
         self.camaras = []
 
         # Configurar parámetros según el modo seleccionado
-        config = {
+        config = dict(self.config_archivo)
+        config.update({
             'modo_grabacion': self.modo_grabacion.get(),
             'duracion_grabacion': self.duracion_grabacion.get(),
             'segmento_continuo': self.segmento_continuo.get(),
+            'backend_grabacion': self.backend_grabacion.get(),
             'sensibilidad_movimiento': self.sensibilidad_movimiento.get(),
+            'preroll_segundos': self.preroll_segundos.get(),
+            'preroll_max_mb': self.preroll_max_mb.get(),
+            'ancho_analisis': self.ancho_analisis.get(),
             'directorio_videos': self.directorio_videos.get(),
-            'ftp_config': self.ftp_config.copy()
-        }
+            'ftp_config': self.ftp_config.copy(),
+            'por_camara': self.config_por_camara
+        })
+
+        self.renderizador.configurar_fps(config.get('fps_visualizacion', FPS_VISUALIZACION))
+        obtener_servicio_retencion(config)
+
+        if self.modo_mosaico.get():
+            self.iniciar_camaras_mosaico(config)
+            return
 
         # Calcular layout óptimo para las cámaras
         num_camaras = len(self.urls)
         cols = min(4, max(1, int(num_camaras ** 0.5) + 1))  # Máximo 4 columnas
         rows = (num_camaras + cols - 1) // cols
 
-        for i, (url, nombre) in enumerate(zip(self.urls, self.nombres_camaras)):
+        for i, (url, nombre, url_substream) in enumerate(zip(self.urls, self.nombres_camaras, self.urls_substream)):
             row = i // cols
             col = i % cols
 
@@ -1567,7 +4256,10 @@ Desarrollado con Python y OpenCV"""
                                     anchor='center')
             nombre_label.pack(fill=tk.X, pady=(5, 0))
 
-            camara = Camara(url, nombre, frame_camara, self.root_window, config)
+            # Aplicar los ajustes específicos de la cámara sobre los globales
+            config_camara = config_para_camara(config, nombre)
+
+            camara = Camara(url, nombre, frame_camara, self.root_window, config_camara, url_substream)
             # Asignar referencia a la aplicación para logging
             camara.app = self
             # Bind double-click to open full screen
@@ -1575,21 +4267,49 @@ Desarrollado con Python y OpenCV"""
             camara.canvas.bind("<Double-Button-1>", lambda e, c=camara: self.abrir_ventana_completa(c))
             self.camaras.append(camara)
             camara.iniciar()
+            self.renderizador.registrar(camara)
+
+        # Actualizar estado
+        self.actualizar_estado()
+        self.start_button.config(text="⏹️ Detener Cámaras", bg='#d13438')
+
+    def iniciar_camaras_mosaico(self, config):
+        """Inicia las cámaras mostrándolas todas en una sola imagen compuesta."""
+        ancho_celda, alto_celda = config.get('celda_mosaico', CELDA_MOSAICO)
+        self.mosaico = CompositorMosaico(self.frame_videos, len(self.urls), ancho_celda, alto_celda,
+                                         config.get('fps_visualizacion', FPS_VISUALIZACION))
+        self.mosaico.canvas.bind("<Double-Button-1>", self.abrir_ventana_completa_mosaico)
+
+        for url, nombre, url_substream in zip(self.urls, self.nombres_camaras, self.urls_substream):
+            # Aplicar los ajustes específicos de la cámara sobre los globales
+            config_camara = config_para_camara(config, nombre)
+
+            # Sin frame propio: la cámara se dibuja en su celda del mosaico
+            camara = Camara(url, nombre, None, self.root_window, config_camara, url_substream)
+            camara.app = self
+            self.mosaico.agregar(camara)
+            self.camaras.append(camara)
+            camara.iniciar()
+        self.renderizador.registrar(self.mosaico)
 
         # Actualizar estado
         self.actualizar_estado()
         self.start_button.config(text="⏹️ Detener Cámaras", bg='#d13438')
 
+    def abrir_ventana_completa_mosaico(self, event):
+        camara = self.mosaico.camara_en(event.x, event.y)
+        if camara:
+            self.abrir_ventana_completa(camara)
+
     def detener_camaras(self):
         for camara in self.camaras:
-            camara.running = False
-            if camara.cap.isOpened():
-                camara.cap.release()
-            # Cerrar grabación continua si está activa
-            if hasattr(camara, 'segmento_actual') and camara.segmento_actual:
-                camara.segmento_actual.release()
-            # Detener grabación de audio
-            camara.detener_grabacion_audio()
+            camara.detener()
+            self.renderizador.quitar(camara)
+            if self.mosaico:
+                self.mosaico.quitar(camara)
+        if self.mosaico:
+            self.renderizador.quitar(self.mosaico)
+            self.mosaico = None
 
         self.camaras = []
         # Limpiar frames de video
@@ -1620,87 +4340,103 @@ Desarrollado con Python y OpenCV"""
         # Si el usuario cancela, no hacer nada (la aplicación continúa ejecutándose)
 
     def abrir_ventana_completa(self, camara):
-        ventana = ttk.Window(themename=STYLE_CONFIG['theme'])
+        ventana = tk.Toplevel(self.root)
         ventana.title(f"Stream completo - {camara.nombre}")
         ventana.geometry("800x600")
 
         canvas = tk.Canvas(ventana, width=800, height=600, bg="black")
         canvas.pack()
 
-        # Crear una nueva instancia de Camara para la ventana completa
-        camara_completa = CamaraCompleta(camara.url, camara.nombre, canvas, ventana)
+        # La ventana completa se suscribe al stream de la cámara existente
+        camara_completa = CamaraCompleta(camara, canvas, ventana)
         camara_completa.iniciar()
+        self.renderizador.registrar(camara_completa)
+
+        def cerrar():
+            camara_completa.detener()
+            self.renderizador.quitar(camara_completa)
+            ventana.destroy()
+
+        ventana.protocol("WM_DELETE_WINDOW", cerrar)
 
 # Clase para mostrar stream en ventana completa
 class CamaraCompleta:
-    def __init__(self, url, nombre, canvas, ventana):
-        self.url = url
-        self.nombre = nombre
-        self.cap = cv2.VideoCapture(url)
+    """Vista ampliada de una cámara que se suscribe a su stream en lugar de abrir otra sesión RTSP.
+
+    Si la cámara usa substream, la vista pide el stream principal, que la cámara
+    decodifica solo mientras haya alguna ventana completa abierta.
+    """
+
+    def __init__(self, camara, canvas, ventana):
+        self.camara = camara
+        self.nombre = camara.nombre
         self.canvas = canvas
         self.ventana = ventana
-        self.queue = queue.Queue(maxsize=10)
-        self.running = True
+        self.salida_vista = SalidaVista(800, 600)
+        self.bus = None
+        self.running = False
         self.photo = None
         self.image_item = None
 
     def iniciar(self):
-        Thread(target=self.capturar_video, daemon=True).start()
-        self.ventana.after(100, self.mostrar_video)
+        self.running = True
+        self.bus = self.camara.abrir_stream_completo()
+        # Reducir y convertir en el hilo de captura, fuera del hilo de Tk
+        self.bus.agregar_consumidor(self.salida_vista.ofrecer)
 
-    def capturar_video(self):
-        while self.running:
-            try:
-                ret, frame = self.cap.read()
-                if not ret:
-                    print(f"[Error] No se puede acceder al stream de {self.nombre}")
-                    time.sleep(1)
-                    continue
+    def detener(self):
+        """Se desuscribe del stream de la cámara al cerrar la ventana."""
+        if not self.running:
+            return
+        self.running = False
+        self.bus.quitar_consumidor(self.salida_vista.ofrecer)
+        self.camara.cerrar_stream_completo()
 
-                try:
-                    self.queue.put_nowait(frame)
-                except queue.Full:
-                    try:
-                        self.queue.get_nowait()
-                        self.queue.put_nowait(frame)
-                    except queue.Empty:
-                        pass
-
-                time.sleep(0.01)
-            except Exception as e:
-                print(f"[Error] Error en {self.nombre}: {e}")
-                time.sleep(1)
+    @property
+    def pausada(self):
+        return self.salida_vista.pausada
+
+    @pausada.setter
+    def pausada(self, valor):
+        self.salida_vista.pausada = valor
+
+    def esta_visible(self, contenedor):
+        # La ventana completa no está dentro de la grilla: basta con que no esté minimizada
+        return self.ventana.state() not in ('iconic', 'withdrawn')
 
     def mostrar_video(self):
         if not self.running:
             return
 
-        try:
-            frame = self.queue.get_nowait()
-        except queue.Empty:
-            self.ventana.after(10, self.mostrar_video)
+        frame_rgb = self.salida_vista.tomar()
+        if frame_rgb is None:
             return
-
-        # Redimensionar al tamaño del canvas
-        frame_resized = cv2.resize(frame, (800, 600))
-        frame_rgb = cv2.cvtColor(frame_resized, cv2.COLOR_BGR2RGB)
         frame_pil = Image.fromarray(frame_rgb)
-        self.photo = ImageTk.PhotoImage(image=frame_pil)
 
         if self.image_item is None:
+            self.photo = ImageTk.PhotoImage(image=frame_pil)
             self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
         else:
-            self.canvas.itemconfig(self.image_item, image=self.photo)
-
-        self.ventana.after(10, self.mostrar_video)
+            self.photo.paste(frame_pil)
 
 # Crear carpeta de videos si no existe
 os.makedirs("./videos", exist_ok=True)
 
 # Ejecutar aplicación
 if __name__ == "__main__":
-    root = ttk.Window(themename=STYLE_CONFIG['theme'])
-    app = Aplicacion(root)
-    # La configuración ya se carga en el constructor
-    root.protocol("WM_DELETE_WINDOW", app.confirmar_cierre)
-    root.mainloop()
+    parser = argparse.ArgumentParser(description="Sistema de Vigilancia RTSP")
+    parser.add_argument('--headless', action='store_true',
+                        help="grabar y detectar sin interfaz gráfica (servidores sin pantalla)")
+    parser.add_argument('--config', default='config.json', help="archivo de configuración (modo headless)")
+    args = parser.parse_args()
+
+    if args.headless:
+        Servicio(args.config).ejecutar()
+    else:
+        if tk is None:
+            raise SystemExit("La interfaz gráfica requiere tkinter, ttkbootstrap y Pillow. Use --headless.")
+        root = ttk.Window(themename=STYLE_CONFIG['theme'])
+        app = Aplicacion(root)
+        # La configuración ya se carga en el constructor
+        root.protocol("WM_DELETE_WINDOW", app.confirmar_cierre)
+        root.mainloop()